@@ -0,0 +1,86 @@
+"""
+Helpers shared by the benchmarks - common command line arguments, results file and comparison with the baseline.
+"""
+import sys
+import json
+import argparse
+import platform
+import statistics
+from datetime import datetime, timezone
+
+# Version of the benchmark results format
+RESULTS_FORMAT_VERSION = 1
+
+
+def add_common_arguments(parser: argparse.ArgumentParser, output_default: str, repeat_default: int = 3) -> None:
+    """
+    Adds arguments shared by the benchmarks to the parser.
+    """
+    parser.add_argument('--repeat', type=int, default=repeat_default,
+                        help=f'number of runs of each scenario (default: {repeat_default})')
+    parser.add_argument('-o', '--output', default=output_default,
+                        help=f'file to which the results are written (default: {output_default})')
+    parser.add_argument('--baseline',
+                        help='results file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown of median time against the baseline reported as regression '
+                             '(default: 0.2)')
+
+
+def summarize_runs(seconds: list) -> dict:
+    """
+    Returns times of all runs of the scenario with their min and median.
+    """
+    return {
+        'runs_seconds': seconds,
+        'min_seconds': min(seconds),
+        'median_seconds': statistics.median(seconds)
+    }
+
+
+def write_results(output_file: str, parameters: dict, results: list, environment: dict = None) -> None:
+    """
+    Writes the benchmark results with the environment and parameters of the run to the JSON file.
+    """
+    with open(output_file, 'w', encoding='utf-8') as file:
+        json.dump({
+            'version': RESULTS_FORMAT_VERSION,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                **(environment or {})
+            },
+            'parameters': parameters,
+            'results': results
+        }, file, indent=2)
+    print(f'Results written to "{output_file}"...', file=sys.stderr)
+
+
+def compare_results(results: list, baseline_file: str, threshold: float) -> list:
+    """
+    Compares median times with the baseline results. Returns ids of scenarios slower by more than threshold.
+    """
+    with open(baseline_file, encoding='utf-8') as file:
+        baseline = {result['id']: result for result in json.load(file)['results']}
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get(result['id'])
+        if baseline_result is None:
+            continue
+        change = result['median_seconds'] / baseline_result['median_seconds'] - 1
+        print(f'{result["id"]}: {baseline_result["median_seconds"]:.3f}s -> {result["median_seconds"]:.3f}s '
+              f'({change:+.1%})', file=sys.stderr)
+        if change > threshold:
+            regressions.append(result['id'])
+    return regressions
+
+
+def exit_on_regressions(results: list, baseline_file: str, threshold: float) -> None:
+    """
+    Exits with status 1 if any scenario is slower than in the baseline by more than threshold.
+    """
+    regressions = compare_results(results=results, baseline_file=baseline_file, threshold=threshold)
+    if regressions:
+        print(f'Regressions: {", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,242 @@
+"""
+Benchmarks of the script's main func against a local moto server seeded with synthetic fleets of EC2 instances.
+
+Every scenario (fleet size, tag cardinality, action, selector and execution mode) is timed and AWS API calls
+are counted with the script's statistics. Results are written to a JSON file, which can be compared with
+the results of a previous run (--baseline) to catch performance regressions.
+Requires moto server dependencies: pip install "moto[server]"
+"""
+import sys
+import os
+import io
+import time
+import socket
+import logging
+import argparse
+import urllib.request
+from contextlib import redirect_stdout, redirect_stderr
+
+from bench_common import add_common_arguments, summarize_runs, write_results, exit_on_regressions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# AWS API requests must never leave the local moto server
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'eu-west-1'
+})
+
+import boto3  # noqa: E402
+import botocore  # noqa: E402
+
+import ec2_tags  # noqa: E402
+from ec2_tags import main, run_async_engine, CompiledTagExpression, RunStats, set_stats  # noqa: E402
+
+AWS_REGION = 'eu-west-1'
+FLEET_SIZES_DEFAULT = [1000, 10000, 50000]
+TAG_CARDINALITIES_DEFAULT = [10]
+ACTIONS_DEFAULT = ['list', 'stop', 'terminate']
+# Number of instances launched with the same tags in a single RunInstances request
+SEED_GROUP_SIZE = 100
+# Selectors of the script's main func
+SELECTORS = {
+    'no_tags': lambda: {'ec2_no_tags': True},
+    'no_name': lambda: {'ec2_no_name_tag': True},
+    'tag': lambda: {'ec2_tag': {'tag_key': 'Env', 'tag_value': 'env-0'}},
+    'expression': lambda: {'ec2_tag_expression': CompiledTagExpression('Env=env-1 AND NOT Owner=*')}
+}
+# Execution modes of the script's main func
+MODES = {
+    'batch': {},
+    'per_instance': {'per_instance': True},
+    'asyncio': {'engine': 'asyncio'}
+}
+
+
+class LineCounter(io.TextIOBase):
+    """
+    Text stream counting written lines instead of storing them.
+    """
+    def __init__(self):
+        self.lines = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.lines += text.count('\n')
+        return len(text)
+
+
+def get_free_port() -> int:
+    """
+    Returns free local TCP port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def start_moto_server():
+    """
+    Starts moto server on a free local port and points AWS API clients to it.
+    Returns the server and its endpoint URL.
+    """
+    from moto.server import ThreadedMotoServer
+
+    # Request log of the server would flood the benchmark output
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = get_free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    endpoint_url = f'http://127.0.0.1:{port}'
+    # Endpoint of all AWS API clients (supported by boto3 1.28+)
+    os.environ['AWS_ENDPOINT_URL'] = endpoint_url
+    return server, endpoint_url
+
+
+def reset_moto_server(endpoint_url: str) -> None:
+    """
+    Removes all resources from moto server.
+    """
+    urllib.request.urlopen(urllib.request.Request(f'{endpoint_url}/moto-api/reset', method='POST')).close()
+
+
+def seed_fleet(ec2_client, fleet_size: int, tag_cardinality: int, stopped_ratio: float = 0.25) -> None:
+    """
+    Launches fleet of instances in groups with the same tags: every 5th group without tags, every 5th group
+    with Env tag only (no Name tag) and the rest with Name, Env and Owner tags.
+    Env tag has tag_cardinality distinct values, each shared by the tagged groups of 5 consecutive groups (so every
+    value, e.g. env-0 of the tag selector, is assigned to some tagged groups). Given ratio of the groups is stopped.
+    """
+    image_id = ec2_client.describe_images()['Images'][0]['ImageId']
+    stopped_groups_every = round(1 / stopped_ratio) if stopped_ratio else 0
+    for group, launched in enumerate(range(0, fleet_size, SEED_GROUP_SIZE)):
+        group_size = min(SEED_GROUP_SIZE, fleet_size - launched)
+        env_tag = {'Key': 'Env', 'Value': f'env-{group // 5 % tag_cardinality}'}
+        if group % 5 == 0:
+            tags = []
+        elif group % 5 == 1:
+            tags = [env_tag]
+        else:
+            tags = [{'Key': 'Name', 'Value': f'instance-{group}'}, env_tag, {'Key': 'Owner', 'Value': 'bench'}]
+        run_args = {'TagSpecifications': [{'ResourceType': 'instance', 'Tags': tags}]} if tags else {}
+        response = ec2_client.run_instances(ImageId=image_id, MinCount=group_size, MaxCount=group_size, **run_args)
+        if stopped_groups_every and group % stopped_groups_every == stopped_groups_every - 1:
+            ec2_client.stop_instances(InstanceIds=[instance['InstanceId'] for instance in response['Instances']])
+
+
+def run_scenario(action: str, selector: str, mode: str, action_rate: float) -> dict:
+    """
+    Runs the script's main func once. Returns wall time, number of output lines and collected statistics.
+    """
+    stats = RunStats()
+    set_stats(stats)
+    output = LineCounter()
+    selector_attrs = SELECTORS[selector]()
+    started_at = time.perf_counter()
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            if MODES[mode].get('engine') == 'asyncio':
+                run_async_engine(aws_regions=[AWS_REGION], ec2_action=action, action_rate=action_rate,
+                                 **selector_attrs)
+            else:
+                main(aws_region=AWS_REGION, ec2_action=action, action_rate=action_rate, **MODES[mode],
+                     **selector_attrs)
+    finally:
+        set_stats(None)
+    return {
+        'seconds': time.perf_counter() - started_at,
+        'output_lines': output.lines,
+        'api_calls': {operation: api_call_stats.calls for operation, api_call_stats in stats.api_calls.items()},
+        'phases': {phase: seconds for phase, (count, seconds) in stats.phases.items()}
+    }
+
+
+def run_benchmarks(args, endpoint_url: str) -> list:
+    """
+    Runs all scenarios given by the args. Fleet is seeded again before every run of mutating action.
+    """
+    results = []
+    for fleet_size in args.fleet_sizes:
+        for tag_cardinality in args.tag_cardinalities:
+            fleet_seeded = False
+            for action in args.actions:
+                for selector in args.selectors:
+                    for mode in args.modes:
+                        if mode == 'per_instance' and (action == 'list' or fleet_size > args.per_instance_max_fleet):
+                            continue
+                        runs = []
+                        for _ in range(args.repeat):
+                            if action != 'list' or not fleet_seeded:
+                                reset_moto_server(endpoint_url)
+                                ec2_tags.configure_client_factory()
+                                seed_fleet(ec2_client=boto3.client('ec2', region_name=AWS_REGION),
+                                           fleet_size=fleet_size,
+                                           tag_cardinality=tag_cardinality)
+                                # Mutating action changes the fleet, so it is seeded again for the next run
+                                fleet_seeded = action == 'list'
+                            runs.append(run_scenario(action=action, selector=selector, mode=mode,
+                                                     action_rate=args.action_rate))
+                        seconds = [run['seconds'] for run in runs]
+                        result = {
+                            'id': f'fleet={fleet_size}/cardinality={tag_cardinality}/action={action}/'
+                                  f'selector={selector}/mode={mode}',
+                            'fleet_size': fleet_size,
+                            'tag_cardinality': tag_cardinality,
+                            'action': action,
+                            'selector': selector,
+                            'mode': mode,
+                            **summarize_runs(seconds),
+                            'output_lines': runs[-1]['output_lines'],
+                            'api_calls': runs[-1]['api_calls'],
+                            'phases': runs[-1]['phases']
+                        }
+                        results.append(result)
+                        print(f'{result["id"]}: median {result["median_seconds"]:.3f}s, '
+                              f'API calls {sum(result["api_calls"].values())}', file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the EC2 tags actions script against moto server')
+    parser.add_argument('--fleet-sizes', nargs='+', type=int, default=FLEET_SIZES_DEFAULT,
+                        help=f'numbers of instances in the fleet (default: {FLEET_SIZES_DEFAULT})')
+    parser.add_argument('--tag-cardinalities', nargs='+', type=int, default=TAG_CARDINALITIES_DEFAULT,
+                        help=f'numbers of distinct Env tag values (default: {TAG_CARDINALITIES_DEFAULT})')
+    parser.add_argument('--actions', nargs='+', choices=ACTIONS_DEFAULT, default=ACTIONS_DEFAULT,
+                        help='benchmarked actions (default: all)')
+    parser.add_argument('--selectors', nargs='+', choices=list(SELECTORS), default=list(SELECTORS),
+                        help='benchmarked selectors (default: all)')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=['batch', 'per_instance'],
+                        help='execution modes, asyncio requires aiobotocore (default: batch per_instance)')
+    parser.add_argument('--per-instance-max-fleet', type=int, default=10000,
+                        help='max fleet size benchmarked in per_instance mode (default: 10000)')
+    parser.add_argument('--action-rate', type=float, default=1000.0,
+                        help='initial rate of action API requests per second (default: 1000)')
+    add_common_arguments(parser, output_default='bench_results.json')
+    args = parser.parse_args()
+    if args.repeat < 1 or any(size < 1 for size in args.fleet_sizes) or \
+            any(cardinality < 1 for cardinality in args.tag_cardinalities):
+        parser.error('--repeat, --fleet-sizes and --tag-cardinalities must be positive numbers')
+    if 'asyncio' in args.modes:
+        try:
+            import aiobotocore  # noqa: F401
+        except ImportError:
+            parser.error('aiobotocore package is required for asyncio mode')
+
+    moto_server, moto_endpoint_url = start_moto_server()
+    try:
+        bench_results = run_benchmarks(args=args, endpoint_url=moto_endpoint_url)
+    finally:
+        moto_server.stop()
+    import moto
+
+    write_results(output_file=args.output,
+                  parameters=vars(args),
+                  results=bench_results,
+                  environment={'boto3': boto3.__version__, 'botocore': botocore.__version__, 'moto': moto.__version__})
+    if args.baseline:
+        exit_on_regressions(results=bench_results, baseline_file=args.baseline, threshold=args.threshold)
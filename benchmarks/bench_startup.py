@@ -0,0 +1,76 @@
+"""
+Benchmarks of the script's startup - import of the script, help and rejection of invalid arguments.
+
+Every scenario runs the script in a new Python process, so the measured time includes the interpreter startup
+and all imports. Modules of the AWS SDK loaded by the import of the script are reported too.
+Results are written to a JSON file, which can be compared with the results of a previous run (--baseline).
+"""
+import sys
+import os
+import time
+import argparse
+import subprocess
+
+from bench_common import add_common_arguments, summarize_runs, write_results, exit_on_regressions
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'ec2_tags.py')
+# Arguments of the Python interpreter for every scenario
+SCENARIOS = {
+    'import': ['-c', 'import ec2_tags'],
+    'help': [SCRIPT_PATH, '--help'],
+    'invalid_args': [SCRIPT_PATH, '--no-name', '--expression', 'Env=prod', 'list'],
+    'invalid_region': [SCRIPT_PATH, '--region', 'not-a-region', '--no-name', 'list']
+}
+# Modules whose import is deferred until the script talks to AWS
+SDK_MODULES = ['boto3', 'botocore.session', 'botocore.config', 'jmespath', 'asyncio', 'sqlite3']
+
+
+def run_scenario(scenario: str) -> float:
+    """
+    Runs the scenario in a new Python process. Returns its wall time.
+    """
+    started_at = time.perf_counter()
+    subprocess.run([sys.executable, *SCENARIOS[scenario]], cwd=SCRIPT_DIR, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - started_at
+
+
+def get_imported_sdk_modules() -> list:
+    """
+    Returns modules of the AWS SDK loaded by the import of the script.
+    """
+    code = f'import sys, ec2_tags; print(*[module for module in {SDK_MODULES!r} if module in sys.modules])'
+    output = subprocess.run([sys.executable, '-c', code], cwd=SCRIPT_DIR, capture_output=True, text=True,
+                            check=True).stdout
+    return output.split()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the EC2 tags actions script startup')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='benchmarked scenarios (default: all)')
+    add_common_arguments(parser, output_default='bench_startup_results.json', repeat_default=10)
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be a positive number')
+
+    imported_sdk_modules = get_imported_sdk_modules()
+    print(f'AWS SDK modules loaded by import: {", ".join(imported_sdk_modules) or "none"}', file=sys.stderr)
+    bench_results = []
+    for bench_scenario in args.scenarios:
+        seconds = [run_scenario(bench_scenario) for _ in range(args.repeat)]
+        result = {
+            'id': f'startup={bench_scenario}',
+            'scenario': bench_scenario,
+            **summarize_runs(seconds)
+        }
+        bench_results.append(result)
+        print(f'{result["id"]}: median {result["median_seconds"]:.3f}s, min {result["min_seconds"]:.3f}s',
+              file=sys.stderr)
+    write_results(output_file=args.output,
+                  parameters=vars(args),
+                  results=bench_results,
+                  environment={'imported_sdk_modules': imported_sdk_modules})
+    if args.baseline:
+        exit_on_regressions(results=bench_results, baseline_file=args.baseline, threshold=args.threshold)
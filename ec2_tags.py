@@ -1,134 +1,3196 @@
 import sys
-from typing import TypeVar
+import os
+import re
+import json
+import csv
+import io
+import time
+from typing import TypeVar, Optional, Mapping, Iterator, Iterable, TYPE_CHECKING
+from types import MappingProxyType
 import argparse
+import threading
+import queue
+import socket
+import signal
+from contextvars import ContextVar, copy_context
+from contextlib import contextmanager
+import gzip
+from datetime import datetime, timezone
+import bisect
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial, lru_cache
 
-import boto3
-from botocore.exceptions import ClientError
+# Only lightweight botocore exceptions are imported at startup (they are needed by except clauses).
+# boto3, the rest of botocore, jmespath, asyncio and sqlite3 are imported on first use, so --help and argument
+# validation do not pay for them.
+from botocore.exceptions import ClientError, BotoCoreError
+
+if TYPE_CHECKING:
+    import asyncio
+    import boto3
+    import botocore
 
 
 # Declare type variable for boto3.resources.factory.ec2.Instance
 Ec2Instance = TypeVar('Ec2Instance', bound='boto3.resources.factory.ec2.Instance')
+# Declare type variable for botocore.client.EC2
+Ec2Client = TypeVar('Ec2Client', bound='botocore.client.EC2')
+
+# Max number of instance ids sent in a single StopInstances/TerminateInstances/CreateTags/DeleteTags request
+EC2_ACTION_BATCH_SIZE = 1000
+# EC2 instance states in which the given action can be performed
+EC2_ACTION_INSTANCE_STATES = {
+    'terminate': ['pending', 'running', 'stopping', 'stopped'],
+    'stop': ['pending', 'running'],
+    'tag': ['pending', 'running', 'stopping', 'stopped'],
+    'untag': ['pending', 'running', 'stopping', 'stopped'],
+    'mark': ['pending', 'running', 'stopping', 'stopped']
+}
+# Actions changing tags of instances (the same tags are sent for all instances of a batch)
+EC2_TAG_ACTIONS = ['tag', 'untag', 'mark']
+# Max number of tags assigned to a single EC2 resource
+EC2_TAGS_PER_RESOURCE_MAX = 50
+# Key of the tag with the time (ISO 8601 UTC timestamp) after which the instance is due for the action
+EXPIRY_TAG_KEY_DEFAULT = 'cleanup-after'
+# Time (in seconds) between marking instances with the expiry tag and their expiry
+EXPIRY_GRACE_PERIOD_DEFAULT = 7 * 24 * 60 * 60
+# Max number of AWS regions processed concurrently
+REGION_WORKERS_DEFAULT = 4
+# Target instance state of actions, awaited with --wait
+EC2_ACTION_TARGET_STATES = {
+    'terminate': 'terminated',
+    'stop': 'stopped'
+}
+# Max time (seconds) of waiting for instances to reach the target state
+WAIT_TIMEOUT_DEFAULT = 600.0
+# Initial and max interval (seconds) between polls of instance states (exponential backoff)
+WAIT_POLL_INTERVAL_MIN = 2.0
+WAIT_POLL_INTERVAL_MAX = 30.0
+# Max number of instances returned in a single DescribeInstances page
+EC2_DESCRIBE_PAGE_SIZE = 1000
+# JMESPath projection of DescribeInstances response pages
+EC2_INSTANCE_RECORD_EXPRESSION = \
+    'Reservations[].Instances[].{InstanceId: InstanceId, State: State.Name, Tags: Tags, LaunchTime: LaunchTime}'
+# Pattern of AWS region names, names not matching it are rejected without calling AWS
+AWS_REGION_NAME_PATTERN = re.compile(r'[a-z]{2}(-[a-z]+)+-\d')
+# Pattern of IAM role ARNs assumed in accounts mode (the account id is captured)
+ROLE_ARN_PATTERN = re.compile(r'arn:aws[a-z-]*:iam::(\d{12}):role/[\w+=,.@/-]+')
+# Session name of the assumed IAM roles
+ROLE_SESSION_NAME = 'ec2-tags'
+# Lifetime (in seconds) of the assumed role credentials
+ROLE_SESSION_DURATION = 60 * 60
+# Assumed role credentials expiring within given number of seconds are fetched again
+ROLE_CREDENTIALS_REFRESH_MARGIN = 15 * 60
+# Order of outcomes in the per-account summary
+OUTPUT_OUTCOMES = ['succeeded', 'failed', 'listed', 'dry_run', 'reached', 'timed_out']
+# Time (in seconds) between starts of sweeps in serve mode
+SERVE_INTERVAL_DEFAULT = 300.0
+# Address of HTTP server with health and metrics endpoints in serve mode
+SERVE_ADDRESS_DEFAULT = '127.0.0.1:8000'
+# Serve mode is reported unhealthy if no sweep succeeded within given number of intervals
+SERVE_HEALTHY_INTERVALS = 3
+# Max number of values of a single EC2 API filter
+EC2_FILTER_VALUES_MAX = 200
+# Time (in seconds) for which instances from events are collected into a micro-batch in event-driven mode
+EVENT_BATCH_WINDOW_DEFAULT = 2.0
+# Max number of instances in a micro-batch of events (described with a single request)
+EVENT_BATCH_SIZE_MAX = EC2_FILTER_VALUES_MAX
+# Long polling time (in seconds) of SQS ReceiveMessage requests (max allowed by SQS)
+SQS_WAIT_TIME = 20
+# Max number of messages in SQS ReceiveMessage and DeleteMessageBatch requests
+SQS_BATCH_SIZE = 10
+# Max number of selected instances waiting in the pipeline queue for dispatching
+PIPELINE_QUEUE_SIZE = 2 * EC2_ACTION_BATCH_SIZE
+# Time (in seconds) after which the collected instances are dispatched while waiting for the next page
+PIPELINE_IDLE_TIMEOUT = 0.5
+# Max number of per-instance actions performed concurrently
+ACTION_WORKERS_DEFAULT = 8
+# Max number of in-flight AWS API requests in the asyncio engine
+ASYNC_CONCURRENCY_DEFAULT = 100
+# Initial and max rate (requests per second) of per-instance action API calls
+ACTION_RATE_DEFAULT = 5.0
+ACTION_RATE_MAX = 50.0
+# Max number of retries of the API call throttled by AWS
+THROTTLING_RETRIES_MAX = 8
+# Error codes returned by AWS API when the request rate limit is exceeded
+THROTTLING_ERROR_CODES = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException']
+# Error codes (and prefixes of error codes) of batched action requests caused by a single instance, other errors
+# (e.g. UnauthorizedOperation) apply to the whole request
+EC2_INSTANCE_ERROR_CODES = ['IncorrectInstanceState', 'OperationNotPermitted', 'UnsupportedOperation', 'InvalidID',
+                            'InvalidInstanceID.']
+# Time (in seconds) after which the cached AWS region names expire
+REGION_CACHE_TTL = 7 * 24 * 60 * 60
+# AWS region names used to validate region when they cannot be fetched from AWS (e.g. offline)
+AWS_REGION_NAMES_KNOWN = [
+    'af-south-1', 'ap-east-1', 'ap-east-2', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3', 'ap-south-1',
+    'ap-south-2', 'ap-southeast-1', 'ap-southeast-2', 'ap-southeast-3', 'ap-southeast-4', 'ap-southeast-5',
+    'ap-southeast-7', 'ca-central-1', 'ca-west-1', 'eu-central-1', 'eu-central-2', 'eu-north-1', 'eu-south-1',
+    'eu-south-2', 'eu-west-1', 'eu-west-2', 'eu-west-3', 'il-central-1', 'me-central-1', 'me-south-1',
+    'mx-central-1', 'sa-east-1', 'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2'
+]
+# Actions in order of precedence, used when an instance matches policies with different actions
+EC2_ACTIONS_PRECEDENCE = ['terminate', 'stop', 'mark', 'tag', 'untag', 'list']
+# Time (in seconds) after which the local inventory snapshot is fully re-synced instead of incremental refresh
+SNAPSHOT_FULL_SYNC_INTERVAL = 24 * 60 * 60
+# Version of the exported inventory file format
+EXPORT_FORMAT_VERSION = 1
+# Version of the action plan file format
+PLAN_FORMAT_VERSION = 1
+# Fields of instance result records in structured output (--output json, ndjson or csv)
+OUTPUT_FIELDS = ['instance_id', 'region', 'action', 'state_before', 'state_after', 'outcome', 'latency_ms', 'error',
+                 'account']
+# Number of result records buffered before they are written to the output stream
+OUTPUT_BUFFER_RECORDS = 500
+# Upper bounds (seconds) of AWS API call latency histogram buckets
+STATS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Prefix of exported metric names
+STATS_METRIC_PREFIX = 'ec2_tags'
+# Max size (bytes) of a single StatsD UDP packet
+STATSD_PACKET_SIZE_MAX = 1432
+# Default settings of AWS API clients
+CLIENT_SETTINGS_DEFAULT = {
+    'max_pool_connections': 50,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'retry_mode': 'standard',
+    'max_attempts': 5
+}
+# Past tense of actions used in script's output
+EC2_ACTIONS_PAST_TENSE = {
+    'stop': 'stopped',
+    'terminate': 'terminated',
+    'tag': 'tagged',
+    'untag': 'untagged',
+    'mark': 'marked'
+}
+
+# Buffer of script's output per AWS region (context variable is isolated per thread and per asyncio task)
+_output_buffer: ContextVar[Optional[list]] = ContextVar('output_buffer', default=None)
+
+
+# AWS region processed by the current thread or task
+_current_region: ContextVar[Optional[str]] = ContextVar('current_region', default=None)
+
+# AWS account processed by the current thread in accounts mode
+_current_account: ContextVar[Optional[str]] = ContextVar('current_account', default=None)
+
+# Counts of results reported by the current thread in accounts mode
+_result_counts: ContextVar[Optional['ResultCounts']] = ContextVar('result_counts', default=None)
+
+
+def echo(message: str) -> None:
+    """
+    Prints given message or appends it to the output buffer of the current thread or task (if any).
+    With structured output, messages are printed to stderr, so stdout contains only result records.
+    """
+    output_buffer = _output_buffer.get()
+    if output_buffer is None:
+        print(message, file=sys.stdout if _result_writer is None else sys.stderr)
+    else:
+        output_buffer.append(message)
+
+
+class ResultWriter:
+    """
+    Streams instance result records in JSON (array), NDJSON or CSV format.
+    Records are formatted into a buffer which is written to the stream every buffer_size records, so large runs
+    can be consumed incrementally without holding all results in memory. Records can be written from many threads.
+    """
+    FORMATS = ('json', 'ndjson', 'csv')
+
+    def __init__(self, output_format: str, stream=None, buffer_size: int = OUTPUT_BUFFER_RECORDS):
+        if output_format not in self.FORMATS:
+            raise ValueError(f'Not supported output format: {output_format}')
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.buffer_size = buffer_size
+        self.records_count = 0
+        self._buffer = io.StringIO()
+        self._buffered_count = 0
+        self._lock = threading.Lock()
+        self._csv_writer = None
+        if output_format == 'csv':
+            self._csv_writer = csv.DictWriter(self._buffer, fieldnames=OUTPUT_FIELDS, lineterminator='\n')
+            self._csv_writer.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, record: Mapping) -> None:
+        """
+        Adds the record to the buffer and writes the buffer to the stream if it is full.
+        """
+        with self._lock:
+            if self._csv_writer is not None:
+                self._csv_writer.writerow({field: record.get(field) for field in OUTPUT_FIELDS})
+            else:
+                if self.output_format == 'json':
+                    self._buffer.write('[\n' if not self.records_count else ',\n')
+                json.dump({field: record.get(field) for field in OUTPUT_FIELDS}, self._buffer, separators=(',', ':'))
+                if self.output_format == 'ndjson':
+                    self._buffer.write('\n')
+            self.records_count += 1
+            self._buffered_count += 1
+            if self._buffered_count >= self.buffer_size:
+                self._flush_buffer()
+
+    def flush(self) -> None:
+        """
+        Writes buffered records to the stream.
+        """
+        with self._lock:
+            self._flush_buffer()
+
+    def close(self) -> None:
+        """
+        Writes remaining records (and closing bracket of JSON array) to the stream.
+        """
+        with self._lock:
+            if self.output_format == 'json':
+                self._buffer.write('[]\n' if not self.records_count else '\n]\n')
+            self._flush_buffer()
+
+    def _flush_buffer(self) -> None:
+        self.stream.write(self._buffer.getvalue())
+        self.stream.flush()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffered_count = 0
+
+
+_result_writer: Optional[ResultWriter] = None
+
+
+def set_result_writer(result_writer: Optional[ResultWriter]) -> None:
+    """
+    Sets the writer of structured output (None restores text output).
+    """
+    global _result_writer
+    _result_writer = result_writer
+
+
+def report_result(message: Optional[str], instance_ids: Iterable, **fields) -> None:
+    """
+    Reports the result of the action on given instances - writes a record per instance with structured output,
+    otherwise echoes the message (if any). In accounts mode, the results are also counted per outcome.
+    """
+    result_counts = _result_counts.get()
+    if result_counts is not None:
+        instance_ids = list(instance_ids)
+        result_counts.add(outcome=fields.get('outcome'), count=len(instance_ids))
+    if _result_writer is None:
+        if message:
+            echo(message)
+        return
+    region = _current_region.get()
+    account = _current_account.get()
+    for instance_id in instance_ids:
+        _result_writer.write({'instance_id': instance_id, 'region': region, 'account': account, **fields})
+
+
+class ResultCounts:
+    """
+    Counts of reported instance results per outcome. Results can be counted from many threads.
+    """
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, outcome: str, count: int = 1) -> None:
+        """
+        Adds count of results with given outcome.
+        """
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + count
+
+    def update(self, other: 'ResultCounts') -> None:
+        """
+        Adds counts of other results.
+        """
+        for outcome, count in other.counts.items():
+            self.add(outcome=outcome, count=count)
+
+    def summary(self) -> str:
+        """
+        Returns counts as text, e.g. "3 succeeded, 1 failed".
+        """
+        outcomes = sorted(self.counts, key=lambda outcome: OUTPUT_OUTCOMES.index(outcome)
+                          if outcome in OUTPUT_OUTCOMES else len(OUTPUT_OUTCOMES))
+        return ', '.join(f'{self.counts[outcome]} {outcome}' for outcome in outcomes) or 'nothing to do'
+
+
+def get_latency_ms(started_at: float) -> float:
+    """
+    Returns milliseconds elapsed since given time.monotonic() value.
+    """
+    return round((time.monotonic() - started_at) * 1000, 1)
+
+
+def parse_state_changes(response: dict) -> dict:
+    """
+    Returns dict with the instance id as key and tuple of the previous and current state as value
+    from StopInstances or TerminateInstances response.
+    """
+    state_changes = response.get('StoppingInstances') or response.get('TerminatingInstances') or []
+    return {
+        state_change['InstanceId']: (state_change['PreviousState']['Name'], state_change['CurrentState']['Name'])
+        for state_change in state_changes
+    }
+
+
+class ApiCallStats:
+    """
+    Statistics of AWS API calls of a single operation.
+    """
+    __slots__ = ('calls', 'errors', 'retries', 'throttles', 'bytes_received', 'latency_sum', 'latency_max',
+                 'latency_buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # Number of calls per latency bucket, the last bucket is +Inf
+        self.latency_buckets = [0] * (len(STATS_LATENCY_BUCKETS) + 1)
+
+
+class RunStats:
+    """
+    Performance statistics of the run - time spent in the phases and AWS API calls per operation
+    (counts, errors, retries, throttles, bytes received and latency histogram).
+    Time of phases performed concurrently (e.g. actions on a worker pool) is summed over threads.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.api_calls = {}
+        self._lock = threading.Lock()
+
+    def add_phase_time(self, phase: str, seconds: float) -> None:
+        """
+        Adds the time spent in the phase.
+        """
+        with self._lock:
+            count, total_seconds = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (count + 1, total_seconds + seconds)
+
+    def record_api_call(self, operation: str, latency: float, error: bool = False, retries: int = 0) -> None:
+        """
+        Records completed AWS API call (including its retries).
+        """
+        bucket = next((i for i, bound in enumerate(STATS_LATENCY_BUCKETS) if latency <= bound),
+                      len(STATS_LATENCY_BUCKETS))
+        with self._lock:
+            api_call_stats = self.api_calls.setdefault(operation, ApiCallStats())
+            api_call_stats.calls += 1
+            api_call_stats.errors += error
+            api_call_stats.retries += retries
+            api_call_stats.latency_sum += latency
+            api_call_stats.latency_max = max(api_call_stats.latency_max, latency)
+            api_call_stats.latency_buckets[bucket] += 1
+
+    def record_api_attempt(self, operation: str, bytes_received: int = 0, throttled: bool = False) -> None:
+        """
+        Records single HTTP attempt of AWS API call.
+        """
+        with self._lock:
+            api_call_stats = self.api_calls.setdefault(operation, ApiCallStats())
+            api_call_stats.bytes_received += bytes_received
+            api_call_stats.throttles += throttled
+
+    def summary_lines(self) -> list:
+        """
+        Returns human-readable summary of the statistics.
+        """
+        lines = ['Stats:', '  Phases:']
+        for phase, (count, seconds) in self.phases.items():
+            lines.append(f'    {phase}: {seconds:.3f}s ({count}x)')
+        lines.append('  AWS API calls:')
+        for operation, api_call_stats in sorted(self.api_calls.items()):
+            latency_avg = api_call_stats.latency_sum / api_call_stats.calls if api_call_stats.calls else 0.0
+            lines.append(f'    {operation}: {api_call_stats.calls} calls, {api_call_stats.errors} errors, '
+                         f'{api_call_stats.retries} retries, {api_call_stats.throttles} throttles, '
+                         f'{api_call_stats.bytes_received} bytes received, latency avg {latency_avg * 1000:.1f}ms, '
+                         f'max {api_call_stats.latency_max * 1000:.1f}ms')
+        return lines
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the statistics in Prometheus text exposition format.
+        """
+        prefix = STATS_METRIC_PREFIX
+        lines = [f'# HELP {prefix}_phase_seconds Time spent in the phase of the last run.',
+                 f'# TYPE {prefix}_phase_seconds gauge']
+        lines.extend(f'{prefix}_phase_seconds{{phase="{phase}"}} {seconds}'
+                     for phase, (count, seconds) in self.phases.items())
+        counters = {
+            'api_calls_total': ('AWS API calls.', 'calls'),
+            'api_errors_total': ('AWS API calls which failed.', 'errors'),
+            'api_retries_total': ('Retries of AWS API calls.', 'retries'),
+            'api_throttles_total': ('AWS API attempts throttled by AWS.', 'throttles'),
+            'api_received_bytes_total': ('Bytes received in AWS API responses.', 'bytes_received')
+        }
+        api_calls = sorted(self.api_calls.items())
+        for metric, (description, attr) in counters.items():
+            lines.extend([f'# HELP {prefix}_{metric} {description}', f'# TYPE {prefix}_{metric} counter'])
+            lines.extend(f'{prefix}_{metric}{{operation="{operation}"}} {getattr(api_call_stats, attr)}'
+                         for operation, api_call_stats in api_calls)
+        metric = f'{prefix}_api_call_duration_seconds'
+        lines.extend([f'# HELP {metric} Latency of AWS API calls.', f'# TYPE {metric} histogram'])
+        for operation, api_call_stats in api_calls:
+            cumulative_count = 0
+            for bound, bucket_count in zip((*STATS_LATENCY_BUCKETS, '+Inf'), api_call_stats.latency_buckets):
+                cumulative_count += bucket_count
+                lines.append(f'{metric}_bucket{{operation="{operation}",le="{bound}"}} {cumulative_count}')
+            lines.append(f'{metric}_sum{{operation="{operation}"}} {api_call_stats.latency_sum}')
+            lines.append(f'{metric}_count{{operation="{operation}"}} {api_call_stats.calls}')
+        lines.extend([f'# HELP {prefix}_last_run_timestamp_seconds Time of the last run.',
+                      f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                      f'{prefix}_last_run_timestamp_seconds {time.time()}'])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_textfile(self, path: str) -> None:
+        """
+        Writes the statistics to the file read by Prometheus node exporter textfile collector.
+        The file is replaced atomically, so the collector never reads partially written file.
+        """
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def to_statsd(self) -> list:
+        """
+        Returns the statistics as StatsD metric lines (phase durations and average latencies as timers).
+        """
+        prefix = STATS_METRIC_PREFIX
+        lines = [f'{prefix}.phase.{phase}:{seconds * 1000:.3f}|ms' for phase, (count, seconds) in self.phases.items()]
+        for operation, api_call_stats in sorted(self.api_calls.items()):
+            for attr in ('calls', 'errors', 'retries', 'throttles', 'bytes_received'):
+                lines.append(f'{prefix}.api.{operation}.{attr}:{getattr(api_call_stats, attr)}|c')
+            if api_call_stats.calls:
+                latency_avg = api_call_stats.latency_sum / api_call_stats.calls
+                lines.append(f'{prefix}.api.{operation}.latency:{latency_avg * 1000:.3f}|ms')
+        return lines
+
+    def send_statsd(self, address: str) -> None:
+        """
+        Sends the statistics to StatsD server at given "host:port" address over UDP.
+        """
+        host, _, port = address.rpartition(':')
+        packets = ['']
+        for line in self.to_statsd():
+            if packets[-1] and len(packets[-1]) + len(line) + 1 > STATSD_PACKET_SIZE_MAX:
+                packets.append('')
+            packets[-1] = f'{packets[-1]}\n{line}' if packets[-1] else line
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+            for packet in packets:
+                if packet:
+                    statsd_socket.sendto(packet.encode('utf-8'), (host, int(port)))
+
+
+_stats: Optional[RunStats] = None
+
+
+def set_stats(stats: Optional[RunStats]) -> None:
+    """
+    Sets the statistics collected by the script (None disables collecting).
+    """
+    global _stats
+    _stats = stats
+
+
+@contextmanager
+def phase_timer(phase: str):
+    """
+    Measures time spent in the block as the phase of the run (if statistics are collected).
+    """
+    if _stats is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stats.add_phase_time(phase, time.perf_counter() - started_at)
+
+
+def _on_before_api_call(context: dict, **kwargs) -> None:
+    context['stats_started_at'] = time.perf_counter()
+
+
+def _on_after_api_call(http_response, parsed: dict, model, context: dict, **kwargs) -> None:
+    started_at = context.get('stats_started_at')
+    if _stats is None or started_at is None:
+        return
+    _stats.record_api_call(operation=model.name,
+                           latency=time.perf_counter() - started_at,
+                           error=http_response.status_code >= 300,
+                           retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+
+def _on_after_api_call_error(event_name: str, context: dict, **kwargs) -> None:
+    started_at = context.get('stats_started_at')
+    if _stats is None or started_at is None:
+        return
+    _stats.record_api_call(operation=event_name.rsplit('.', 1)[-1],
+                           latency=time.perf_counter() - started_at,
+                           error=True)
+
+
+def _on_api_attempt(response, operation, **kwargs) -> None:
+    # Called after every HTTP attempt, response is None if the attempt failed with exception
+    if _stats is None or response is None:
+        return
+    http_response, parsed = response
+    content_length = http_response.headers.get('content-length')
+    if content_length is not None:
+        bytes_received = int(content_length)
+    else:
+        # Body has been already read by the parser, aiobotocore returns coroutine which is not used here
+        content = http_response.content
+        if not isinstance(content, bytes) and hasattr(content, 'close'):
+            content.close()
+        bytes_received = len(content) if isinstance(content, bytes) else 0
+    _stats.record_api_attempt(operation=operation.name,
+                              bytes_received=bytes_received,
+                              throttled=parsed.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES)
+
+
+def instrument_client(client):
+    """
+    Registers handlers of AWS API client events collecting statistics of the calls (if statistics are collected).
+    """
+    client.meta.events.register('before-call', _on_before_api_call, unique_id='ec2-tags-stats-before-call')
+    client.meta.events.register('after-call', _on_after_api_call, unique_id='ec2-tags-stats-after-call')
+    client.meta.events.register('after-call-error', _on_after_api_call_error,
+                                unique_id='ec2-tags-stats-after-call-error')
+    client.meta.events.register('needs-retry', _on_api_attempt, unique_id='ec2-tags-stats-needs-retry')
+    return client
+
+
+def is_throttling_error(err: ClientError) -> bool:
+    """
+    Checks whether given AWS API error was caused by exceeding the request rate limit.
+    """
+    return err.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_instance_error(err: ClientError) -> bool:
+    """
+    Checks whether given AWS API error of batched action request was caused by an instance in the batch
+    (e.g. instance in 'pending' state), so the failing instance can be isolated by splitting the batch.
+    """
+    error_code = err.response.get('Error', {}).get('Code', '')
+    return any(error_code == instance_error_code or
+               (instance_error_code.endswith('.') and error_code.startswith(instance_error_code))
+               for instance_error_code in EC2_INSTANCE_ERROR_CODES)
+
+
+class TokenBucketRateLimiter:
+    """
+    Thread-safe token bucket rate limiter which adapts its rate to AWS API throttling.
+    The rate is halved on every throttled request and increased additively after successful requests.
+    """
+    def __init__(self, rate: float = ACTION_RATE_DEFAULT, max_rate: float = ACTION_RATE_MAX, min_rate: float = 0.5):
+        self.rate = rate
+        self.max_rate = max(rate, max_rate)
+        self.min_rate = min(rate, min_rate)
+        self._tokens = 1.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token if available. Returns 0 or the time (in seconds) to wait before the next try.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # Bucket capacity is equal to one second of requests, but at least one request (rate can be below 1)
+            self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available.
+        """
+        while True:
+            wait_time = self.reserve()
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self) -> None:
+        """
+        Waits (without blocking the event loop) until a token is available.
+        """
+        import asyncio
+
+        while True:
+            wait_time = self.reserve()
+            if not wait_time:
+                return
+            await asyncio.sleep(wait_time)
+
+    def on_success(self) -> None:
+        """
+        Ramps the rate up after successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def on_throttle(self) -> None:
+        """
+        Backs the rate off after throttled request.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+
+def call_with_rate_limit(rate_limiter: TokenBucketRateLimiter, func, *args, **kwargs):
+    """
+    Calls given func once a token is acquired from the rate limiter.
+    The call throttled by AWS is retried with exponential backoff.
+    """
+    for retry in range(THROTTLING_RETRIES_MAX + 1):
+        rate_limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except ClientError as err:
+            if not is_throttling_error(err) or retry == THROTTLING_RETRIES_MAX:
+                raise
+            rate_limiter.on_throttle()
+            time.sleep(min(2 ** retry * 0.1, 10))
+            continue
+        rate_limiter.on_success()
+        return result
+
+
+class ActionDispatcher:
+    """
+    Runs instance actions on a worker pool with API calls limited by the rate limiter.
+    Throttled actions are retried with exponential backoff. Failed actions are reported.
+    Submitting blocks when too many actions are pending, so memory usage stays bounded.
+    """
+    def __init__(self, max_workers: int = ACTION_WORKERS_DEFAULT, rate_limiter: TokenBucketRateLimiter = None):
+        self.rate_limiter = rate_limiter or TokenBucketRateLimiter()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending_slots = threading.BoundedSemaphore(4 * max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """
+        Schedules given action to be executed on the worker pool.
+        """
+        return self._submit(True, func, *args, **kwargs)
+
+    def submit_self_limited(self, func, *args, **kwargs) -> Future:
+        """
+        Schedules given action which limits the rate of its API calls itself (e.g. batched action).
+        """
+        return self._submit(False, func, *args, **kwargs)
+
+    def shutdown(self) -> None:
+        """
+        Waits for all scheduled actions and releases the worker pool.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, rate_limited: bool, func, *args, **kwargs) -> Future:
+        self._pending_slots.acquire()
+        # Action runs in the context of the submitting thread, e.g. its output is added to the same output buffer
+        context = copy_context()
+        try:
+            future = self._executor.submit(context.run, self._run, rate_limited, func, *args, **kwargs)
+        except Exception:
+            self._pending_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._pending_slots.release())
+        return future
+
+    def _run(self, rate_limited: bool, func, *args, **kwargs):
+        try:
+            with phase_timer('action'):
+                if rate_limited:
+                    return call_with_rate_limit(self.rate_limiter, func, *args, **kwargs)
+                return func(*args, **kwargs)
+        except ClientError as err:
+            error_msg = err.response['Error']['Message']
+            echo(f'Error: {error_msg}. Try later...')
+
+
+class _ProducerError:
+    """
+    Wrapper of the exception raised in the background producer thread.
+    """
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def iterate_in_background(items: Iterable,
+                          max_size: int = PIPELINE_QUEUE_SIZE,
+                          idle_timeout: float = PIPELINE_IDLE_TIMEOUT) -> Iterator:
+    """
+    Iterates given items in a background thread (producer) and yields them through a bounded queue.
+    None is yielded every time no item arrives within idle_timeout seconds, e.g. while next page is fetched.
+    """
+    items_queue = queue.Queue(maxsize=max_size)
+    items_end = object()
+
+    def produce() -> None:
+        try:
+            for item in items:
+                items_queue.put(item)
+        except Exception as err:
+            items_queue.put(_ProducerError(err))
+        finally:
+            items_queue.put(items_end)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    while True:
+        try:
+            item = items_queue.get(timeout=idle_timeout)
+        except queue.Empty:
+            yield None
+            continue
+        if item is items_end:
+            break
+        if isinstance(item, _ProducerError):
+            raise item.error
+        yield item
+
+
+class InstanceRecord:
+    """
+    Compact record of the EC2 instance with tags indexed by tag key.
+    """
+    __slots__ = ('id', 'state', 'tags', 'launch_time')
+
+    # Shared read-only tags of instances without assigned tags
+    NO_TAGS: Mapping = MappingProxyType({})
+
+    def __init__(self, instance_id: str, state: str, tags: Mapping = NO_TAGS, launch_time: datetime = None):
+        self.id = instance_id
+        self.state = state
+        self.tags = tags
+        self.launch_time = launch_time
+
+    def __repr__(self):
+        return f'InstanceRecord(id={self.id!r}, state={self.state!r}, tags={dict(self.tags)!r}, ' \
+               f'launch_time={self.launch_time!r})'
+
+    def __eq__(self, other):
+        if not isinstance(other, InstanceRecord):
+            return NotImplemented
+        return (self.id, self.state, self.tags, self.launch_time) == \
+            (other.id, other.state, other.tags, other.launch_time)
+
+    @classmethod
+    def from_tags_list(cls,
+                       instance_id: str,
+                       state: str,
+                       tags: Optional[list],
+                       launch_time: datetime = None) -> 'InstanceRecord':
+        """
+        Creates instance record from the list of tags returned by EC2 API.
+        """
+        if not tags:
+            return cls(instance_id, state, launch_time=launch_time)
+        return cls(instance_id, state, MappingProxyType({tag['Key']: tag['Value'] for tag in tags}), launch_time)
+
+    def has_tag(self, tag_key: str, tag_value: str = '') -> bool:
+        """
+        Checks whether a specified tag is assigned to the instance.
+        """
+        if tag_value:
+            return self.tags.get(tag_key) == tag_value
+        return tag_key in self.tags
+
+
+def check_tag_exist(tags: list, tag_key: str, tag_value: str = '') -> bool:
+    """
+    Checks whether a specified tag is in the list of given tags.
+    """
+    for tag in tags:
+        if tag_value:
+            if tag.get('Key') == tag_key and tag.get('Value') == tag_value:
+                return True
+        else:
+            if tag.get('Key') == tag_key:
+                return True
+    return False
+
+
+class TagExpressionError(ValueError):
+    """
+    Raised when the tag expression cannot be parsed.
+    """
+
+
+class CompiledTagExpression:
+    """
+    Tag expression (e.g. 'Env=Test AND NOT Owner=* AND Project~^tmp-') compiled into a predicate tree.
+    Sub-expressions supported by EC2 API are pushed down into filters, so instances listed with the filters
+    are checked only with the local remainder of the expression, while other instances are checked with
+    the whole expression.
+    Supported terms:
+      - KEY=VALUE - tag with given key and value assigned, VALUE may contain "*" and "?" wildcards;
+      - KEY=* - tag with given key assigned;
+      - KEY~REGEX - tag with given key and value matching the regular expression assigned.
+    """
+    def __init__(self, expression: str):
+        self.expression = expression
+        tree = TagExpressionParser(expression).parse()
+        self.filters, local_tree = self._push_down(tree)
+        # None if all sub-expressions are evaluated by EC2 API
+        self.predicate = self._compile(local_tree) if local_tree else None
+        # Whole expression, used when the filters were not applied by EC2 API
+        self.full_predicate = self._compile(tree)
+
+    def __repr__(self):
+        return f'CompiledTagExpression({self.expression!r})'
+
+    def matches(self, instance: InstanceRecord, filters_applied: bool = False) -> bool:
+        """
+        Checks whether the EC2 instance matches the expression. If filters_applied is True (the instance was listed
+        with the filters), only sub-expressions which are not evaluated by EC2 API are checked.
+        """
+        if filters_applied:
+            return self.predicate is None or self.predicate(instance)
+        return self.full_predicate(instance)
+
+    @classmethod
+    def _push_down(cls, tree: tuple) -> tuple:
+        """
+        Splits top-level conjunction into EC2 API filters and the tree evaluated locally.
+        """
+        conjuncts = tree[1] if tree[0] == 'and' else [tree]
+        filters = []
+        local_conjuncts = []
+        for conjunct in conjuncts:
+            ec2_filter = cls._to_filter(conjunct)
+            # EC2 API combines values of a single filter with OR, so each filter name can be used only once
+            if ec2_filter and ec2_filter['Name'] not in [used_filter['Name'] for used_filter in filters]:
+                filters.append(ec2_filter)
+            else:
+                local_conjuncts.append(conjunct)
+        if not local_conjuncts:
+            return filters, None
+        if len(local_conjuncts) == 1:
+            return filters, local_conjuncts[0]
+        return filters, ('and', local_conjuncts)
+
+    @staticmethod
+    def _to_filter(node: tuple) -> Optional[dict]:
+        """
+        Returns EC2 API filter equivalent to given node or None if there is no such filter.
+        """
+        terms = node[1] if node[0] == 'or' else [node]
+        if not all(term[0] == 'term' and term[2] == '=' for term in terms):
+            return None
+        tag_keys = {term[1] for term in terms}
+        tag_values = [term[3] for term in terms]
+        # EC2 API "?" wildcard matches also zero characters
+        if len(tag_keys) != 1 or any('?' in tag_value for tag_value in tag_values):
+            return None
+        tag_key = tag_keys.pop()
+        if tag_values == ['*']:
+            return {'Name': 'tag-key', 'Values': [tag_key]}
+        if '*' in tag_values:
+            return None
+        return {'Name': f'tag:{tag_key}', 'Values': tag_values}
+
+    @classmethod
+    def _compile(cls, node: tuple):
+        """
+        Compiles given node into predicate called with the instance record.
+        """
+        node_type = node[0]
+        if node_type == 'not':
+            operand = cls._compile(node[1])
+            return lambda instance: not operand(instance)
+        if node_type in ('and', 'or'):
+            operands = tuple(cls._compile(child) for child in node[1])
+            if node_type == 'and':
+                return lambda instance: all(operand(instance) for operand in operands)
+            return lambda instance: any(operand(instance) for operand in operands)
+        _, tag_key, operator, tag_value = node
+        if operator == '~':
+            if tag_value in ('', '.*'):
+                return lambda instance: tag_key in instance.tags
+            tag_value_regex = re.compile(tag_value)
+        elif tag_value == '*':
+            return lambda instance: tag_key in instance.tags
+        elif '*' not in tag_value and '?' not in tag_value:
+            return lambda instance: instance.tags.get(tag_key) == tag_value
+        else:
+            wildcard_pattern = re.escape(tag_value).replace(r'\*', '.*').replace(r'\?', '.')
+            tag_value_regex = re.compile(f'{wildcard_pattern}\\Z', re.DOTALL)
+            # Wildcards match the whole tag value
+            match_value = tag_value_regex.match
+
+            def matches_wildcard(instance: InstanceRecord) -> bool:
+                instance_tag_value = instance.tags.get(tag_key)
+                return instance_tag_value is not None and match_value(instance_tag_value) is not None
+            return matches_wildcard
+        search_value = tag_value_regex.search
+
+        def matches_regex(instance: InstanceRecord) -> bool:
+            instance_tag_value = instance.tags.get(tag_key)
+            return instance_tag_value is not None and search_value(instance_tag_value) is not None
+        return matches_regex
+
+
+class TagExpressionParser:
+    """
+    Recursive descent parser of the tag expression. Operators precedence: NOT, AND, OR.
+    The parse tree consists of tuples: ('or', [nodes]), ('and', [nodes]), ('not', node),
+    ('term', tag_key, operator, tag_value).
+    """
+    TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|((?:[^\s()"]|"[^"]*")+))')
+    TERM_PATTERN = re.compile(r'(?P<key>(?:[^=~"]|"[^"]*")+)(?P<operator>[=~])(?P<value>.*)', re.DOTALL)
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = self._tokenize(expression)
+        self.position = 0
+
+    def parse(self) -> tuple:
+        """
+        Returns the parse tree of the expression.
+        """
+        if not self.tokens:
+            raise TagExpressionError('tag expression is empty')
+        tree = self._parse_or()
+        if self.position < len(self.tokens):
+            raise TagExpressionError(f'unexpected "{self.tokens[self.position]}" in tag expression')
+        return tree
+
+    def _tokenize(self, expression: str) -> list:
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = self.TOKEN_PATTERN.match(expression, position)
+            if not match or match.end() == position:
+                raise TagExpressionError(f'unterminated quote in tag expression: {expression[position:].strip()}')
+            tokens.append(match.group(match.lastindex))
+            position = match.end()
+        return tokens
+
+    def _peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self) -> str:
+        token = self._peek()
+        if token is None:
+            raise TagExpressionError('unexpected end of tag expression')
+        self.position += 1
+        return token
+
+    def _parse_binary(self, operator: str, parse_operand) -> tuple:
+        operands = [parse_operand()]
+        while self._peek() == operator:
+            self._next()
+            operands.append(parse_operand())
+        if len(operands) == 1:
+            return operands[0]
+        # Flatten nested operations of the same type
+        flattened = []
+        for operand in operands:
+            flattened.extend(operand[1] if operand[0] == operator.lower() else [operand])
+        return operator.lower(), flattened
+
+    def _parse_or(self) -> tuple:
+        return self._parse_binary('OR', self._parse_and)
+
+    def _parse_and(self) -> tuple:
+        return self._parse_binary('AND', self._parse_not)
+
+    def _parse_not(self) -> tuple:
+        if self._peek() == 'NOT':
+            self._next()
+            operand = self._parse_not()
+            # Double negation is removed
+            if operand[0] == 'not':
+                return operand[1]
+            return 'not', operand
+        return self._parse_atom()
+
+    def _parse_atom(self) -> tuple:
+        token = self._next()
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                raise TagExpressionError('missing ")" in tag expression')
+            return node
+        if token in ('AND', 'OR', ')'):
+            raise TagExpressionError(f'unexpected "{token}" in tag expression')
+        match = self.TERM_PATTERN.fullmatch(token)
+        if not match:
+            raise TagExpressionError(f'invalid term "{token}" in tag expression, expected KEY=VALUE or KEY~REGEX')
+        tag_key = match.group('key').replace('"', '')
+        tag_value = match.group('value').replace('"', '')
+        if match.group('operator') == '~':
+            try:
+                re.compile(tag_value)
+            except re.error as err:
+                raise TagExpressionError(f'invalid regular expression "{tag_value}" in tag expression: {err}')
+        return 'term', tag_key, match.group('operator'), tag_value
+
+
+def check_proper_instance_state(action: str, ec2_current_state: str) -> bool:
+    """
+    Checks whether the EC2 instance is in desired state.
+    """
+    if action in EC2_ACTION_INSTANCE_STATES:
+        return ec2_current_state in EC2_ACTION_INSTANCE_STATES[action]
+    elif action == 'list':
+        return True
+    return False
+
+
+def build_instance_filters(action: str, **kwargs) -> list:
+    """
+    Builds EC2 API filters for the predicates which can be evaluated on the server side.
+    Predicates such as "no tags" or "no Name tag" cannot be expressed with filters.
+    """
+    filters = []
+    specified_tag: dict = kwargs.get('ec2_tag', {})
+    tag_expression: Optional[CompiledTagExpression] = kwargs.get('ec2_tag_expression')
+    expired_tag: Optional[str] = kwargs.get('ec2_expired_tag')
+    if tag_expression:
+        filters.extend(tag_expression.filters)
+    if expired_tag:
+        # Only marked instances are listed, whether they are due is checked locally
+        filters.append({
+            'Name': 'tag-key',
+            'Values': [expired_tag]
+        })
+    if specified_tag:
+        filters.append({
+            'Name': f'tag:{specified_tag["tag_key"]}',
+            'Values': [specified_tag['tag_value']]
+        })
+    if action in EC2_ACTION_INSTANCE_STATES:
+        filters.append({
+            'Name': 'instance-state-name',
+            'Values': EC2_ACTION_INSTANCE_STATES[action]
+        })
+    return filters
+
+
+class ClientFactory:
+    """
+    Creates AWS API clients from a single boto3 session and caches them per service and region.
+    Clients are thread-safe, so the cached clients (and their connection pools) are shared by all workers.
+    """
+    def __init__(self, session=None, **settings):
+        # Session (and boto3) is created on first client request
+        self._session = session
+        self.settings = {**CLIENT_SETTINGS_DEFAULT, **settings}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        Returns boto3 session of the factory.
+        """
+        if self._session is None:
+            import boto3
+
+            self._session = boto3.session.Session()
+        return self._session
+
+    def build_config(self, config_class=None):
+        """
+        Returns botocore config (or config of given compatible class, e.g. aiobotocore AioConfig) with client settings.
+        """
+        if config_class is None:
+            from botocore.config import Config as config_class
+        return config_class(max_pool_connections=self.settings['max_pool_connections'],
+                            connect_timeout=self.settings['connect_timeout'],
+                            read_timeout=self.settings['read_timeout'],
+                            retries={
+                                'mode': self.settings['retry_mode'],
+                                'total_max_attempts': self.settings['max_attempts']
+                            })
+
+    def client(self, service_name: str = 'ec2', region_name: str = None):
+        """
+        Returns cached client of the service in the region (default region of the session if not given).
+        """
+        client_key = (service_name, region_name)
+        # Creating clients from the same session is not thread-safe
+        with self._lock:
+            if client_key not in self._clients:
+                self._clients[client_key] = instrument_client(self.session.client(service_name,
+                                                                                  region_name=region_name,
+                                                                                  config=self.build_config()))
+            return self._clients[client_key]
+
+
+_client_factory: Optional[ClientFactory] = None
+_client_factory_lock = threading.Lock()
+
+
+def get_client_factory() -> ClientFactory:
+    """
+    Returns the script's shared client factory (created with default settings on first use).
+    """
+    global _client_factory
+    with _client_factory_lock:
+        if _client_factory is None:
+            _client_factory = ClientFactory()
+        return _client_factory
+
+
+def configure_client_factory(session=None, **settings) -> ClientFactory:
+    """
+    Replaces the script's shared client factory with a new one using given session and client settings.
+    """
+    global _client_factory
+    with _client_factory_lock:
+        _client_factory = ClientFactory(session=session, **settings)
+        return _client_factory
+
+
+def get_ec2_client(aws_region: str, session=None) -> Ec2Client:
+    """
+    Returns EC2 client for the region - created from given session (with settings of the client factory) or
+    the shared one from the client factory.
+    """
+    if session is not None:
+        return instrument_client(session.client('ec2', region_name=aws_region,
+                                                config=get_client_factory().build_config()))
+    return get_client_factory().client('ec2', region_name=aws_region)
+
+
+def get_aws_region_names(all_regions: bool = True, session=None) -> list:
+    """
+    Returns AWS region names. If all_regions is False, only regions enabled for the account are returned.
+    If session is given, the regions of its account are returned.
+    """
+    ec2_client = get_ec2_client(aws_region=None, session=session)
+    aws_regions: list = ec2_client.describe_regions(AllRegions=all_regions)['Regions']
+    return [region['RegionName'] for region in aws_regions]
+
+
+def get_role_account_id(role_arn: str) -> str:
+    """
+    Returns AWS account id of the IAM role ARN.
+    """
+    role_arn_match = ROLE_ARN_PATTERN.fullmatch(role_arn)
+    if not role_arn_match:
+        raise ValueError(f'Not valid IAM role ARN: {role_arn}')
+    return role_arn_match.group(1)
+
+
+class AssumedRoleSessions:
+    """
+    Creates boto3 sessions with credentials of assumed IAM roles (one session per role).
+    Temporary credentials are cached per role and fetched again from STS only once they expire within
+    refresh_margin seconds, so the sessions (and their clients) can be used for runs longer than the credentials
+    lifetime. Roles are assumed on first use of their session, so many roles can be assumed concurrently.
+    """
+    def __init__(self,
+                 session_name: str = ROLE_SESSION_NAME,
+                 duration: int = ROLE_SESSION_DURATION,
+                 refresh_margin: float = ROLE_CREDENTIALS_REFRESH_MARGIN):
+        self.session_name = session_name
+        self.duration = duration
+        self.refresh_margin = refresh_margin
+        self._credentials = {}
+        self._sessions = {}
+        self._role_locks = {}
+        self._lock = threading.Lock()
+
+    def credentials(self, role_arn: str) -> dict:
+        """
+        Returns cached credentials of the role (in botocore credentials metadata format).
+        Credentials are fetched from STS if they are not cached yet or are about to expire.
+        """
+        with self._lock:
+            role_lock = self._role_locks.setdefault(role_arn, threading.Lock())
+        # Only one AssumeRole request per role is in flight, other roles are assumed concurrently
+        with role_lock:
+            credentials = self._credentials.get(role_arn)
+            if credentials is None or credentials['Expiration'].timestamp() - time.time() <= self.refresh_margin:
+                sts_client = get_client_factory().client('sts')
+                credentials = sts_client.assume_role(RoleArn=role_arn,
+                                                     RoleSessionName=self.session_name,
+                                                     DurationSeconds=self.duration)['Credentials']
+                self._credentials[role_arn] = credentials
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+    def session(self, role_arn: str):
+        """
+        Returns cached boto3 session of the role. Its credentials are refreshed from the cache before expiry.
+        """
+        with self._lock:
+            if role_arn not in self._sessions:
+                import boto3
+                import botocore.session
+                from botocore.credentials import DeferredRefreshableCredentials
+
+                botocore_session = botocore.session.get_session()
+                # Credentials are fetched on the first AWS API call of the session
+                botocore_session._credentials = DeferredRefreshableCredentials(
+                    refresh_using=partial(self.credentials, role_arn),
+                    method='assume-role')
+                self._sessions[role_arn] = boto3.session.Session(
+                    botocore_session=botocore_session,
+                    region_name=get_client_factory().session.region_name)
+            return self._sessions[role_arn]
+
+
+def get_cache_dir() -> str:
+    """
+    Returns path to the script's cache directory.
+    """
+    cache_dir = os.environ.get('EC2_TAGS_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    user_cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(user_cache_dir, 'ec2-tags')
+
+
+def load_cached_region_names() -> Optional[list]:
+    """
+    Returns AWS region names from the on-disk cache or None if the cache is missing or expired.
+    """
+    cache_file = os.path.join(get_cache_dir(), 'regions.json')
+    try:
+        with open(cache_file) as file:
+            cache = json.load(file)
+        if time.time() - cache['fetched_at'] > REGION_CACHE_TTL:
+            return None
+        return cache['regions']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cached_region_names(region_names: list) -> None:
+    """
+    Saves AWS region names in the on-disk cache. Failure to write the cache is not an error.
+    """
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'regions.json'), 'w') as file:
+            json.dump({'fetched_at': time.time(), 'regions': region_names}, file)
+    except OSError:
+        pass
+
+
+def check_aws_region(region_specified: str) -> bool:
+    """
+    Checks whether given text value is a valid AWS region name.
+    AWS region names are fetched from AWS only if the cache is expired or the region is not cached.
+    Values which are not formatted as region names are rejected without calling AWS.
+    """
+    if not AWS_REGION_NAME_PATTERN.fullmatch(region_specified):
+        return False
+    cached_region_names = load_cached_region_names()
+    if cached_region_names and region_specified in cached_region_names:
+        return True
+    # Get AWS region names
+    try:
+        aws_region_names = get_aws_region_names()
+    except (BotoCoreError, ClientError):
+        # Validate region offline
+        return region_specified in AWS_REGION_NAMES_KNOWN
+    save_cached_region_names(region_names=aws_region_names)
+    return region_specified in aws_region_names
+
+
+def is_action_allowed(action: str) -> None:
+    """
+    Checks whether given EC2 action is allowed.
+    """
+    allowed_ec2_actions = ['stop', 'terminate', 'tag', 'untag', 'mark', 'list', 'export']
+    if action not in allowed_ec2_actions:
+        print('Not allowed "ec2_action" value!')
+        sys.exit(1)
+
+
+@lru_cache(maxsize=4096)
+def parse_expiry_timestamp(tag_value: str) -> Optional[float]:
+    """
+    Parses the value of the expiry tag (ISO 8601 date or time, UTC if the time zone is not given) into POSIX
+    timestamp. Returns None if the value is not valid. Instances marked in the same run share the value,
+    so each distinct value is parsed only once.
+    """
+    try:
+        expires_at = datetime.fromisoformat(tag_value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at.timestamp()
+
+
+def format_expiry_timestamp(timestamp: float) -> str:
+    """
+    Formats POSIX timestamp as the value of the expiry tag (ISO 8601 UTC time, sortable as a string).
+    """
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def build_expiry_tags(expiry_tag: str = EXPIRY_TAG_KEY_DEFAULT,
+                      grace_period: float = EXPIRY_GRACE_PERIOD_DEFAULT) -> dict:
+    """
+    Builds tags of mark action - the expiry tag with the time grace_period seconds from now.
+    """
+    return {expiry_tag: format_expiry_timestamp(time.time() + grace_period)}
+
+
+def is_instance_expired(instance: InstanceRecord, expiry_tag: str, now: float = None) -> bool:
+    """
+    Checks whether the EC2 instance is marked with the expiry tag and its expiry time has passed.
+    """
+    tag_value = instance.tags.get(expiry_tag)
+    if tag_value is None:
+        return False
+    expires_at = parse_expiry_timestamp(tag_value)
+    return expires_at is not None and expires_at <= (time.time() if now is None else now)
+
+
+def is_selector_checked_locally(**kwargs) -> bool:
+    """
+    Checks whether the specified selector has to be checked locally, i.e. it is not fully expressed with EC2 filters.
+    """
+    tag_expression: Optional[CompiledTagExpression] = kwargs.get('ec2_tag_expression')
+    if tag_expression:
+        return tag_expression.predicate is not None
+    return 'ec2_tag' not in kwargs
+
+
+def is_instance_selected(instance: InstanceRecord, filters_applied: bool = False, **kwargs) -> bool:
+    """
+    Checks whether the EC2 instance matches the specified selector.
+    If filters_applied is True, the instance was listed with the selector's EC2 API filters (see
+    build_instance_filters()), so the predicates evaluated by EC2 API are not checked again.
+    """
+    # Get additional attrs
+    no_tags: bool = kwargs.get('ec2_no_tags', False)
+    no_name_tag: bool = kwargs.get('ec2_no_name_tag', False)
+    specified_tag: dict = kwargs.get('ec2_tag', {})
+    tag_expression: Optional[CompiledTagExpression] = kwargs.get('ec2_tag_expression')
+    expired_tag: Optional[str] = kwargs.get('ec2_expired_tag')
+    if no_tags and not instance.tags:
+        # Select EC2 instance if it has NO tag assigned
+        return True
+    elif no_name_tag:
+        # Select EC2 instance ONLY if tag "Name" IS NOT assigned to it
+        return not instance.has_tag(tag_key='Name')
+    elif specified_tag:
+        # Select EC2 instance ONLY if specified tag IS assigned to it
+        return instance.has_tag(**specified_tag)
+    elif tag_expression:
+        # Select EC2 instance ONLY if it matches the tag expression
+        return tag_expression.matches(instance, filters_applied=filters_applied)
+    elif expired_tag:
+        # Select EC2 instance ONLY if its expiry time has passed
+        return is_instance_expired(instance=instance, expiry_tag=expired_tag)
+    return False
+
+
+class TagsError(ValueError):
+    """
+    Raised when the tags of tag or untag action are not valid.
+    """
+
+
+def parse_tags(tag_args: list, action: str) -> dict:
+    """
+    Parses comma-separated tags of tag or untag action given as KEY=VALUE (or only KEY with untag action, which
+    removes the tag with any value). Returns dict with the tag key as key and the tag value (None - any value)
+    as value.
+    """
+    tags = {}
+    for tag_arg in (tag_arg for tags_arg in tag_args for tag_arg in tags_arg.split(',')):
+        tag_key, separator, tag_value = tag_arg.partition('=')
+        if not tag_key:
+            raise TagsError(f'tag "{tag_arg}" must have a key')
+        if not separator and action == 'tag':
+            raise TagsError(f'tag "{tag_arg}" must be given as KEY=VALUE with tag action')
+        if tag_key.lower().startswith('aws:'):
+            raise TagsError(f'tag key "{tag_key}" with reserved aws: prefix cannot be changed')
+        tags[tag_key] = tag_value if separator else None
+    if not tags:
+        raise TagsError(f'tags must be given with {action} action')
+    if len(tags) > EC2_TAGS_PER_RESOURCE_MAX:
+        raise TagsError(f'at most {EC2_TAGS_PER_RESOURCE_MAX} tags can be given')
+    return tags
+
+
+def build_api_tags(tags: Mapping) -> list:
+    """
+    Builds the list of tags for CreateTags/DeleteTags request (the value is omitted if any value is removed).
+    """
+    return [{'Key': tag_key} if tag_value is None else {'Key': tag_key, 'Value': tag_value}
+            for tag_key, tag_value in tags.items()]
+
+
+def is_tags_change_needed(instance: InstanceRecord, action: str, tags: Mapping) -> bool:
+    """
+    Checks whether the tag, untag or mark action would change tags of the EC2 instance, so instances which already
+    have (or do not have) the tags are not sent to EC2 API again. Mark action never changes the expiry time
+    of already marked instances.
+    """
+    if action == 'mark':
+        return not any(tag_key in instance.tags for tag_key in tags)
+    if action == 'tag':
+        return any(instance.tags.get(tag_key) != tag_value for tag_key, tag_value in tags.items())
+    return any(tag_key in instance.tags and (tag_value is None or instance.tags[tag_key] == tag_value)
+               for tag_key, tag_value in tags.items())
+
+
+def perform_action_on_instance(action: str, instance: Ec2Instance, tags: Mapping = None, **kwargs) -> bool:
+    """
+    Performs the specified action (stop, terminate, tag, untag or mark with given tags) on the EC2 instance
+    if necessary. Returns True if the action was performed on the EC2 instance.
+    """
+    instance_record = InstanceRecord.from_tags_list(instance_id=instance.id,
+                                                    state=instance.state['Name'],
+                                                    tags=instance.tags)
+    take_action = is_instance_selected(instance=instance_record, **kwargs)
+    if take_action and action in EC2_TAG_ACTIONS:
+        take_action = is_tags_change_needed(instance=instance_record, action=action, tags=tags)
+    if not take_action:
+        return take_action
+    # Take action on EC2 instance if necessary
+    if action in EC2_TAG_ACTIONS:
+        if action in ('tag', 'mark'):
+            instance.create_tags(Tags=build_api_tags(tags))
+        else:
+            instance.delete_tags(Tags=build_api_tags(tags))
+        echo(f'Instance with id "{instance.id}" {EC2_ACTIONS_PAST_TENSE[action]}...')
+    elif action == 'terminate':
+        instance.terminate()
+        echo(f'Instance with id "{instance.id}" terminated...')
+    elif action == 'stop':
+        try:
+            instance.stop()
+            echo(f'Instance with id "{instance.id}" stopped...')
+        except ClientError as err:
+            if is_throttling_error(err):
+                raise
+            # Handle exception when instance in 'pending' state
+            error_msg = err.response['Error']['Message']
+            echo(f'Error: {error_msg}. Try later...')
+    else:
+        # Only list effected instances
+        instance_current_state = instance.state['Name']
+        echo(f'Instance id: "{instance.id}", current state: "{instance_current_state}"')
+    return take_action
+
+
+def get_action_api_call(ec2_client: Ec2Client, action: str, tags: Mapping = None):
+    """
+    Returns EC2 API call performing the specified action on instances with ids given as InstanceIds arg.
+    Tag, untag and mark actions send the same tags for all instances in a single CreateTags/DeleteTags request.
+    Works with both botocore and aiobotocore clients.
+    """
+    if action not in EC2_TAG_ACTIONS:
+        # StopInstances or TerminateInstances
+        return getattr(ec2_client, f'{action}_instances')
+    tags_api_call = ec2_client.delete_tags if action == 'untag' else ec2_client.create_tags
+    api_tags = build_api_tags(tags)
+
+    def call_tags_api(**kwargs):
+        return tags_api_call(Resources=kwargs.pop('InstanceIds'), Tags=api_tags, **kwargs)
+
+    return call_tags_api
+
+
+def perform_instance_action(ec2_client: Ec2Client, action: str, instance_id: str, tags: Mapping = None) -> bool:
+    """
+    Performs the specified action (stop, terminate, tag or untag with given tags) on the EC2 instance with given id.
+    Returns True if the action was performed.
+    """
+    ec2_api_call = get_action_api_call(ec2_client=ec2_client, action=action, tags=tags)
+    started_at = time.monotonic()
+    try:
+        response = ec2_api_call(InstanceIds=[instance_id])
+    except ClientError as err:
+        if is_throttling_error(err):
+            raise
+        # Handle exception when e.g. instance in 'pending' state
+        error_msg = err.response['Error']['Message']
+        report_result(f'Error: {error_msg}. Try later...', [instance_id],
+                      action=action, outcome='failed', latency_ms=get_latency_ms(started_at), error=error_msg)
+        return False
+    state_before, state_after = parse_state_changes(response).get(instance_id, (None, None))
+    report_result(f'Instance with id "{instance_id}" {EC2_ACTIONS_PAST_TENSE[action]}...', [instance_id],
+                  action=action, state_before=state_before, state_after=state_after, outcome='succeeded',
+                  latency_ms=get_latency_ms(started_at))
+    return True
+
+
+def split_into_chunks(items: list, chunk_size: int) -> list:
+    """
+    Splits given list into chunks with at most chunk_size elements.
+    """
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def is_dry_run_succeeded(err: ClientError) -> bool:
+    """
+    Checks whether the error is EC2 response to DryRun request which would have succeeded.
+    """
+    return err.response.get('Error', {}).get('Code') == 'DryRunOperation'
+
+
+def perform_batch_action(ec2_client: Ec2Client,
+                         action: str,
+                         instance_ids: list,
+                         rate_limiter: TokenBucketRateLimiter = None,
+                         dry_run: bool = False,
+                         tags: Mapping = None) -> dict:
+    """
+    Performs the specified action (stop, terminate, tag or untag with given tags) on EC2 instances with batched
+    API calls. A chunk rejected by EC2 because of an instance is split in half and retried until the failing
+    instance is isolated, other errors (e.g. missing permission) fail the whole chunk.
+    If dry_run is True, the action is only checked (including IAM permissions) with DryRun requests.
+    Returns dict with the instance id as key and the action result (True if succeeded) as value.
+    """
+    rate_limiter = rate_limiter or TokenBucketRateLimiter()
+    ec2_api_call = get_action_api_call(ec2_client=ec2_client, action=action, tags=tags)
+    dry_run_args = {'DryRun': True} if dry_run else {}
+    results = {}
+    chunks = split_into_chunks(items=instance_ids, chunk_size=EC2_ACTION_BATCH_SIZE)
+    while chunks:
+        chunk = chunks.pop(0)
+        started_at = time.monotonic()
+        try:
+            response = call_with_rate_limit(rate_limiter, ec2_api_call, InstanceIds=chunk, **dry_run_args)
+        except ClientError as err:
+            if dry_run and is_dry_run_succeeded(err):
+                latency_ms = get_latency_ms(started_at)
+                for instance_id in chunk:
+                    report_result(f'Instance with id "{instance_id}" would be {EC2_ACTIONS_PAST_TENSE[action]}...',
+                                  [instance_id], action=action, outcome='dry_run', latency_ms=latency_ms)
+                    results[instance_id] = True
+                continue
+            if len(chunk) > 1 and is_instance_error(err):
+                # Isolate instance(s) responsible for the failure
+                middle = len(chunk) // 2
+                chunks[:0] = [chunk[:middle], chunk[middle:]]
+                continue
+            # Handle exception when e.g. instance in 'pending' state
+            error_msg = err.response['Error']['Message']
+            report_result(f'Error: {error_msg}. Try later...', chunk,
+                          action=action, outcome='failed', latency_ms=get_latency_ms(started_at), error=error_msg)
+            results.update({instance_id: False for instance_id in chunk})
+            continue
+        latency_ms = get_latency_ms(started_at)
+        state_changes = parse_state_changes(response)
+        for instance_id in chunk:
+            state_before, state_after = state_changes.get(instance_id, (None, None))
+            report_result(f'Instance with id "{instance_id}" {EC2_ACTIONS_PAST_TENSE[action]}...', [instance_id],
+                          action=action, state_before=state_before, state_after=state_after, outcome='succeeded',
+                          latency_ms=latency_ms)
+            results[instance_id] = True
+    return results
+
+
+def scan_instances(ec2_client: Ec2Client, ec2_filters: list) -> Iterator[InstanceRecord]:
+    """
+    Yields EC2 instances matching given filters (page by page) as compact records.
+    """
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=ec2_filters, PaginationConfig={'PageSize': EC2_DESCRIBE_PAGE_SIZE})
+    for page in pages:
+        yield from parse_instance_records(page=page)
+
+
+@lru_cache(maxsize=None)
+def compile_jmespath(expression: str):
+    """
+    Returns compiled JMESPath expression (jmespath is imported on first use).
+    """
+    import jmespath
+
+    return jmespath.compile(expression)
+
+
+def parse_instance_records(page: dict) -> Iterator[InstanceRecord]:
+    """
+    Yields compact records of EC2 instances from DescribeInstances response page.
+    """
+    for instance in compile_jmespath(EC2_INSTANCE_RECORD_EXPRESSION).search(page):
+        yield InstanceRecord.from_tags_list(instance_id=instance['InstanceId'],
+                                            state=instance['State'],
+                                            tags=instance['Tags'],
+                                            launch_time=instance['LaunchTime'])
+
+
+def scan_instance_states(ec2_client: Ec2Client) -> Iterator[tuple]:
+    """
+    Yields ids and states of all EC2 instances. DescribeInstanceStatus response is much smaller than DescribeInstances.
+    """
+    paginator = ec2_client.get_paginator('describe_instance_status')
+    pages = paginator.paginate(IncludeAllInstances=True, PaginationConfig={'PageSize': EC2_DESCRIBE_PAGE_SIZE})
+    for instance_id, instance_state in pages.search('InstanceStatuses[].[InstanceId, InstanceState.Name]'):
+        yield instance_id, instance_state
+
+
+def scan_instance_states_by_ids(ec2_client: Ec2Client, instance_ids: list) -> dict:
+    """
+    Returns current states of EC2 instances with given ids, fetched with batched DescribeInstances requests.
+    Instances no longer known to EC2 are omitted.
+    """
+    instance_states = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for chunk in split_into_chunks(items=instance_ids, chunk_size=EC2_FILTER_VALUES_MAX):
+        # Unknown instance id fails the whole request with InstanceIds, so instance-id filter is used instead
+        pages = paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}])
+        for instance_id, instance_state in pages.search('Reservations[].Instances[].[InstanceId, State.Name]'):
+            instance_states[instance_id] = instance_state
+    return instance_states
+
+
+def wait_for_instance_states(ec2_client: Ec2Client,
+                             instance_target_states: Mapping[str, str],
+                             timeout: float = WAIT_TIMEOUT_DEFAULT) -> dict:
+    """
+    Waits until EC2 instances reach their target states (instance id as key and the target state as value).
+    States of all pending instances are polled together with batched requests, the interval between polls grows
+    exponentially. Instances no longer known to EC2 are considered terminated.
+    Returns dict with the instance id as key and the last seen state as value for instances which timed out.
+    """
+    pending = dict(instance_target_states)
+    deadline = time.monotonic() + timeout
+    poll_interval = WAIT_POLL_INTERVAL_MIN
+    while True:
+        instance_states = scan_instance_states_by_ids(ec2_client=ec2_client, instance_ids=list(pending))
+        for instance_id, target_state in list(pending.items()):
+            instance_state = instance_states.get(instance_id, 'terminated')
+            if instance_state == target_state:
+                report_result(f'Instance with id "{instance_id}" is {target_state}...', [instance_id],
+                              action='wait', state_after=instance_state, outcome='reached')
+                del pending[instance_id]
+        remaining_time = deadline - time.monotonic()
+        if not pending or remaining_time <= 0:
+            break
+        time.sleep(min(poll_interval, remaining_time))
+        poll_interval = min(poll_interval * 2, WAIT_POLL_INTERVAL_MAX)
+    timed_out = {instance_id: instance_states.get(instance_id, 'terminated') for instance_id in pending}
+    for instance_id, instance_state in timed_out.items():
+        report_result(f'Timeout: instance with id "{instance_id}" is still {instance_state}...', [instance_id],
+                      action='wait', state_after=instance_state, outcome='timed_out')
+    return timed_out
+
+
+def scan_instances_by_ids(ec2_client: Ec2Client, instance_ids: list) -> Iterator[InstanceRecord]:
+    """
+    Yields records of EC2 instances with given ids. Ids of non-existent instances are skipped.
+    """
+    for instance_ids_chunk in split_into_chunks(items=instance_ids, chunk_size=EC2_FILTER_VALUES_MAX):
+        ec2_filters = [{'Name': 'instance-id', 'Values': instance_ids_chunk}]
+        yield from scan_instances(ec2_client=ec2_client, ec2_filters=ec2_filters)
+
+
+class PolicyError(ValueError):
+    """
+    Raised when the policy file is not valid.
+    """
+
+
+class Policy:
+    """
+    Cleanup policy - the action performed on EC2 instances matching the selector.
+    The selector consists of the same args as the script's main func (e.g. ec2_no_tags=True).
+    """
+    def __init__(self, action: str, selector: dict, name: str = ''):
+        self.action = action
+        self.selector = selector
+        self.name = name or action
+
+    def __repr__(self):
+        return f'Policy(action={self.action!r}, selector={self.selector!r}, name={self.name!r})'
+
+    def matches(self, instance: InstanceRecord, filters_applied: bool = False) -> bool:
+        """
+        Checks whether the policy action should be performed on the EC2 instance.
+        If filters_applied is True, the instance was listed with the policy's EC2 API filters.
+        """
+        return check_proper_instance_state(action=self.action, ec2_current_state=instance.state) and \
+            is_instance_selected(instance=instance, filters_applied=filters_applied, **self.selector)
+
+    @classmethod
+    def from_dict(cls, policy: dict) -> 'Policy':
+        """
+        Creates policy from the policy file entry, e.g. {'action': 'stop', 'tag': {'key': 'Env', 'value': 'Dev'}}
+        or {'action': 'terminate', 'expired': 'cleanup-after'}.
+        """
+        if not isinstance(policy, dict):
+            raise PolicyError(f'policy must be a mapping, got: {policy!r}')
+        name = str(policy.get('name', ''))
+        action = policy.get('action')
+        # Tags of tag and untag actions are given only on the command line
+        if action not in EC2_ACTIONS_PRECEDENCE or action in ('tag', 'untag'):
+            raise PolicyError(f'policy "{name or action}" has not allowed action: {action!r}')
+        selectors = [selector for selector in ('no_tags', 'no_name', 'tag', 'expression', 'expired')
+                     if policy.get(selector)]
+        if len(selectors) > 1:
+            raise PolicyError(f'policy "{name or action}" selectors {", ".join(selectors)} are mutually exclusive')
+        if 'no_name' in selectors:
+            selector = {'ec2_no_name_tag': True}
+        elif 'tag' in selectors:
+            tag = policy['tag']
+            if not isinstance(tag, dict) or not tag.get('key') or not tag.get('value'):
+                raise PolicyError(f'policy "{name or action}" tag must have key and value')
+            selector = {'ec2_tag': {'tag_key': str(tag['key']), 'tag_value': str(tag['value'])}}
+        elif 'expression' in selectors:
+            try:
+                selector = {'ec2_tag_expression': CompiledTagExpression(str(policy['expression']))}
+            except TagExpressionError as err:
+                raise PolicyError(f'policy "{name or action}": {err}')
+        elif 'expired' in selectors:
+            # Expiry tag key, or true for the default key
+            expired = policy['expired']
+            selector = {'ec2_expired_tag': EXPIRY_TAG_KEY_DEFAULT if expired is True else str(expired)}
+        else:
+            # Default option - EC2 instances without assigned tags
+            selector = {'ec2_no_tags': True}
+        return cls(action=action, selector=selector, name=name)
+
+
+def load_policies(policy_file: str) -> list:
+    """
+    Loads cleanup policies from the JSON or YAML file.
+    """
+    try:
+        with open(policy_file) as file:
+            if policy_file.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise PolicyError('PyYAML package is required to load YAML policy files')
+                content = yaml.safe_load(file)
+            else:
+                content = json.load(file)
+    except OSError as err:
+        raise PolicyError(f'cannot read policy file: {err}')
+    except ValueError as err:
+        # Both json.JSONDecodeError and yaml.YAMLError
+        raise PolicyError(f'cannot parse policy file: {err}')
+    policies = content.get('policies') if isinstance(content, dict) else content
+    if not isinstance(policies, list) or not policies:
+        raise PolicyError('policy file must contain non-empty list of policies')
+    return [Policy.from_dict(policy) for policy in policies]
+
+
+def build_policies_filters(policies: list) -> list:
+    """
+    Builds EC2 API filters for the scan shared by all given policies.
+    """
+    if len(policies) == 1:
+        return build_instance_filters(action=policies[0].action, **policies[0].selector)
+    if any(policy.action not in EC2_ACTION_INSTANCE_STATES for policy in policies):
+        return []
+    instance_states = {state for policy in policies for state in EC2_ACTION_INSTANCE_STATES[policy.action]}
+    return [{'Name': 'instance-state-name', 'Values': sorted(instance_states)}]
+
+
+def select_policy_action(instance: InstanceRecord, policies: list, filters_applied: bool = False) -> Optional[str]:
+    """
+    Returns the action with the highest precedence among policies matching the EC2 instance.
+    filters_applied must be True only if the instance was listed with the EC2 API filters of the single policy.
+    """
+    actions = {policy.action for policy in policies if policy.matches(instance, filters_applied=filters_applied)}
+    for action in EC2_ACTIONS_PRECEDENCE:
+        if action in actions:
+            return action
+    return None
+
+
+def get_scanned_instance_action(policies: list):
+    """
+    Returns func which returns the action to be performed on the EC2 instance scanned with policies filters
+    (or None if there is no action).
+    """
+    # Single policy may be fully evaluated by EC2 filters
+    if len(policies) == 1 and not is_selector_checked_locally(**policies[0].selector):
+        return lambda instance: policies[0].action
+    # Filters of a single policy were applied by EC2 API, multiple policies are scanned only with state filter
+    filters_applied = len(policies) == 1
+    return lambda instance: select_policy_action(instance=instance, policies=policies, filters_applied=filters_applied)
+
+
+def scan_selected_instances(ec2_client: Ec2Client, policies: list) -> Iterator[tuple]:
+    """
+    Yields records of EC2 instances matching any of given policies along with the action to be performed.
+    All policies are evaluated against a single scan.
+    """
+    ec2_filters = build_policies_filters(policies=policies)
+    get_instance_action = get_scanned_instance_action(policies=policies)
+    instances = scan_instances(ec2_client=ec2_client, ec2_filters=ec2_filters)
+    # Time spent in paging (including parsing) and in matching is measured separately
+    scan_seconds = match_seconds = 0.0
+    try:
+        while True:
+            started_at = time.perf_counter()
+            instance = next(instances, None)
+            scanned_at = time.perf_counter()
+            scan_seconds += scanned_at - started_at
+            if instance is None:
+                break
+            action = get_instance_action(instance)
+            match_seconds += time.perf_counter() - scanned_at
+            if action:
+                yield instance, action
+    finally:
+        if _stats is not None:
+            _stats.add_phase_time('scan', scan_seconds)
+            _stats.add_phase_time('match', match_seconds)
+
+
+class InventorySnapshot:
+    """
+    Local SQLite snapshot of EC2 instances (id, state, tags and launch time) per AWS region.
+    """
+    def __init__(self, path: str = None):
+        if path is None:
+            os.makedirs(get_cache_dir(), exist_ok=True)
+            path = os.path.join(get_cache_dir(), 'inventory.sqlite3')
+        import sqlite3
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS instances ('
+                'region TEXT, instance_id TEXT, state TEXT, tags TEXT, launch_time TEXT, '
+                'PRIMARY KEY (region, instance_id))'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots (region TEXT PRIMARY KEY, synced_at REAL, full_synced_at REAL)'
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.close()
+
+    def sync_times(self, region: str) -> tuple:
+        """
+        Returns times (epoch) of the last sync and the last full sync of the region or (None, None).
+        """
+        row = self.connection.execute(
+            'SELECT synced_at, full_synced_at FROM snapshots WHERE region = ?', (region,)
+        ).fetchone()
+        return row or (None, None)
+
+    def instances(self, region: str) -> Iterator[InstanceRecord]:
+        """
+        Yields records of EC2 instances stored in the snapshot of the region.
+        """
+        rows = self.connection.execute(
+            'SELECT instance_id, state, tags, launch_time FROM instances WHERE region = ? ORDER BY instance_id',
+            (region,)
+        )
+        for instance_id, state, tags, launch_time in rows:
+            yield InstanceRecord(instance_id=instance_id,
+                                 state=state,
+                                 tags=MappingProxyType(json.loads(tags)) if tags != '{}' else InstanceRecord.NO_TAGS,
+                                 launch_time=datetime.fromisoformat(launch_time) if launch_time else None)
+
+    def instance_states(self, region: str) -> dict:
+        """
+        Returns states of EC2 instances stored in the snapshot of the region (instance id as key).
+        """
+        rows = self.connection.execute('SELECT instance_id, state FROM instances WHERE region = ?', (region,))
+        return dict(rows)
+
+    def update(self, region: str, instances: Iterable, removed_instance_ids: Iterable = (), full: bool = False) -> None:
+        """
+        Stores given EC2 instances in the snapshot of the region. Full update replaces all stored instances.
+        """
+        now = time.time()
+        rows = (
+            (region, instance.id, instance.state, json.dumps(dict(instance.tags)),
+             instance.launch_time.isoformat() if instance.launch_time else None)
+            for instance in instances
+        )
+        with self.connection:
+            if full:
+                self.connection.execute('DELETE FROM instances WHERE region = ?', (region,))
+            else:
+                self.connection.executemany('DELETE FROM instances WHERE region = ? AND instance_id = ?',
+                                            ((region, instance_id) for instance_id in removed_instance_ids))
+            self.connection.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)', rows)
+            full_synced_at = now if full else self.sync_times(region)[1]
+            self.connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)', (region, now, full_synced_at))
 
 
-def check_tag_exist(tags: list, tag_key: str, tag_value: str = '') -> bool:
+class InstanceInventory:
     """
-    Checks whether a specified tag is in the list of given tags.
+    In-memory inventory of EC2 instances per AWS region kept between sweeps of serve mode.
+    It has the same interface as InventorySnapshot, so it is refreshed the same way.
     """
-    for tag in tags:
-        if tag_value:
-            if tag.get('Key') == tag_key and tag.get('Value') == tag_value:
-                return True
+    def __init__(self):
+        self._instances = {}
+        self._sync_times = {}
+        self._lock = threading.Lock()
+
+    def sync_times(self, region: str) -> tuple:
+        """
+        Returns times (epoch) of the last sync and the last full sync of the region or (None, None).
+        """
+        with self._lock:
+            return self._sync_times.get(region, (None, None))
+
+    def instances(self, region: str) -> Iterator[InstanceRecord]:
+        """
+        Yields records of EC2 instances stored in the inventory of the region.
+        """
+        with self._lock:
+            region_instances = sorted(self._instances.get(region, {}).values(), key=lambda instance: instance.id)
+        yield from region_instances
+
+    def instance_states(self, region: str) -> dict:
+        """
+        Returns states of EC2 instances stored in the inventory of the region (instance id as key).
+        """
+        with self._lock:
+            return {instance_id: instance.state for instance_id, instance in self._instances.get(region, {}).items()}
+
+    def instances_count(self) -> dict:
+        """
+        Returns number of EC2 instances stored in the inventory per region.
+        """
+        with self._lock:
+            return {region: len(region_instances) for region, region_instances in self._instances.items()}
+
+    def update(self, region: str, instances: Iterable, removed_instance_ids: Iterable = (), full: bool = False) -> None:
+        """
+        Stores given EC2 instances in the inventory of the region. Full update replaces all stored instances.
+        """
+        instances = {instance.id: instance for instance in instances}
+        now = time.time()
+        with self._lock:
+            if full:
+                self._instances[region] = instances
+                self._sync_times[region] = (now, now)
+                return
+            region_instances = self._instances.setdefault(region, {})
+            for instance_id in removed_instance_ids:
+                region_instances.pop(instance_id, None)
+            region_instances.update(instances)
+            self._sync_times[region] = (now, self._sync_times.get(region, (None, None))[1])
+
+
+def refresh_inventory_snapshot(ec2_client: Ec2Client,
+                               snapshot: InventorySnapshot,
+                               region: str,
+                               full_sync_interval: float = SNAPSHOT_FULL_SYNC_INTERVAL) -> None:
+    """
+    Refreshes the snapshot (or in-memory inventory) of the region. If the snapshot was fully synced within
+    full_sync_interval seconds, only instances whose state changed (or which are new) are re-fetched,
+    otherwise all instances are re-fetched.
+    """
+    _, full_synced_at = snapshot.sync_times(region)
+    if full_synced_at is None or time.time() - full_synced_at > full_sync_interval:
+        snapshot.update(region=region, instances=scan_instances(ec2_client=ec2_client, ec2_filters=[]), full=True)
+        return
+    stored_states = snapshot.instance_states(region)
+    current_states = dict(scan_instance_states(ec2_client=ec2_client))
+    changed_instance_ids = [
+        instance_id for instance_id, state in current_states.items() if stored_states.get(instance_id) != state
+    ]
+    removed_instance_ids = [instance_id for instance_id in stored_states if instance_id not in current_states]
+    snapshot.update(region=region,
+                    instances=list(scan_instances_by_ids(ec2_client=ec2_client, instance_ids=changed_instance_ids)),
+                    removed_instance_ids=removed_instance_ids)
+
+
+def query_inventory_snapshot(ec2_client: Ec2Client,
+                             region: str,
+                             policies: list,
+                             max_staleness: float = None,
+                             refresh: bool = False) -> Iterator[tuple]:
+    """
+    Yields records of EC2 instances from the local snapshot matching any of given policies along with the action.
+    The snapshot is refreshed first if it is older than max_staleness (seconds) or if refresh is True.
+    """
+    with InventorySnapshot() as snapshot:
+        synced_at, _ = snapshot.sync_times(region)
+        snapshot_stale = synced_at is None or max_staleness is None or time.time() - synced_at > max_staleness
+        if refresh or snapshot_stale:
+            with phase_timer('snapshot_refresh'):
+                refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=snapshot, region=region)
+        for instance in snapshot.instances(region):
+            action = select_policy_action(instance=instance, policies=policies)
+            if action:
+                yield instance, action
+
+
+def select_instances_by_ids(ec2_client: Ec2Client, instance_ids: list, policies: list) -> Iterator[tuple]:
+    """
+    Yields records of EC2 instances with given ids matching any of given policies along with the action.
+    Only the given instances are described.
+    """
+    for instance in scan_instances_by_ids(ec2_client=ec2_client, instance_ids=instance_ids):
+        action = select_policy_action(instance=instance, policies=policies)
+        if action:
+            yield instance, action
+
+
+def select_inventory_instances(ec2_client: Ec2Client,
+                               inventory: InstanceInventory,
+                               region: str,
+                               policies: list) -> Iterator[tuple]:
+    """
+    Yields records of EC2 instances from the in-memory inventory matching any of given policies along with the action.
+    Instances to be stopped or terminated are described again and the policies are evaluated with their current
+    state and tags, because the inventory does not track tag changes between full syncs.
+    """
+    candidate_instance_ids = []
+    for instance in inventory.instances(region):
+        action = select_policy_action(instance=instance, policies=policies)
+        if action == 'list':
+            yield instance, action
+        elif action:
+            candidate_instance_ids.append(instance.id)
+    if not candidate_instance_ids:
+        return
+    candidate_instances = list(scan_instances_by_ids(ec2_client=ec2_client, instance_ids=candidate_instance_ids))
+    inventory.update(region=region, instances=candidate_instances)
+    for instance in candidate_instances:
+        action = select_policy_action(instance=instance, policies=policies)
+        if action:
+            yield instance, action
+
+
+def export_instances(ec2_client: Ec2Client, export_file: str, region: str) -> int:
+    """
+    Writes all EC2 instances in the region to the compact columnar file (gzipped JSON).
+    States, tag keys and tag values are dictionary-encoded. Returns the number of exported instances.
+    """
+    columns = {'ids': [], 'states': [], 'launch_times': [], 'tags': []}
+    dictionaries = {'state_names': {}, 'tag_keys': {}, 'tag_values': {}}
+
+    def encode(dictionary: str, value: str) -> int:
+        return dictionaries[dictionary].setdefault(value, len(dictionaries[dictionary]))
+
+    for instance in scan_instances(ec2_client=ec2_client, ec2_filters=[]):
+        columns['ids'].append(instance.id)
+        columns['states'].append(encode('state_names', instance.state))
+        columns['launch_times'].append(instance.launch_time.isoformat() if instance.launch_time else None)
+        # Tags of the instance are flattened into [key index, value index, ...]
+        instance_tags = []
+        for tag_key, tag_value in instance.tags.items():
+            instance_tags.extend([encode('tag_keys', tag_key), encode('tag_values', tag_value)])
+        columns['tags'].append(instance_tags)
+    export = {
+        'version': EXPORT_FORMAT_VERSION,
+        'region': region,
+        'exported_at': time.time(),
+        **{dictionary: list(values) for dictionary, values in dictionaries.items()},
+        **columns
+    }
+    with gzip.open(export_file, 'wt', encoding='utf-8') as file:
+        json.dump(export, file, separators=(',', ':'))
+    return len(columns['ids'])
+
+
+def load_exported_instances(export_file: str) -> list:
+    """
+    Reads records of EC2 instances from the file written by export_instances().
+    """
+    with gzip.open(export_file, 'rt', encoding='utf-8') as file:
+        export = json.load(file)
+    if export.get('version') != EXPORT_FORMAT_VERSION:
+        raise ValueError(f'Not supported export file version: {export.get("version")}')
+    state_names, tag_keys, tag_values = export['state_names'], export['tag_keys'], export['tag_values']
+    instances = []
+    for instance_id, state, launch_time, tags in zip(export['ids'], export['states'], export['launch_times'],
+                                                     export['tags']):
+        instance_tags = {tag_keys[tags[i]]: tag_values[tags[i + 1]] for i in range(0, len(tags), 2)}
+        instances.append(InstanceRecord(instance_id=instance_id,
+                                        state=state_names[state],
+                                        tags=MappingProxyType(instance_tags) if tags else InstanceRecord.NO_TAGS,
+                                        launch_time=datetime.fromisoformat(launch_time) if launch_time else None))
+    return instances
+
+
+class InventoryIndex:
+    """
+    Inverted indexes over EC2 instances: tag key -> ids, tag key -> tag value -> ids and state -> ids.
+    Selectors are answered with set operations on the indexes. Instances marked with an expiry tag are indexed
+    by their expiry time on first use of the tag key.
+    """
+    def __init__(self, instances: Iterable):
+        self.instances = {}
+        self.tagged_ids = set()
+        self.tag_keys = {}
+        self.tag_values = {}
+        self.states = {}
+        self.expiry_schedules = {}
+        for instance in instances:
+            self.instances[instance.id] = instance
+            self.states.setdefault(instance.state, set()).add(instance.id)
+            if instance.tags:
+                self.tagged_ids.add(instance.id)
+            for tag_key, tag_value in instance.tags.items():
+                self.tag_keys.setdefault(tag_key, set()).add(instance.id)
+                self.tag_values.setdefault(tag_key, {}).setdefault(tag_value, set()).add(instance.id)
+
+    def select(self, **kwargs) -> list:
+        """
+        Returns records of EC2 instances (sorted by id) matching the selector given as the script's main func args.
+        """
+        no_tags: bool = kwargs.get('ec2_no_tags', False)
+        no_name_tag: bool = kwargs.get('ec2_no_name_tag', False)
+        specified_tag: dict = kwargs.get('ec2_tag', {})
+        tag_expression: Optional[CompiledTagExpression] = kwargs.get('ec2_tag_expression')
+        expired_tag: Optional[str] = kwargs.get('ec2_expired_tag')
+        all_ids = set(self.instances)
+        if no_name_tag:
+            instance_ids = all_ids - self.tag_keys.get('Name', set())
+        elif specified_tag:
+            instance_ids = self._filter_ids({'Name': f'tag:{specified_tag["tag_key"]}',
+                                             'Values': [specified_tag['tag_value']]})
+        elif tag_expression:
+            instance_ids = all_ids
+            # Sub-expressions pushed down into EC2 filters are answered by indexes
+            for ec2_filter in tag_expression.filters:
+                instance_ids = instance_ids & self._filter_ids(ec2_filter)
+            instance_ids = {
+                instance_id for instance_id in instance_ids
+                if tag_expression.matches(self.instances[instance_id], filters_applied=True)
+            }
+        elif expired_tag:
+            expiry_timestamps, expiry_ids = self.expiry_schedule(expiry_tag=expired_tag)
+            instance_ids = set(expiry_ids[:bisect.bisect_right(expiry_timestamps, time.time())])
+        elif no_tags:
+            instance_ids = all_ids - self.tagged_ids
         else:
-            if tag.get('Key') == tag_key:
-                return True
-    return False
+            instance_ids = set()
+        return [self.instances[instance_id] for instance_id in sorted(instance_ids)]
 
+    def expiry_schedule(self, expiry_tag: str) -> tuple:
+        """
+        Returns expiry timestamps (sorted) of instances marked with the expiry tag and ids of the instances in the
+        same order, so the due instances are a prefix found with binary search. Instances with the expiry tag value
+        which is not valid timestamp are left out.
+        """
+        if expiry_tag not in self.expiry_schedules:
+            schedule = sorted(
+                (parse_expiry_timestamp(tag_value), instance_id)
+                for tag_value, instance_ids in self.tag_values.get(expiry_tag, {}).items()
+                if parse_expiry_timestamp(tag_value) is not None
+                for instance_id in instance_ids
+            )
+            self.expiry_schedules[expiry_tag] = ([timestamp for timestamp, _ in schedule],
+                                                 [instance_id for _, instance_id in schedule])
+        return self.expiry_schedules[expiry_tag]
 
-def check_proper_instance_state(action: str, ec2_current_state: str) -> bool:
+    def _filter_ids(self, ec2_filter: dict) -> set:
+        """
+        Returns ids of EC2 instances matching EC2 API filter (tag-key, tag:KEY or instance-state-name).
+        """
+        filter_name, filter_values = ec2_filter['Name'], ec2_filter['Values']
+        if filter_name == 'tag-key':
+            return set().union(*(self.tag_keys.get(tag_key, set()) for tag_key in filter_values))
+        if filter_name == 'instance-state-name':
+            return set().union(*(self.states.get(state, set()) for state in filter_values))
+        tag_values = self.tag_values.get(filter_name[len('tag:'):], {})
+        instance_ids = set()
+        for filter_value in filter_values:
+            if '*' in filter_value:
+                wildcard_pattern = re.compile(re.escape(filter_value).replace(r'\*', '.*') + r'\Z', re.DOTALL)
+                for tag_value, tag_value_ids in tag_values.items():
+                    if wildcard_pattern.match(tag_value):
+                        instance_ids |= tag_value_ids
+            else:
+                instance_ids |= tag_values.get(filter_value, set())
+        return instance_ids
+
+
+def query_exported_instances(export_file: str, **kwargs) -> None:
     """
-    Checks whether the EC2 instance is in desired state.
+    Lists EC2 instances from the export file matching the selector given as the script's main func args.
     """
-    if action == 'terminate':
-        return ec2_current_state in ['pending', 'running', 'stopping', 'stopped']
-    elif action == 'stop':
-        return ec2_current_state in ['pending', 'running']
-    elif action == 'list':
-        return True
-    return False
+    index = InventoryIndex(load_exported_instances(export_file=export_file))
+    instances = index.select(**kwargs)
+    for instance in instances:
+        report_result(f'Instance id: "{instance.id}", current state: "{instance.state}"', [instance.id],
+                      action='list', state_before=instance.state, state_after=instance.state, outcome='listed')
+    if not instances:
+        echo('Nothing to do...')
 
 
-def check_aws_region(region_specified: str) -> bool:
+class PlanError(ValueError):
     """
-    Checks whether given text value is a valid AWS region name.
+    Raised when the action plan file is not valid.
     """
-    # Get AWS region names
-    ec2_client = boto3.client('ec2')
-    aws_regions: list = ec2_client.describe_regions(AllRegions=True)['Regions']
-    aws_region_names = [region['RegionName'] for region in aws_regions]
-    return region_specified in aws_region_names
 
 
-def is_action_allowed(action: str) -> None:
+class ActionPlan:
     """
-    Checks whether given EC2 action is allowed.
+    Ids of EC2 instances per action per region, recorded by dry run and executed later without rescanning.
+    Instances can be added concurrently from multiple regions.
     """
-    allowed_ec2_actions = ['stop', 'terminate', 'list']
-    if action not in allowed_ec2_actions:
-        print('Not allowed "ec2_action" value!')
-        sys.exit(1)
+    def __init__(self, regions: Mapping = None, created_at: float = None):
+        self.regions = {region: {action: list(instance_ids) for action, instance_ids in actions.items()}
+                        for region, actions in (regions or {}).items()}
+        self.created_at = time.time() if created_at is None else created_at
+        self._lock = threading.Lock()
+
+    def add(self, region: str, action: str, instance_ids: Iterable) -> None:
+        """
+        Adds the instances on which the action is planned in the region.
+        """
+        with self._lock:
+            self.regions.setdefault(region, {}).setdefault(action, []).extend(instance_ids)
 
+    def iterate_instances(self, region: str) -> Iterator[tuple]:
+        """
+        Yields planned instances in the region with the action in the same form as scan_selected_instances().
+        Instance state is unknown until the action is performed.
+        """
+        for action, instance_ids in self.regions.get(region, {}).items():
+            for instance_id in instance_ids:
+                yield InstanceRecord(instance_id=instance_id, state='planned'), action
 
-def perform_action_on_instance(action: str, instance: Ec2Instance, **kwargs) -> bool:
+    def save(self, plan_file: str) -> None:
+        """
+        Writes the plan to the JSON file.
+        """
+        plan = {
+            'version': PLAN_FORMAT_VERSION,
+            'created_at': self.created_at,
+            'regions': self.regions
+        }
+        with open(plan_file, 'w', encoding='utf-8') as file:
+            json.dump(plan, file, indent=2)
+
+    @classmethod
+    def load(cls, plan_file: str) -> 'ActionPlan':
+        """
+        Reads the plan from the JSON file written by save().
+        """
+        try:
+            with open(plan_file, encoding='utf-8') as file:
+                plan = json.load(file)
+        except (OSError, ValueError) as err:
+            raise PlanError(f'Cannot read plan file "{plan_file}": {err}') from err
+        if not isinstance(plan, dict) or plan.get('version') != PLAN_FORMAT_VERSION:
+            raise PlanError('Not supported plan file version')
+        regions = plan.get('regions')
+        if not isinstance(regions, dict):
+            raise PlanError('Plan file must contain regions mapping')
+        for region, actions in regions.items():
+            if not isinstance(actions, dict) or any(action not in EC2_ACTION_TARGET_STATES for action in actions):
+                raise PlanError(f'Plan of region {region} must map stop or terminate action to instance ids')
+        return cls(regions=regions, created_at=plan.get('created_at'))
+
+
+def main(aws_region,
+         ec2_action=None,
+         session=None,
+         per_instance: bool = False,
+         action_workers: int = ACTION_WORKERS_DEFAULT,
+         action_rate: float = ACTION_RATE_DEFAULT,
+         policies: list = None,
+         max_staleness: float = None,
+         refresh_snapshot: bool = False,
+         export_file: str = None,
+         wait: bool = False,
+         wait_timeout: float = WAIT_TIMEOUT_DEFAULT,
+         dry_run: bool = False,
+         plan: ActionPlan = None,
+         applied_plan: ActionPlan = None,
+         inventory: InstanceInventory = None,
+         instance_ids: list = None,
+         tags: Mapping = None,
+         expiry_tag: str = EXPIRY_TAG_KEY_DEFAULT,
+         grace_period: float = EXPIRY_GRACE_PERIOD_DEFAULT,
+         **kwargs) -> None:
     """
-    Performs the specified action (stop or terminate) on the EC2 instance if necessary.
-    Returns True if the action was performed on the EC2 instance.
+    Script's main func.
+    Instances are listed in a background thread, while the actions on already listed instances are dispatched.
+    If per_instance is True, the action is performed with a separate API call per instance (on a worker pool).
+    If policies are given, all of them are evaluated in a single scan instead of ec2_action and selector args.
+    If max_staleness (seconds) is given or refresh_snapshot is True, the list action is answered from the local
+    inventory snapshot.
+    The export action writes all EC2 instances to the export_file ("{region}" is replaced with region name).
+    If wait is True, the instances acted on are polled until they reach the target state or wait_timeout elapses.
+    If dry_run is True, the actions are only checked with batched DryRun requests and the instances which passed
+    the check are added to the plan. If applied_plan is given, its instances in the region are acted on instead
+    of scanned ones. If inventory is given, the instances are selected from it instead of scanned.
+    If instance_ids are given, only these instances are described and selected.
+    Tag and untag actions assign or remove given tags (see parse_tags()) and skip instances whose tags would not
+    change. Mark action tags instances which are not marked yet with expiry_tag set to grace_period seconds
+    from now (due instances are later selected with ec2_expired_tag selector).
     """
-    instance_tags = instance.tags
-    take_action = False
-    # Get additional attrs
-    no_tags: bool = kwargs.get('ec2_no_tags', False)
-    no_name_tag: bool = kwargs.get('ec2_no_name_tag', False)
-    specified_tag: dict = kwargs.get('ec2_tag', {})
-    if no_tags and not instance_tags:
-        # Perform an action if EC2 instance has NO tag assigned
-        take_action = True
-    elif no_name_tag:
-        # Perform an action ONLY if tag "Name" IS NOT assigned to EC2 instance
-        if instance_tags:
-            take_action = not check_tag_exist(tags=instance_tags, tag_key='Name')
+    if ec2_action == 'export':
+        ec2_client = get_ec2_client(aws_region=aws_region, session=session)
+        export_file = export_file.format(region=aws_region)
+        with phase_timer('export'):
+            exported_count = export_instances(ec2_client=ec2_client, export_file=export_file, region=aws_region)
+        echo(f'{exported_count} instances exported to "{export_file}"...')
+        return
+    if policies is None and applied_plan is None:
+        is_action_allowed(action=ec2_action)
+        policies = [Policy(action=ec2_action, selector=kwargs)]
+    if policies and any(policy.action == 'mark' for policy in policies):
+        # Expiry time is computed for every run (e.g. every sweep of serve mode)
+        tags = build_expiry_tags(expiry_tag=expiry_tag, grace_period=grace_period)
+    use_snapshot = max_staleness is not None or refresh_snapshot
+    if use_snapshot and applied_plan is None and any(policy.action != 'list' for policy in policies):
+        raise ValueError('Only list action can be answered from the local inventory snapshot')
+    # Get EC2 instances in specified AWS region matching the policies
+    ec2_client = get_ec2_client(aws_region=aws_region, session=session)
+    if dry_run and plan is None:
+        raise ValueError('Plan must be given with dry run')
+    if dry_run and policies and any(policy.action in EC2_TAG_ACTIONS for policy in policies):
+        raise ValueError('Only stop and terminate actions can be planned with dry run')
+    # Results reported by the current thread (and actions dispatched from it) belong to the region
+    _current_region.set(aws_region)
+    if applied_plan is not None:
+        ec2_instances_selected = applied_plan.iterate_instances(region=aws_region)
+    elif instance_ids is not None:
+        ec2_instances_selected = select_instances_by_ids(ec2_client=ec2_client,
+                                                         instance_ids=instance_ids,
+                                                         policies=policies)
+    elif inventory is not None:
+        ec2_instances_selected = select_inventory_instances(ec2_client=ec2_client,
+                                                            inventory=inventory,
+                                                            region=aws_region,
+                                                            policies=policies)
+    elif use_snapshot:
+        ec2_instances_selected = query_inventory_snapshot(ec2_client=ec2_client,
+                                                          region=aws_region,
+                                                          policies=policies,
+                                                          max_staleness=max_staleness,
+                                                          refresh=refresh_snapshot)
+    else:
+        ec2_instances_selected = scan_selected_instances(ec2_client=ec2_client, policies=policies)
+    rate_limiter = TokenBucketRateLimiter(rate=action_rate)
+    ec2_instances_selected_count = 0
+    # Ids of EC2 instances on which the action will be performed in the next batch (per action)
+    ec2_instance_ids_batches = {action: [] for action in EC2_ACTIONS_PAST_TENSE}
+    # Target states of the instances acted on (instance id as key), awaited if wait is True
+    ec2_instance_target_states = {}
+    track_results = wait or dry_run
+
+    def track_batch_result(action: str, future: Future) -> None:
+        performed_instance_ids = [instance_id for instance_id, performed in (future.result() or {}).items()
+                                  if performed]
+        if dry_run:
+            plan.add(region=aws_region, action=action, instance_ids=performed_instance_ids)
+        # Only stop and terminate actions have target states (e.g. mark policy can be evaluated with them)
+        if wait and action in EC2_ACTION_TARGET_STATES:
+            ec2_instance_target_states.update(dict.fromkeys(performed_instance_ids, EC2_ACTION_TARGET_STATES[action]))
+
+    def track_instance_result(action: str, instance_id: str, future: Future) -> None:
+        if future.result() and action in EC2_ACTION_TARGET_STATES:
+            ec2_instance_target_states[instance_id] = EC2_ACTION_TARGET_STATES[action]
+
+    with ActionDispatcher(max_workers=action_workers, rate_limiter=rate_limiter) as dispatcher:
+
+        def dispatch_batch(action: str) -> None:
+            ec2_instance_ids_batch = ec2_instance_ids_batches[action]
+            if ec2_instance_ids_batch:
+                future = dispatcher.submit_self_limited(perform_batch_action,
+                                                        ec2_client=ec2_client,
+                                                        action=action,
+                                                        instance_ids=ec2_instance_ids_batch.copy(),
+                                                        rate_limiter=rate_limiter,
+                                                        dry_run=dry_run,
+                                                        tags=tags)
+                if track_results:
+                    future.add_done_callback(partial(track_batch_result, action))
+                ec2_instance_ids_batch.clear()
+
+        for selected in iterate_in_background(ec2_instances_selected):
+            if selected is None:
+                # Listing waits for the next page - dispatch instances collected so far
+                for batch_action in ec2_instance_ids_batches:
+                    dispatch_batch(action=batch_action)
+                continue
+            instance, ec2_instance_action = selected
+            if ec2_instance_action in EC2_TAG_ACTIONS and \
+                    not is_tags_change_needed(instance=instance, action=ec2_instance_action, tags=tags):
+                continue
+            ec2_instances_selected_count += 1
+            if ec2_instance_action == 'list':
+                # Only list effected instances
+                report_result(f'Instance id: "{instance.id}", current state: "{instance.state}"', [instance.id],
+                              action='list', state_before=instance.state, state_after=instance.state,
+                              outcome='listed')
+            elif per_instance and not dry_run:
+                future = dispatcher.submit(perform_instance_action,
+                                           ec2_client=ec2_client,
+                                           action=ec2_instance_action,
+                                           instance_id=instance.id,
+                                           tags=tags)
+                if wait:
+                    future.add_done_callback(partial(track_instance_result, ec2_instance_action, instance.id))
+            else:
+                ec2_instance_ids_batches[ec2_instance_action].append(instance.id)
+                if len(ec2_instance_ids_batches[ec2_instance_action]) == EC2_ACTION_BATCH_SIZE:
+                    dispatch_batch(action=ec2_instance_action)
+        for batch_action in ec2_instance_ids_batches:
+            dispatch_batch(action=batch_action)
+    if not ec2_instances_selected_count:
+        echo('Nothing to do...')
+    elif ec2_instance_target_states:
+        with phase_timer('wait'):
+            wait_for_instance_states(ec2_client=ec2_client,
+                                     instance_target_states=ec2_instance_target_states,
+                                     timeout=wait_timeout)
+
+
+def run_main_in_region(aws_region: str, ec2_action: str = None, **kwargs) -> list:
+    """
+    Runs script's main func in the specified AWS region with the shared client.
+    Returns the output lines produced for the region.
+    """
+    region_output = []
+    output_buffer_token = _output_buffer.set(region_output)
+    try:
+        main(aws_region=aws_region, ec2_action=ec2_action, **kwargs)
+    except ClientError as err:
+        error_msg = err.response['Error']['Message']
+        echo(f'Error: {error_msg}')
+    finally:
+        _output_buffer.reset(output_buffer_token)
+    return region_output
+
+
+def echo_regions_output(aws_regions: list, regions_output: Iterable) -> None:
+    """
+    Prints output lines of the regions grouped per region.
+    """
+    for aws_region, region_output in zip(aws_regions, regions_output):
+        echo(f'Region: {aws_region}')
+        for line in region_output:
+            echo(f'  {line}')
+
+
+def run_main_in_regions(aws_regions: list,
+                        ec2_action: str = None,
+                        max_workers: int = REGION_WORKERS_DEFAULT,
+                        **kwargs) -> None:
+    """
+    Runs script's main func concurrently in the specified AWS regions.
+    The output is printed per region in the order in which the regions were given.
+    """
+    if not kwargs.get('policies') and kwargs.get('applied_plan') is None:
+        is_action_allowed(action=ec2_action)
+    if ec2_action == 'export' and len(aws_regions) > 1 and '{region}' not in (kwargs.get('export_file') or ''):
+        raise ValueError('Export file must contain "{region}" placeholder when exporting multiple regions')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_main_in_region, aws_region, ec2_action, **kwargs) for aws_region in aws_regions]
+        echo_regions_output(aws_regions=aws_regions, regions_output=(future.result() for future in futures))
+
+
+def run_main_in_account_region(role_sessions: AssumedRoleSessions,
+                               role_arn: str,
+                               aws_region: str,
+                               ec2_action: str = None,
+                               **kwargs) -> tuple:
+    """
+    Runs script's main func in the specified AWS region with the session of the assumed role.
+    Returns the output lines produced for the region and counts of the reported results.
+    """
+    result_counts = ResultCounts()
+    account_token = _current_account.set(get_role_account_id(role_arn))
+    result_counts_token = _result_counts.set(result_counts)
+    try:
+        region_output = run_main_in_region(aws_region=aws_region,
+                                           ec2_action=ec2_action,
+                                           session=role_sessions.session(role_arn),
+                                           **kwargs)
+    finally:
+        _current_account.reset(account_token)
+        _result_counts.reset(result_counts_token)
+    return region_output, result_counts
+
+
+def get_account_region_names(role_sessions: AssumedRoleSessions, role_arn: str) -> tuple:
+    """
+    Returns AWS region names enabled for the account of the role and error message (if regions cannot be listed).
+    """
+    try:
+        return get_aws_region_names(all_regions=False, session=role_sessions.session(role_arn)), None
+    except ClientError as err:
+        return [], err.response['Error']['Message']
+
+
+def run_main_in_accounts(role_arns: list,
+                         aws_regions: list = None,
+                         ec2_action: str = None,
+                         max_workers: int = REGION_WORKERS_DEFAULT,
+                         role_sessions: AssumedRoleSessions = None,
+                         **kwargs) -> None:
+    """
+    Runs script's main func concurrently in all (account, region) pairs with sessions of the assumed IAM roles.
+    If aws_regions are not given, the regions enabled for each account are used.
+    The output is printed per account and region in the order in which they were given, followed by the summary
+    of the results in the account.
+    """
+    if not kwargs.get('policies'):
+        is_action_allowed(action=ec2_action)
+    role_sessions = role_sessions or AssumedRoleSessions()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if aws_regions is None:
+            accounts_regions = list(executor.map(partial(get_account_region_names, role_sessions), role_arns))
         else:
-            take_action = True
-    elif specified_tag and instance_tags:
-        # Perform an action ONLY if specified tag IS assigned to EC2 instance
-        take_action = check_tag_exist(tags=instance_tags, **specified_tag)
-    if not take_action:
-        return take_action
-    # Take action on EC2 instance if necessary
-    if action == 'terminate':
-        instance.terminate()
-        print(f'Instance with id "{instance.id}" terminated...')
-    elif action == 'stop':
+            accounts_regions = [(aws_regions, None)] * len(role_arns)
+        # All pairs are submitted at once, so the pool is shared by accounts and regions
+        accounts_futures = [
+            [executor.submit(run_main_in_account_region, role_sessions, role_arn, aws_region, ec2_action, **kwargs)
+             for aws_region in account_regions]
+            for role_arn, (account_regions, _) in zip(role_arns, accounts_regions)
+        ]
+        for role_arn, (account_regions, error_msg), futures in zip(role_arns, accounts_regions, accounts_futures):
+            echo(f'Account: {get_role_account_id(role_arn)}')
+            if error_msg:
+                echo(f'  Error: {error_msg}')
+                continue
+            account_result_counts = ResultCounts()
+            for aws_region, future in zip(account_regions, futures):
+                region_output, result_counts = future.result()
+                account_result_counts.update(result_counts)
+                echo(f'  Region: {aws_region}')
+                for line in region_output:
+                    echo(f'    {line}')
+            echo(f'  Summary: {account_result_counts.summary()}')
+
+
+class ServeStatus:
+    """
+    Status of serve mode - results of the sweeps exposed by the health and metrics endpoints.
+    """
+    def __init__(self, interval: float = SERVE_INTERVAL_DEFAULT, inventory: InstanceInventory = None):
+        self.interval = interval
+        self.inventory = inventory or InstanceInventory()
+        self.started_at = time.time()
+        self.sweeps = 0
+        self.failed_sweeps = 0
+        self.last_sweep_at = None
+        self.last_sweep_seconds = None
+        self.last_success_at = None
+        self.last_result_counts = ResultCounts()
+        self._lock = threading.Lock()
+
+    def record_sweep(self, seconds: float, result_counts: ResultCounts, failed: bool = False) -> None:
+        """
+        Records finished sweep.
+        """
+        with self._lock:
+            self.sweeps += 1
+            self.failed_sweeps += failed
+            self.last_sweep_at = time.time()
+            self.last_sweep_seconds = seconds
+            self.last_result_counts = result_counts
+            if not failed:
+                self.last_success_at = self.last_sweep_at
+
+    def is_healthy(self) -> bool:
+        """
+        Checks whether a sweep succeeded (or serve mode started) within SERVE_HEALTHY_INTERVALS intervals.
+        """
+        with self._lock:
+            return time.time() - (self.last_success_at or self.started_at) <= SERVE_HEALTHY_INTERVALS * self.interval
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the sweep metrics and the statistics of all sweeps (if collected) in Prometheus text exposition format.
+        """
+        prefix = STATS_METRIC_PREFIX
+        with self._lock:
+            metrics = [
+                ('sweeps_total', 'counter', 'Finished sweeps.', [('', self.sweeps)]),
+                ('sweep_failures_total', 'counter', 'Sweeps which failed in any region.', [('', self.failed_sweeps)]),
+                ('last_sweep_timestamp_seconds', 'gauge', 'Time of the last finished sweep.',
+                 [('', self.last_sweep_at)]),
+                ('last_success_timestamp_seconds', 'gauge', 'Time of the last successful sweep.',
+                 [('', self.last_success_at)]),
+                ('last_sweep_duration_seconds', 'gauge', 'Duration of the last sweep.',
+                 [('', self.last_sweep_seconds)]),
+                ('last_sweep_instances', 'gauge', 'Instances processed by the last sweep per outcome.',
+                 [(f'{{outcome="{outcome}"}}', count)
+                  for outcome, count in sorted(self.last_result_counts.counts.items())]),
+                ('inventory_instances', 'gauge', 'Instances in the in-memory inventory per region.',
+                 [(f'{{region="{region}"}}', count)
+                  for region, count in sorted(self.inventory.instances_count().items())])
+            ]
+        lines = []
+        for metric, metric_type, description, samples in metrics:
+            lines.extend([f'# HELP {prefix}_{metric} {description}', f'# TYPE {prefix}_{metric} {metric_type}'])
+            lines.extend(f'{prefix}_{metric}{labels} {value}' for labels, value in samples if value is not None)
+        metrics_text = '\n'.join(lines) + '\n'
+        if _stats is not None:
+            metrics_text += _stats.to_prometheus()
+        return metrics_text
+
+
+def start_status_server(status: ServeStatus, address: str = SERVE_ADDRESS_DEFAULT):
+    """
+    Starts HTTP server with /healthz and /metrics endpoints of serve mode in a background thread.
+    Returns the server (its shutdown() stops it).
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class StatusRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/healthz':
+                healthy = status.is_healthy()
+                self.send_text(200 if healthy else 503, 'ok\n' if healthy else 'unhealthy\n')
+            elif self.path == '/metrics':
+                self.send_text(200, status.to_prometheus(), content_type='text/plain; version=0.0.4')
+            else:
+                self.send_text(404, 'not found\n')
+
+        def send_text(self, code: int, text: str, content_type: str = 'text/plain') -> None:
+            body = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # Requests of health checks and metrics scrapes are not logged
+            pass
+
+    host, _, port = address.rpartition(':')
+    server = ThreadingHTTPServer((host, int(port)), StatusRequestHandler)
+    threading.Thread(target=server.serve_forever, name='status-server', daemon=True).start()
+    return server
+
+
+def sweep_region(aws_region: str,
+                 inventory: InstanceInventory,
+                 full_sync_interval: float = SNAPSHOT_FULL_SYNC_INTERVAL,
+                 **kwargs) -> tuple:
+    """
+    Refreshes the in-memory inventory of the region and runs script's main func with instances selected from it.
+    Returns the output lines produced for the region, counts of the reported results and whether the sweep failed.
+    """
+    region_output = []
+    result_counts = ResultCounts()
+    output_buffer_token = _output_buffer.set(region_output)
+    result_counts_token = _result_counts.set(result_counts)
+    try:
+        with phase_timer('snapshot_refresh'):
+            refresh_inventory_snapshot(ec2_client=get_ec2_client(aws_region=aws_region),
+                                       snapshot=inventory,
+                                       region=aws_region,
+                                       full_sync_interval=full_sync_interval)
+        main(aws_region=aws_region, inventory=inventory, **kwargs)
+    except ClientError as err:
+        error_msg = err.response['Error']['Message']
+        echo(f'Error: {error_msg}')
+        return region_output, result_counts, True
+    except BotoCoreError as err:
+        echo(f'Error: {err}')
+        return region_output, result_counts, True
+    finally:
+        _output_buffer.reset(output_buffer_token)
+        _result_counts.reset(result_counts_token)
+    return region_output, result_counts, False
+
+
+def serve(aws_regions: list,
+          ec2_action: str = None,
+          interval: float = SERVE_INTERVAL_DEFAULT,
+          max_workers: int = REGION_WORKERS_DEFAULT,
+          status: ServeStatus = None,
+          stop_event: threading.Event = None,
+          max_sweeps: int = None,
+          **kwargs) -> ServeStatus:
+    """
+    Serve mode - sweeps the specified AWS regions every interval seconds until stop_event is set (or max_sweeps
+    sweeps are finished). Clients and the in-memory inventory are kept between the sweeps, so a sweep re-fetches
+    only instances whose state changed since the previous one (all instances are re-fetched every
+    full_sync_interval seconds). The output of each sweep is printed per region, followed by the sweep summary.
+    Returns the status of serve mode.
+    """
+    if not kwargs.get('policies'):
+        is_action_allowed(action=ec2_action)
+    status = status or ServeStatus(interval=interval)
+    stop_event = stop_event or threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while not stop_event.is_set():
+            started_at = time.monotonic()
+            futures = [executor.submit(sweep_region, aws_region, status.inventory, ec2_action=ec2_action, **kwargs)
+                       for aws_region in aws_regions]
+            sweep_results = [future.result() for future in futures]
+            sweep_result_counts = ResultCounts()
+            for _, result_counts, _ in sweep_results:
+                sweep_result_counts.update(result_counts)
+            sweep_seconds = time.monotonic() - started_at
+            status.record_sweep(seconds=sweep_seconds,
+                                result_counts=sweep_result_counts,
+                                failed=any(failed for _, _, failed in sweep_results))
+            echo_regions_output(aws_regions=aws_regions,
+                                regions_output=(region_output for region_output, _, _ in sweep_results))
+            echo(f'Sweep {status.sweeps} finished in {sweep_seconds:.1f}s: {sweep_result_counts.summary()}')
+            if max_sweeps is not None and status.sweeps >= max_sweeps:
+                break
+            stop_event.wait(max(interval - sweep_seconds, 0))
+    return status
+
+
+class EventError(ValueError):
+    """
+    Raised when the event of EC2 instances is not valid.
+    """
+
+
+def parse_instance_event(event: Mapping) -> list:
+    """
+    Returns list of (region, instance id, state) tuples of EC2 instances from the EventBridge event -
+    "EC2 Instance State-change Notification" or RunInstances API call recorded by CloudTrail (state is None),
+    optionally wrapped in SNS notification. Other events are ignored (empty list is returned).
+    """
+    try:
+        if event.get('Type') == 'Notification' and 'Message' in event:
+            event = json.loads(event['Message'])
+        detail = event.get('detail') or {}
+        if event.get('detail-type') == 'EC2 Instance State-change Notification':
+            instance_events = [(event['region'], detail['instance-id'], detail.get('state'))]
+        elif event.get('detail-type') == 'AWS API Call via CloudTrail' and detail.get('eventName') == 'RunInstances':
+            instances = ((detail.get('responseElements') or {}).get('instancesSet') or {}).get('items') or []
+            region = detail.get('awsRegion') or event['region']
+            instance_events = [(region, instance['instanceId'], None) for instance in instances]
+        else:
+            return []
+    except (KeyError, TypeError, AttributeError, json.JSONDecodeError) as err:
+        raise EventError(f'Event of EC2 instances is not valid: {err!r}') from err
+    for region, _, _ in instance_events:
+        if not isinstance(region, str) or not AWS_REGION_NAME_PATTERN.fullmatch(region):
+            raise EventError(f'Event of EC2 instances has not valid AWS region name: {region}')
+    return instance_events
+
+
+def read_events_file(events_file: str) -> Iterator[tuple]:
+    """
+    Yields events (with None message receipt) from NDJSON file, an event per line ("-" reads stdin).
+    Lines which are not valid JSON are reported and skipped.
+    """
+    file = sys.stdin if events_file == '-' else open(events_file, encoding='utf-8')
+    try:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError as err:
+                echo(f'Skipping event on line {line_number}, it is not valid JSON: {err}')
+                continue
+            yield event, None
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def get_queue_region(queue_url: str) -> Optional[str]:
+    """
+    Returns AWS region of SQS queue URL (None if the URL does not contain region).
+    """
+    region_match = re.search(r'sqs[.-]([a-z]{2}(?:-[a-z]+)+-\d)\.', queue_url)
+    return region_match.group(1) if region_match else None
+
+
+def receive_queue_events(queue_url: str,
+                         stop_event: threading.Event = None,
+                         wait_time: int = SQS_WAIT_TIME,
+                         stop_when_empty: bool = False) -> Iterator[tuple]:
+    """
+    Yields events with receipt handles of the messages received from SQS queue with long polling, until stop_event
+    is set (or the queue is empty if stop_when_empty is True). Messages are deleted by delete_queue_messages()
+    once their events are processed. Messages which are not valid JSON are yielded as None events.
+    """
+    sqs_client = get_client_factory().client('sqs', region_name=get_queue_region(queue_url))
+    while stop_event is None or not stop_event.is_set():
+        messages = sqs_client.receive_message(QueueUrl=queue_url,
+                                              MaxNumberOfMessages=SQS_BATCH_SIZE,
+                                              WaitTimeSeconds=wait_time).get('Messages', [])
+        if not messages and stop_when_empty:
+            return
+        for message in messages:
+            try:
+                event = json.loads(message['Body'])
+            except json.JSONDecodeError as err:
+                echo(f'Skipping message {message["MessageId"]}, it is not valid JSON: {err}')
+                event = None
+            yield event, message['ReceiptHandle']
+
+
+def delete_queue_messages(queue_url: str, receipt_handles: list) -> None:
+    """
+    Deletes processed messages from SQS queue with batched requests. Failed deletions are reported.
+    """
+    sqs_client = get_client_factory().client('sqs', region_name=get_queue_region(queue_url))
+    for receipt_handles_chunk in split_into_chunks(items=receipt_handles, chunk_size=SQS_BATCH_SIZE):
+        response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': receipt_handle} for i, receipt_handle in enumerate(receipt_handles_chunk)
+        ])
+        for failed in response.get('Failed', []):
+            echo(f'Error: Message cannot be deleted from the queue: {failed.get("Message", failed["Code"])}')
+
+
+def process_event_region(aws_region: str, ec2_action: str = None, **kwargs) -> tuple:
+    """
+    Runs script's main func with instances from the events in the specified AWS region.
+    Returns the output lines produced for the region and whether processing failed (an error of the region or
+    a failed action on any instance).
+    """
+    region_output = []
+    result_counts = ResultCounts()
+    output_buffer_token = _output_buffer.set(region_output)
+    result_counts_token = _result_counts.set(result_counts)
+    try:
+        main(aws_region=aws_region, ec2_action=ec2_action, **kwargs)
+    except ClientError as err:
+        error_msg = err.response['Error']['Message']
+        echo(f'Error: {error_msg}')
+        return region_output, True
+    except BotoCoreError as err:
+        echo(f'Error: {err}')
+        return region_output, True
+    finally:
+        _output_buffer.reset(output_buffer_token)
+        _result_counts.reset(result_counts_token)
+    return region_output, bool(result_counts.counts.get('failed'))
+
+
+def consume_events(events: Iterable,
+                   ec2_action: str = None,
+                   aws_regions: list = None,
+                   batch_window: float = EVENT_BATCH_WINDOW_DEFAULT,
+                   acknowledge=None,
+                   **kwargs) -> None:
+    """
+    Event-driven mode - performs actions on EC2 instances from the events (see parse_instance_event()) instead of
+    scanning the regions. Instances from the events are collected into micro-batches (for batch_window seconds or
+    up to EVENT_BATCH_SIZE_MAX instances), then script's main func describes only these instances and performs
+    the actions in batches. Events of instances in states in which no action can be performed are dropped without
+    describing them. If aws_regions are given, events from other regions are ignored.
+    Message receipts of the processed events are passed to acknowledge func (e.g. delete_queue_messages()).
+    Receipts of events with instances in a region whose processing failed are not acknowledged, so that the events
+    are delivered again.
+    """
+    if not kwargs.get('policies'):
+        is_action_allowed(action=ec2_action)
+    actions = [policy.action for policy in kwargs['policies']] if kwargs.get('policies') else [ec2_action]
+    # Instance states in which any action can be performed (None - any state, list action shows all instances)
+    action_states = None if 'list' in actions else \
+        {state for action in actions for state in EC2_ACTION_INSTANCE_STATES[action]}
+    # Ids of instances from the events per region (dict keeps the order of events without duplicates)
+    batch_instance_ids = {}
+    # Regions of instances from the events per message receipt
+    batch_receipts = {}
+    batch_started_at = None
+
+    def process_batch() -> None:
+        batch_regions = list(batch_instance_ids)
+        regions_output = []
+        failed_regions = set()
+        for aws_region in batch_regions:
+            region_output, region_failed = process_event_region(aws_region=aws_region,
+                                                                ec2_action=ec2_action,
+                                                                instance_ids=list(batch_instance_ids[aws_region]),
+                                                                **kwargs)
+            regions_output.append(region_output)
+            if region_failed:
+                failed_regions.add(aws_region)
+        echo_regions_output(aws_regions=batch_regions, regions_output=regions_output)
+        batch_instance_ids.clear()
+        receipts = [receipt for receipt, regions in batch_receipts.items() if not regions & failed_regions]
+        if acknowledge is not None and receipts:
+            acknowledge(receipt_handles=receipts)
+        batch_receipts.clear()
+
+    for item in iterate_in_background(events):
+        if item is not None:
+            event, receipt = item
+            if receipt is not None:
+                batch_receipts[receipt] = set()
+            try:
+                instance_events = parse_instance_event(event) if event is not None else []
+            except EventError as err:
+                echo(f'Skipping event: {err}')
+                instance_events = []
+            for aws_region, instance_id, state in instance_events:
+                if aws_regions is not None and aws_region not in aws_regions:
+                    continue
+                if action_states is not None and state is not None and state not in action_states:
+                    continue
+                if batch_started_at is None:
+                    batch_started_at = time.monotonic()
+                batch_instance_ids.setdefault(aws_region, {})[instance_id] = None
+                if receipt is not None:
+                    batch_receipts[receipt].add(aws_region)
+        batch_size = sum(len(instance_ids) for instance_ids in batch_instance_ids.values())
+        # Receipts of events without any instance to process are acknowledged right away
+        if batch_size >= EVENT_BATCH_SIZE_MAX or \
+                (batch_started_at is not None and time.monotonic() - batch_started_at >= batch_window) or \
+                (not batch_size and batch_receipts):
+            process_batch()
+            batch_started_at = None
+    process_batch()
+
+
+async def async_call_with_rate_limit(rate_limiter: TokenBucketRateLimiter, coroutine_func, *args, **kwargs):
+    """
+    Awaits given coroutine func once a token is acquired from the rate limiter.
+    The call throttled by AWS is retried with exponential backoff.
+    """
+    import asyncio
+
+    for retry in range(THROTTLING_RETRIES_MAX + 1):
+        await rate_limiter.acquire_async()
         try:
-            instance.stop()
-            print(f'Instance with id "{instance.id}" stopped...')
+            result = await coroutine_func(*args, **kwargs)
         except ClientError as err:
-            # Handle exception when instance in 'pending' state
+            if not is_throttling_error(err) or retry == THROTTLING_RETRIES_MAX:
+                raise
+            rate_limiter.on_throttle()
+            await asyncio.sleep(min(2 ** retry * 0.1, 10))
+            continue
+        rate_limiter.on_success()
+        return result
+
+
+async def async_perform_batch_action(ec2_client,
+                                     action: str,
+                                     instance_ids: list,
+                                     rate_limiter: TokenBucketRateLimiter,
+                                     semaphore: 'asyncio.Semaphore',
+                                     tags: Mapping = None) -> dict:
+    """
+    Asyncio version of perform_batch_action().
+    """
+    ec2_api_call = get_action_api_call(ec2_client=ec2_client, action=action, tags=tags)
+    results = {}
+    chunks = split_into_chunks(items=instance_ids, chunk_size=EC2_ACTION_BATCH_SIZE)
+    while chunks:
+        chunk = chunks.pop(0)
+        started_at = time.monotonic()
+        try:
+            async with semaphore:
+                response = await async_call_with_rate_limit(rate_limiter, ec2_api_call, InstanceIds=chunk)
+        except ClientError as err:
+            if len(chunk) > 1 and is_instance_error(err):
+                # Isolate instance(s) responsible for the failure
+                middle = len(chunk) // 2
+                chunks[:0] = [chunk[:middle], chunk[middle:]]
+                continue
             error_msg = err.response['Error']['Message']
-            print(f'Error: {error_msg}. Try later...')
-    else:
-        # Only list effected instances
-        instance_current_state = instance.state['Name']
-        print(f'Instance id: "{instance.id}", current state: "{instance_current_state}"')
-    return take_action
+            report_result(f'Error: {error_msg}. Try later...', chunk,
+                          action=action, outcome='failed', latency_ms=get_latency_ms(started_at), error=error_msg)
+            results.update({instance_id: False for instance_id in chunk})
+            continue
+        latency_ms = get_latency_ms(started_at)
+        state_changes = parse_state_changes(response or {})
+        for instance_id in chunk:
+            state_before, state_after = state_changes.get(instance_id, (None, None))
+            report_result(f'Instance with id "{instance_id}" {EC2_ACTIONS_PAST_TENSE[action]}...', [instance_id],
+                          action=action, state_before=state_before, state_after=state_after, outcome='succeeded',
+                          latency_ms=latency_ms)
+            results[instance_id] = True
+    return results
 
 
-def main(aws_region, ec2_action, **kwargs) -> None:
+async def async_perform_instance_action(ec2_client,
+                                        action: str,
+                                        instance_id: str,
+                                        rate_limiter: TokenBucketRateLimiter,
+                                        semaphore: 'asyncio.Semaphore',
+                                        tags: Mapping = None) -> None:
     """
-    Script's main func.
+    Asyncio version of perform_instance_action().
     """
-    is_action_allowed(action=ec2_action)
-    # Get additional func args
-    additional_args = kwargs
-    # Get all EC2 instances in specified AWS region
-    ec2 = boto3.resource('ec2', region_name=aws_region)
-    ec2_instances_all = ec2.instances.all()
-    # Helper variable indicating whether an action has been performed on any instance
-    ec2_instance_action_taken = False
-    for instance in ec2_instances_all:
-        instance_current_state = instance.state['Name']
-        instance_proper_state: bool = check_proper_instance_state(
-            action=ec2_action,
-            ec2_current_state=instance_current_state
-        )
-        # Perform action on EC2 instance if it is in the correct state
-        if instance_proper_state:
-            instance_state_changed: bool = perform_action_on_instance(action=ec2_action,
-                                                                      instance=instance,
-                                                                      **additional_args)
-            if instance_state_changed:
-                ec2_instance_action_taken = True
-    if not ec2_instance_action_taken:
-        print('Nothing to do...')
+    ec2_api_call = get_action_api_call(ec2_client=ec2_client, action=action, tags=tags)
+    started_at = time.monotonic()
+    try:
+        async with semaphore:
+            response = await async_call_with_rate_limit(rate_limiter, ec2_api_call, InstanceIds=[instance_id])
+    except ClientError as err:
+        # Handle exception when e.g. instance in 'pending' state
+        error_msg = err.response['Error']['Message']
+        report_result(f'Error: {error_msg}. Try later...', [instance_id],
+                      action=action, outcome='failed', latency_ms=get_latency_ms(started_at), error=error_msg)
+        return
+    state_before, state_after = parse_state_changes(response or {}).get(instance_id, (None, None))
+    report_result(f'Instance with id "{instance_id}" {EC2_ACTIONS_PAST_TENSE[action]}...', [instance_id],
+                  action=action, state_before=state_before, state_after=state_after, outcome='succeeded',
+                  latency_ms=get_latency_ms(started_at))
+
+
+async def async_process_region(ec2_client,
+                               policies: list,
+                               rate_limiter: TokenBucketRateLimiter,
+                               semaphore: 'asyncio.Semaphore',
+                               per_instance: bool = False,
+                               max_pending_tasks: int = 4 * ASYNC_CONCURRENCY_DEFAULT,
+                               tags: Mapping = None) -> None:
+    """
+    Scans EC2 instances in the region with the async client and performs actions of matching policies.
+    Actions on instances from a page are started before the next page is fetched.
+    """
+    import asyncio
+
+    ec2_filters = build_policies_filters(policies=policies)
+    get_instance_action = get_scanned_instance_action(policies=policies)
+    ec2_instances_selected_count = 0
+    ec2_instance_ids_batches = {action: [] for action in EC2_ACTIONS_PAST_TENSE}
+    action_tasks = set()
+
+    async def start_action_task(coroutine) -> None:
+        nonlocal action_tasks
+        # Number of pending tasks is bounded, so memory usage does not depend on the number of instances
+        if len(action_tasks) >= max_pending_tasks:
+            done_tasks, action_tasks = await asyncio.wait(action_tasks, return_when=asyncio.FIRST_COMPLETED)
+            for done_task in done_tasks:
+                done_task.result()
+        action_tasks.add(asyncio.create_task(coroutine))
+
+    async def dispatch_batch(action: str) -> None:
+        ec2_instance_ids_batch = ec2_instance_ids_batches[action]
+        if ec2_instance_ids_batch:
+            await start_action_task(async_perform_batch_action(ec2_client=ec2_client,
+                                                               action=action,
+                                                               instance_ids=ec2_instance_ids_batch.copy(),
+                                                               rate_limiter=rate_limiter,
+                                                               semaphore=semaphore,
+                                                               tags=tags))
+            ec2_instance_ids_batch.clear()
+
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=ec2_filters, PaginationConfig={'PageSize': EC2_DESCRIBE_PAGE_SIZE})
+    async for page in pages:
+        for instance in parse_instance_records(page=page):
+            ec2_instance_action = get_instance_action(instance)
+            if not ec2_instance_action:
+                continue
+            if ec2_instance_action in EC2_TAG_ACTIONS and \
+                    not is_tags_change_needed(instance=instance, action=ec2_instance_action, tags=tags):
+                continue
+            ec2_instances_selected_count += 1
+            if ec2_instance_action == 'list':
+                # Only list effected instances
+                report_result(f'Instance id: "{instance.id}", current state: "{instance.state}"', [instance.id],
+                              action='list', state_before=instance.state, state_after=instance.state,
+                              outcome='listed')
+            elif per_instance:
+                await start_action_task(async_perform_instance_action(ec2_client=ec2_client,
+                                                                      action=ec2_instance_action,
+                                                                      instance_id=instance.id,
+                                                                      rate_limiter=rate_limiter,
+                                                                      semaphore=semaphore,
+                                                                      tags=tags))
+            else:
+                ec2_instance_ids_batches[ec2_instance_action].append(instance.id)
+        # Dispatch instances collected so far before the next page is fetched
+        for batch_action in ec2_instance_ids_batches:
+            await dispatch_batch(action=batch_action)
+    if action_tasks:
+        await asyncio.gather(*action_tasks)
+    if not ec2_instances_selected_count:
+        echo('Nothing to do...')
+
+
+async def async_main(aws_regions: list,
+                     ec2_action: str = None,
+                     max_concurrency: int = ASYNC_CONCURRENCY_DEFAULT,
+                     action_rate: float = ACTION_RATE_DEFAULT,
+                     per_instance: bool = False,
+                     policies: list = None,
+                     tags: Mapping = None,
+                     expiry_tag: str = EXPIRY_TAG_KEY_DEFAULT,
+                     grace_period: float = EXPIRY_GRACE_PERIOD_DEFAULT,
+                     **kwargs) -> list:
+    """
+    Asyncio engine - runs script's main func in the specified AWS regions as coroutines on a single thread.
+    The number of in-flight AWS API requests is limited by max_concurrency.
+    Returns the output lines produced for each region.
+    """
+    import asyncio
+
+    # Optional dependency - imported only when the asyncio engine is used
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+
+    if policies is None:
+        is_action_allowed(action=ec2_action)
+        policies = [Policy(action=ec2_action, selector=kwargs)]
+    if any(policy.action == 'mark' for policy in policies):
+        tags = build_expiry_tags(expiry_tag=expiry_tag, grace_period=grace_period)
+    session = get_session()
+    # Client settings are shared with the threads engine
+    client_config = get_client_factory().build_config(config_class=AioConfig)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_region(aws_region: str) -> list:
+        region_output = []
+        _output_buffer.set(region_output)
+        _current_region.set(aws_region)
+        try:
+            async with session.create_client('ec2', region_name=aws_region, config=client_config) as ec2_client:
+                instrument_client(ec2_client)
+                await async_process_region(ec2_client=ec2_client,
+                                           policies=policies,
+                                           rate_limiter=TokenBucketRateLimiter(rate=action_rate),
+                                           semaphore=semaphore,
+                                           per_instance=per_instance,
+                                           max_pending_tasks=4 * max_concurrency,
+                                           tags=tags)
+        except ClientError as err:
+            error_msg = err.response['Error']['Message']
+            echo(f'Error: {error_msg}')
+        return region_output
+
+    # Each task runs in a copy of the current context, so output buffers are isolated per region
+    return await asyncio.gather(*(run_region(aws_region) for aws_region in aws_regions))
+
+
+def run_async_engine(aws_regions: list, **kwargs) -> None:
+    """
+    Runs the asyncio engine and prints the output in the same format as the threaded engine.
+    """
+    import asyncio
+
+    regions_output = asyncio.run(async_main(aws_regions=aws_regions, **kwargs))
+    if len(aws_regions) == 1:
+        for line in regions_output[0]:
+            echo(line)
+    else:
+        echo_regions_output(aws_regions=aws_regions, regions_output=regions_output)
 
 
 if __name__ == '__main__':
@@ -137,13 +3199,45 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The EC2 tags actions script')
     # Positional argument
     parser.add_argument('action',
-                        choices=['stop', 'terminate', 'list'],
-                        help='action to be performed on instances')
+                        nargs='?',
+                        choices=['stop', 'terminate', 'tag', 'untag', 'mark', 'list', 'export', 'query'],
+                        help='action to be performed on instances (not used with --policy-file), '
+                             'tag and untag assign or remove --tags, mark tags instances with expiry time, '
+                             'export writes all instances to the file, query lists instances from exported file')
     parser.add_argument('-r',
                         '--region',
-                        default=AWS_REGION_DEFAULT,
+                        action='append',
                         type=str,
-                        help=f'AWS region in which instances are deployed (default: {AWS_REGION_DEFAULT})')
+                        help=f'AWS region in which instances are deployed, can be repeated '
+                             f'(default: {AWS_REGION_DEFAULT})')
+    parser.add_argument('--all-regions',
+                        action='store_true',
+                        help='perform action in all AWS regions enabled for the account')
+    parser.add_argument('--role-arn',
+                        action='append',
+                        metavar='ARN',
+                        help='perform action in the account of assumed IAM role, can be repeated')
+    parser.add_argument('--role-arns-file',
+                        metavar='FILE',
+                        help='perform action in the accounts of assumed IAM roles from the file (an ARN per line)')
+    parser.add_argument('--region-workers',
+                        default=REGION_WORKERS_DEFAULT,
+                        type=int,
+                        help='max number of AWS regions (or account and region pairs with assumed roles) processed '
+                             f'concurrently (default: {REGION_WORKERS_DEFAULT})')
+    parser.add_argument('--per-instance',
+                        action='store_true',
+                        help='perform action with a separate API request per instance instead of batched requests')
+    parser.add_argument('--action-workers',
+                        default=ACTION_WORKERS_DEFAULT,
+                        type=int,
+                        help=f'max number of per-instance actions performed concurrently '
+                             f'(default: {ACTION_WORKERS_DEFAULT})')
+    parser.add_argument('--action-rate',
+                        default=ACTION_RATE_DEFAULT,
+                        type=float,
+                        help=f'initial rate (requests per second) of action API requests, adjusted automatically '
+                             f'to AWS API throttling (default: {ACTION_RATE_DEFAULT})')
     # 1st "mutually exclusive" group of args
     parser.add_argument('-n',
                         '--no-name',
@@ -158,36 +3252,480 @@ if __name__ == '__main__':
                         '--tag-value',
                         type=str,
                         help='perform action on instances with specified tag value')
+    # 3rd "mutually exclusive" group of args
+    parser.add_argument('-e',
+                        '--expression',
+                        type=str,
+                        help='perform action on instances matching tag expression, '
+                             'e.g. "Env=Test AND NOT Owner=* AND Project~^tmp-"')
+    # 4th "mutually exclusive" group of args
+    parser.add_argument('--expired',
+                        action='store_true',
+                        help='perform action on instances whose expiry time (--expiry-tag set by mark action) '
+                             'has passed')
+    # 5th "mutually exclusive" group of args
+    parser.add_argument('-p',
+                        '--policy-file',
+                        type=str,
+                        help='evaluate cleanup policies (actions with selectors) from JSON or YAML file '
+                             'in a single scan')
+
+    parser.add_argument('--tags',
+                        action='append',
+                        metavar='KEY=VALUE[,KEY=VALUE...]',
+                        help='comma-separated tags assigned by tag action or removed by untag action (KEY alone '
+                             'removes the tag with any value), can be repeated')
+    parser.add_argument('--expiry-tag',
+                        default=EXPIRY_TAG_KEY_DEFAULT,
+                        metavar='KEY',
+                        help=f'key of the tag with expiry time set by mark action and checked by --expired '
+                             f'(default: {EXPIRY_TAG_KEY_DEFAULT})')
+    parser.add_argument('--grace-period',
+                        default=EXPIRY_GRACE_PERIOD_DEFAULT,
+                        type=float,
+                        help=f'number of seconds from marking instances to their expiry time '
+                             f'(default: {EXPIRY_GRACE_PERIOD_DEFAULT})')
+    parser.add_argument('--wait',
+                        action='store_true',
+                        help='wait until stopped or terminated instances reach the target state')
+    parser.add_argument('--wait-timeout',
+                        default=WAIT_TIMEOUT_DEFAULT,
+                        type=float,
+                        help=f'max number of seconds to wait with --wait (default: {WAIT_TIMEOUT_DEFAULT:g})')
+    parser.add_argument('-f',
+                        '--file',
+                        type=str,
+                        help='file written by export action ("{region}" is replaced with region name) or --dry-run, '
+                             'or read by query action or --apply-plan')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='check stop and terminate actions (including permissions) with DryRun requests '
+                             'and write the plan to -f/--file')
+    parser.add_argument('--apply-plan',
+                        action='store_true',
+                        help='perform actions from the plan file (-f/--file) written by --dry-run without scanning '
+                             'instances')
+    parser.add_argument('--output',
+                        choices=['text', *ResultWriter.FORMATS],
+                        default='text',
+                        help='output format, json, ndjson and csv stream a record per instance to stdout '
+                             '(other messages are printed to stderr) (default: text)')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='print performance statistics (time of phases, AWS API calls) at the end of the run')
+    parser.add_argument('--stats-prometheus',
+                        type=str,
+                        metavar='FILE',
+                        help='write performance statistics to Prometheus textfile (node exporter textfile collector)')
+    parser.add_argument('--stats-statsd',
+                        type=str,
+                        metavar='HOST:PORT',
+                        help='send performance statistics to StatsD server over UDP')
+    parser.add_argument('--max-pool-connections',
+                        default=CLIENT_SETTINGS_DEFAULT['max_pool_connections'],
+                        type=int,
+                        help=f'max number of connections kept in the pool of each AWS API client '
+                             f'(default: {CLIENT_SETTINGS_DEFAULT["max_pool_connections"]})')
+    parser.add_argument('--connect-timeout',
+                        default=CLIENT_SETTINGS_DEFAULT['connect_timeout'],
+                        type=float,
+                        help=f'AWS API connection timeout in seconds '
+                             f'(default: {CLIENT_SETTINGS_DEFAULT["connect_timeout"]})')
+    parser.add_argument('--read-timeout',
+                        default=CLIENT_SETTINGS_DEFAULT['read_timeout'],
+                        type=float,
+                        help=f'AWS API read timeout in seconds (default: {CLIENT_SETTINGS_DEFAULT["read_timeout"]})')
+    parser.add_argument('--retry-mode',
+                        choices=['legacy', 'standard', 'adaptive'],
+                        default=CLIENT_SETTINGS_DEFAULT['retry_mode'],
+                        help=f'retry mode of AWS API clients (default: {CLIENT_SETTINGS_DEFAULT["retry_mode"]})')
+    parser.add_argument('--max-attempts',
+                        default=CLIENT_SETTINGS_DEFAULT['max_attempts'],
+                        type=int,
+                        help=f'max number of attempts of AWS API request '
+                             f'(default: {CLIENT_SETTINGS_DEFAULT["max_attempts"]})')
+    parser.add_argument('--engine',
+                        choices=['threads', 'asyncio'],
+                        default='threads',
+                        help='execution engine, asyncio engine requires aiobotocore package (default: threads)')
+    parser.add_argument('--max-concurrency',
+                        default=ASYNC_CONCURRENCY_DEFAULT,
+                        type=int,
+                        help=f'max number of in-flight AWS API requests in asyncio engine '
+                             f'(default: {ASYNC_CONCURRENCY_DEFAULT})')
+    parser.add_argument('--max-staleness',
+                        type=float,
+                        help='answer list action from the local inventory snapshot if it is not older than given '
+                             'number of seconds, otherwise refresh the snapshot first')
+    parser.add_argument('--refresh-snapshot',
+                        action='store_true',
+                        help='refresh the local inventory snapshot (only instances whose state changed are re-fetched) '
+                             'and answer list action from it')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='run as a daemon sweeping the regions periodically with in-memory inventory, '
+                             'serving /healthz and /metrics over HTTP')
+    parser.add_argument('--sweep-interval',
+                        default=SERVE_INTERVAL_DEFAULT,
+                        type=float,
+                        help=f'seconds between starts of sweeps in serve mode (default: {SERVE_INTERVAL_DEFAULT:.0f})')
+    parser.add_argument('--full-sync-interval',
+                        default=SNAPSHOT_FULL_SYNC_INTERVAL,
+                        type=float,
+                        help='seconds after which all instances are re-fetched instead of only the changed ones '
+                             f'in serve mode (default: {SNAPSHOT_FULL_SYNC_INTERVAL})')
+    parser.add_argument('--events-queue',
+                        metavar='URL',
+                        help='perform action on instances from EC2 state-change and RunInstances events received '
+                             'from SQS queue instead of scanning the regions')
+    parser.add_argument('--events-file',
+                        metavar='FILE',
+                        help='perform action on instances from events in NDJSON file ("-" reads stdin) '
+                             'instead of scanning the regions')
+    parser.add_argument('--event-batch-window',
+                        default=EVENT_BATCH_WINDOW_DEFAULT,
+                        type=float,
+                        help='seconds for which instances from events are collected before they are described '
+                             f'(default: {EVENT_BATCH_WINDOW_DEFAULT})')
+    parser.add_argument('--serve-address',
+                        default=SERVE_ADDRESS_DEFAULT,
+                        metavar='HOST:PORT',
+                        help=f'address of health and metrics HTTP endpoints in serve mode '
+                             f'(default: {SERVE_ADDRESS_DEFAULT})')
 
     args = parser.parse_args()
-    # Simple mutually exclusive check - ec2_tags [-n | [-k abc -v def]]
-    if args.no_name and (args.tag_key or args.tag_value):
-        parser.error('-n/--no-name and pair of -k/--tag-key, -v/--tag-value are mutually exclusive')
+    # Simple mutually exclusive check - ec2_tags [-n | [-k abc -v def] | -e expr | --expired | -p file]
+    if sum([args.no_name, bool(args.tag_key or args.tag_value), bool(args.expression), args.expired,
+            bool(args.policy_file)]) > 1:
+        parser.error('-n/--no-name, pair of -k/--tag-key, -v/--tag-value, -e/--expression, --expired and '
+                     '-p/--policy-file are mutually exclusive')
+        sys.exit(1)
+    if args.apply_plan:
+        if args.action or args.policy_file or args.no_name or args.tag_key or args.tag_value or args.expression or \
+                args.expired:
+            parser.error('--apply-plan cannot be used with action, selectors or -p/--policy-file')
+            sys.exit(1)
+        if args.region or args.all_regions:
+            parser.error('--apply-plan performs actions in regions from the plan, -r/--region and --all-regions '
+                         'cannot be used')
+            sys.exit(1)
+    # Checks whether action is given only without policy file
+    elif bool(args.action) == bool(args.policy_file):
+        parser.error('either action or -p/--policy-file must be given')
+        sys.exit(1)
+    if args.policy_file:
+        try:
+            ec2_policies = load_policies(policy_file=args.policy_file)
+        except PolicyError as err:
+            parser.error(str(err))
+            sys.exit(1)
+    if args.action in ('export', 'query') and not args.file:
+        parser.error(f'-f/--file must be given with {args.action} action')
+        sys.exit(1)
+    if (args.dry_run or args.apply_plan) and not args.file:
+        parser.error('-f/--file must be given with --dry-run and --apply-plan')
         sys.exit(1)
+    if args.dry_run:
+        if args.apply_plan or args.action in ('tag', 'untag', 'mark', 'list', 'export', 'query') or args.wait:
+            parser.error('--dry-run can be used only with stop and terminate actions (or policy file) '
+                         'without --apply-plan and --wait')
+            sys.exit(1)
+        if args.policy_file and any(policy.action in EC2_TAG_ACTIONS for policy in ec2_policies):
+            parser.error('--dry-run cannot be used with policy file containing mark policy')
+            sys.exit(1)
+        if args.engine == 'asyncio':
+            parser.error('--dry-run is not supported by asyncio engine')
+            sys.exit(1)
+    if args.apply_plan:
+        if args.engine == 'asyncio':
+            parser.error('--apply-plan is not supported by asyncio engine')
+            sys.exit(1)
+        try:
+            ec2_applied_plan = ActionPlan.load(plan_file=args.file)
+        except PlanError as err:
+            parser.error(str(err))
+            sys.exit(1)
+    if args.action == 'export' and (args.no_name or args.tag_key or args.expression or args.expired):
+        parser.error('export action writes all instances, selectors cannot be used')
+        sys.exit(1)
+    if args.max_staleness is not None or args.refresh_snapshot:
+        if args.max_staleness is not None and args.max_staleness < 0:
+            parser.error('--max-staleness must not be a negative number')
+            sys.exit(1)
+        actions = [policy.action for policy in ec2_policies] if args.policy_file else [args.action]
+        if any(action != 'list' for action in actions):
+            parser.error('--max-staleness and --refresh-snapshot can be used only with list action')
+            sys.exit(1)
+    if args.wait:
+        if args.action in ('tag', 'untag', 'mark', 'list', 'export', 'query'):
+            parser.error('--wait can be used only with stop and terminate actions')
+            sys.exit(1)
+        if args.engine == 'asyncio':
+            parser.error('--wait is not supported by asyncio engine')
+            sys.exit(1)
+        if args.wait_timeout <= 0:
+            parser.error('--wait-timeout must be a positive number')
+            sys.exit(1)
+    if args.action in ('tag', 'untag'):
+        try:
+            ec2_action_tags = parse_tags(tag_args=args.tags or [], action=args.action)
+        except TagsError as err:
+            parser.error(str(err))
+            sys.exit(1)
+    elif args.tags:
+        parser.error('--tags can be used only with tag and untag actions')
+        sys.exit(1)
+    if args.action == 'mark' and args.expired:
+        parser.error('mark action cannot be used with --expired')
+        sys.exit(1)
+    if not args.expiry_tag or args.expiry_tag.lower().startswith('aws:'):
+        parser.error('--expiry-tag must be a tag key without reserved aws: prefix')
+        sys.exit(1)
+    if args.grace_period < 0:
+        parser.error('--grace-period must not be a negative number')
+        sys.exit(1)
+    if args.expression:
+        try:
+            ec2_tag_expression = CompiledTagExpression(args.expression)
+        except TagExpressionError as err:
+            parser.error(str(err))
+            sys.exit(1)
     # Checks whether -k and -v tags have been specified together
     if bool(args.tag_key) ^ bool(args.tag_value):
         parser.error('-k/--tag-key and -v/--tag-value must be given together')
         sys.exit(1)
-    # Checks whether provided -r value is valid AWS region name
-    if not check_aws_region(region_specified=args.region):
-        parser.error(f'value {args.region} is not valid AWS region name')
+    if args.all_regions and args.region:
+        parser.error('-r/--region and --all-regions are mutually exclusive')
         sys.exit(1)
+    if args.action == 'export' and (args.all_regions or len(args.region or []) > 1) and '{region}' not in args.file:
+        parser.error('-f/--file must contain "{region}" placeholder when exporting multiple regions')
+        sys.exit(1)
+    ec2_role_arns = list(args.role_arn or [])
+    if args.role_arns_file:
+        try:
+            with open(args.role_arns_file, encoding='utf-8') as role_arns_file:
+                ec2_role_arns.extend(line.strip() for line in role_arns_file if line.strip())
+        except OSError as err:
+            parser.error(f'Cannot read role ARNs file: {err}')
+            sys.exit(1)
+    if args.role_arns_file and not ec2_role_arns:
+        parser.error('--role-arns-file does not contain any role ARN')
+        sys.exit(1)
+    # Remove duplicates preserving the order of given roles
+    ec2_role_arns = list(dict.fromkeys(ec2_role_arns))
+    if ec2_role_arns:
+        for role_arn in ec2_role_arns:
+            if not ROLE_ARN_PATTERN.fullmatch(role_arn):
+                parser.error(f'value {role_arn} is not valid IAM role ARN')
+                sys.exit(1)
+        if args.action in ('export', 'query') or args.dry_run or args.apply_plan or \
+                args.max_staleness is not None or args.refresh_snapshot:
+            parser.error('assumed roles can be used only with stop, terminate, tag, untag, mark and list actions '
+                         '(or policy file) without --dry-run, --apply-plan and inventory snapshot')
+            sys.exit(1)
+        if args.engine == 'asyncio':
+            parser.error('assumed roles are not supported by asyncio engine')
+            sys.exit(1)
+    if args.region_workers < 1 or args.action_workers < 1 or args.action_rate <= 0 or args.max_concurrency < 1:
+        parser.error('--region-workers, --action-workers, --action-rate and --max-concurrency must be positive numbers')
+        sys.exit(1)
+    if args.max_pool_connections < 1 or args.connect_timeout <= 0 or args.read_timeout <= 0 or args.max_attempts < 1:
+        parser.error('--max-pool-connections, --connect-timeout, --read-timeout and --max-attempts '
+                     'must be positive numbers')
+        sys.exit(1)
+    if args.stats_statsd and not re.fullmatch(r'[^:]+:\d+', args.stats_statsd):
+        parser.error('--stats-statsd must be given as HOST:PORT')
+        sys.exit(1)
+    if args.serve:
+        if args.action in ('export', 'query') or args.dry_run or args.apply_plan or ec2_role_arns or \
+                args.max_staleness is not None or args.refresh_snapshot:
+            parser.error('--serve can be used only with stop, terminate, tag, untag, mark and list actions '
+                         '(or policy file) without --dry-run, --apply-plan, assumed roles and local inventory snapshot')
+            sys.exit(1)
+        if args.engine == 'asyncio':
+            parser.error('--serve is not supported by asyncio engine')
+            sys.exit(1)
+        if args.sweep_interval <= 0 or args.full_sync_interval <= 0:
+            parser.error('--sweep-interval and --full-sync-interval must be positive numbers')
+            sys.exit(1)
+        if not re.fullmatch(r'[^:]*:\d+', args.serve_address):
+            parser.error('--serve-address must be given as HOST:PORT')
+            sys.exit(1)
+    if args.events_queue or args.events_file:
+        if args.events_queue and args.events_file:
+            parser.error('--events-queue and --events-file are mutually exclusive')
+            sys.exit(1)
+        if args.action in ('export', 'query') or args.dry_run or args.apply_plan or ec2_role_arns or args.serve or \
+                args.max_staleness is not None or args.refresh_snapshot:
+            parser.error('events can be used only with stop, terminate, tag, untag, mark and list actions '
+                         '(or policy file) without --dry-run, --apply-plan, assumed roles, --serve and local inventory '
+                         'snapshot')
+            sys.exit(1)
+        if args.engine == 'asyncio':
+            parser.error('events are not supported by asyncio engine')
+            sys.exit(1)
+        if args.event_batch_window < 0:
+            parser.error('--event-batch-window must not be a negative number')
+            sys.exit(1)
+    # Metrics endpoint of serve mode exposes the statistics of all sweeps
+    collect_stats = args.stats or args.stats_prometheus or args.stats_statsd or args.serve
+    if collect_stats:
+        ec2_stats = RunStats()
+        set_stats(ec2_stats)
+        run_started_at = time.perf_counter()
+    configure_client_factory(max_pool_connections=args.max_pool_connections,
+                             connect_timeout=args.connect_timeout,
+                             read_timeout=args.read_timeout,
+                             retry_mode=args.retry_mode,
+                             max_attempts=args.max_attempts)
+    if args.engine == 'asyncio':
+        if args.action in ('export', 'query') or args.max_staleness is not None or args.refresh_snapshot:
+            parser.error('asyncio engine supports only stop, terminate, tag, untag, mark and list actions without '
+                         'inventory snapshot')
+            sys.exit(1)
+        try:
+            import aiobotocore  # noqa: F401
+        except ImportError:
+            parser.error('aiobotocore package is required for asyncio engine')
+            sys.exit(1)
+    if args.action == 'query':
+        # Query is answered offline, AWS region is not used
+        aws_regions = []
+    elif args.apply_plan:
+        aws_regions = list(ec2_applied_plan.regions)
+    elif (args.events_queue or args.events_file) and not args.region:
+        # Events from all regions are processed
+        aws_regions = None
+    elif args.all_regions and ec2_role_arns:
+        # Regions enabled for each account are listed with the account's assumed role
+        aws_regions = None
+    elif args.all_regions:
+        with phase_timer('regions'):
+            aws_regions = get_aws_region_names(all_regions=False)
+    else:
+        # Remove duplicates preserving the order of given regions
+        aws_regions = list(dict.fromkeys(args.region or [AWS_REGION_DEFAULT]))
+        # Checks whether provided -r values are valid AWS region names
+        with phase_timer('regions'):
+            for aws_region in aws_regions:
+                if not check_aws_region(region_specified=aws_region):
+                    parser.error(f'value {aws_region} is not valid AWS region name')
+                    sys.exit(1)
 
     # Get data from argparse
-    main_attrs = {
-        'aws_region': args.region,
-        'ec2_action': args.action
-    }
-    if args.no_name:
-        main_attrs['ec2_no_name_tag'] = args.no_name
+    selector_attrs = {}
+    if args.policy_file:
+        selector_attrs['policies'] = ec2_policies
+    elif args.no_name:
+        selector_attrs['ec2_no_name_tag'] = args.no_name
+    elif args.expression:
+        selector_attrs['ec2_tag_expression'] = ec2_tag_expression
+    elif args.expired:
+        selector_attrs['ec2_expired_tag'] = args.expiry_tag
     elif args.tag_key and args.tag_value:
-        main_attrs['ec2_tag'] = {
+        selector_attrs['ec2_tag'] = {
             'tag_key': args.tag_key,
             'tag_value': args.tag_value
         }
     else:
         # Default option - EC2 instances without assigned tags
-        main_attrs['ec2_no_tags'] = True
+        selector_attrs['ec2_no_tags'] = True
+    main_attrs = {
+        'ec2_action': args.action,
+        'per_instance': args.per_instance,
+        'action_workers': args.action_workers,
+        'action_rate': args.action_rate,
+        'max_staleness': args.max_staleness,
+        'refresh_snapshot': args.refresh_snapshot,
+        'export_file': args.file,
+        'wait': args.wait,
+        'wait_timeout': args.wait_timeout,
+        'dry_run': args.dry_run,
+        'expiry_tag': args.expiry_tag,
+        'grace_period': args.grace_period,
+        **selector_attrs
+    }
+    if args.action in ('tag', 'untag'):
+        main_attrs['tags'] = ec2_action_tags
+    if args.dry_run:
+        ec2_plan = main_attrs['plan'] = ActionPlan()
+    if args.apply_plan:
+        main_attrs['applied_plan'] = ec2_applied_plan
 
+    if args.output != 'text':
+        ec2_result_writer = ResultWriter(output_format=args.output)
+        set_result_writer(ec2_result_writer)
     # Run script's main func
-    main(**main_attrs)
+    if args.action == 'query':
+        query_exported_instances(export_file=args.file, **selector_attrs)
+    elif args.engine == 'asyncio':
+        run_async_engine(aws_regions=aws_regions,
+                         ec2_action=args.action,
+                         max_concurrency=args.max_concurrency,
+                         action_rate=args.action_rate,
+                         per_instance=args.per_instance,
+                         tags=main_attrs.get('tags'),
+                         expiry_tag=args.expiry_tag,
+                         grace_period=args.grace_period,
+                         **selector_attrs)
+    elif args.events_queue or args.events_file:
+        if args.events_queue:
+            # Events received so far are processed before the consumer stops
+            ec2_stop_event = threading.Event()
+            for stop_signal in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(stop_signal, lambda signum, frame: ec2_stop_event.set())
+            ec2_events = receive_queue_events(queue_url=args.events_queue, stop_event=ec2_stop_event)
+            ec2_acknowledge = partial(delete_queue_messages, queue_url=args.events_queue)
+        else:
+            ec2_events = read_events_file(events_file=args.events_file)
+            ec2_acknowledge = None
+        consume_events(events=ec2_events,
+                       aws_regions=aws_regions,
+                       batch_window=args.event_batch_window,
+                       acknowledge=ec2_acknowledge,
+                       **main_attrs)
+    elif args.serve:
+        ec2_serve_status = ServeStatus(interval=args.sweep_interval)
+        try:
+            ec2_status_server = start_status_server(status=ec2_serve_status, address=args.serve_address)
+        except OSError as err:
+            parser.error(f'Cannot serve on {args.serve_address}: {err}')
+            sys.exit(1)
+        echo(f'Serving health and metrics on http://{args.serve_address}...')
+        # Current sweep is finished before the daemon stops
+        ec2_stop_event = threading.Event()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(stop_signal, lambda signum, frame: ec2_stop_event.set())
+        try:
+            serve(aws_regions=aws_regions,
+                  interval=args.sweep_interval,
+                  max_workers=args.region_workers,
+                  status=ec2_serve_status,
+                  stop_event=ec2_stop_event,
+                  full_sync_interval=args.full_sync_interval,
+                  **main_attrs)
+        finally:
+            ec2_status_server.shutdown()
+    elif ec2_role_arns:
+        run_main_in_accounts(role_arns=ec2_role_arns,
+                             aws_regions=aws_regions,
+                             max_workers=args.region_workers,
+                             **main_attrs)
+    elif len(aws_regions) == 1:
+        main(aws_region=aws_regions[0], **main_attrs)
+    else:
+        run_main_in_regions(aws_regions=aws_regions, max_workers=args.region_workers, **main_attrs)
+    if args.dry_run:
+        ec2_plan.save(plan_file=args.file)
+        echo(f'Plan written to "{args.file}"...')
+    if args.output != 'text':
+        ec2_result_writer.close()
+    if collect_stats:
+        ec2_stats.add_phase_time('total', time.perf_counter() - run_started_at)
+        if args.stats:
+            for line in ec2_stats.summary_lines():
+                echo(line)
+        if args.stats_prometheus:
+            ec2_stats.write_prometheus_textfile(path=args.stats_prometheus)
+        if args.stats_statsd:
+            ec2_stats.send_statsd(address=args.stats_statsd)
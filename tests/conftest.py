@@ -2,7 +2,28 @@ from pytest import fixture
 import os
 
 import boto3
-from moto import mock_ec2
+from moto import mock_ec2, mock_sts, mock_sqs
+from moto.core.base_backend import BackendDict, AccountSpecificBackend
+from moto.ec2.models import ec2_backends
+
+from ec2_tags import configure_client_factory
+
+
+@fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Temporary cache directory used by the script.
+    """
+    monkeypatch.setenv('EC2_TAGS_CACHE_DIR', str(tmp_path))
+    yield tmp_path
+
+
+@fixture(autouse=True)
+def client_factory():
+    """
+    Fresh client factory of the script, so AWS API clients are not shared between tests.
+    """
+    yield configure_client_factory()
 
 
 @fixture
@@ -80,3 +101,37 @@ def ec2_instance_multiple_instances_no_tags(ec2_resource, ec2_client):
     # Create dummy instance
     instances = ec2_resource.create_instances(ImageId=image_id, MinCount=3, MaxCount=3)
     yield instances
+
+
+@fixture
+def role_arns(ec2_client):
+    """
+    Mocked STS service and ARNs of IAM roles in two accounts, each with a running instance without tags.
+    """
+    with mock_sts():
+        arns = ['arn:aws:iam::111111111111:role/cleanup', 'arn:aws:iam::222222222222:role/cleanup']
+        for role_arn in arns:
+            credentials = boto3.client('sts').assume_role(RoleArn=role_arn, RoleSessionName='setup')['Credentials']
+            account_ec2_client = boto3.client('ec2',
+                                              aws_access_key_id=credentials['AccessKeyId'],
+                                              aws_secret_access_key=credentials['SecretAccessKey'],
+                                              aws_session_token=credentials['SessionToken'])
+            image_id = account_ec2_client.describe_images()['Images'][0]['ImageId']
+            account_ec2_client.run_instances(ImageId=image_id, MinCount=1, MaxCount=1)
+        yield arns
+    # moto resets backends of all accounts whenever a mock starts, so backends of the accounts are removed
+    # (otherwise every following test would re-create their EC2 backends in all regions)
+    for role_arn in arns:
+        ec2_backends.pop(role_arn.split(':')[4], None)
+    # moto caches backends looked up by account and region
+    BackendDict.__getitem__.cache_clear()
+    AccountSpecificBackend.__getitem__.cache_clear()
+
+
+@fixture
+def sqs_queue_url(aws_credentials):
+    """
+    URL of mocked SQS queue.
+    """
+    with mock_sqs():
+        yield boto3.client('sqs').create_queue(QueueName='ec2-events')['QueueUrl']
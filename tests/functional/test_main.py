@@ -1,4 +1,16 @@
-from ec2_tags import main
+import io
+import json
+from functools import partial
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+import ec2_tags
+
+from ec2_tags import main, run_main_in_regions, CompiledTagExpression, Policy, query_exported_instances, ActionPlan, \
+    ResultWriter, set_result_writer, RunStats, run_main_in_accounts, serve, ServeStatus, consume_events, \
+    read_events_file, receive_queue_events, delete_queue_messages, set_stats
 
 
 def test_main_single_instance_no_tags_stop(ec2_instance):
@@ -478,3 +490,560 @@ def test_main_multiple_instances_no_name_tag_list(ec2_resource, ec2_instance_mul
         assert ec2_instance.state['Name'] == 'running'
 
 
+def test_main_multiple_instances_no_tags_per_instance_stop(ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple instances without assigned tags.
+    WHEN main() is called with per-instance action mode.
+    THEN The stop action has been performed on all instances.
+    """
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.start()
+    main(aws_region='eu-west-1', ec2_action='stop', per_instance=True, action_workers=2, ec2_no_tags=True)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        assert instance.state['Name'] == 'stopped'
+
+
+def test_main_multiple_instances_tag_expression_stop(ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple instances with different tags assigned.
+    WHEN main() is called with tag expression.
+    THEN The stop action has been performed only on instances matching the expression.
+    """
+    instances_tags = [
+        [{'Key': 'Env', 'Value': 'Test'}, {'Key': 'Project', 'Value': 'tmp-1'}],
+        [{'Key': 'Env', 'Value': 'Test'}, {'Key': 'Project', 'Value': 'tmp-2'}, {'Key': 'Owner', 'Value': 'ops'}],
+        [{'Key': 'Env', 'Value': 'Production'}, {'Key': 'Project', 'Value': 'tmp-3'}]
+    ]
+    for instance, instance_tags in zip(ec2_instance_multiple_instances_no_tags, instances_tags):
+        ec2_resource.create_tags(Resources=[instance.id], Tags=instance_tags)
+        instance.start()
+    tag_expression = CompiledTagExpression('Env=Te* AND NOT Owner=* AND Project~^tmp-')
+    main(aws_region='eu-west-1', ec2_action='stop', ec2_tag_expression=tag_expression)
+    instances_states = [instance.state['Name'] for instance in ec2_instance_multiple_instances_no_tags]
+    assert instances_states == ['stopped', 'running', 'running']
+
+
+def test_main_multiple_instances_policies(ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple instances with different tags assigned.
+    WHEN main() is called with multiple policies.
+    THEN Each instance is processed according to the matching policy with the highest precedence.
+    """
+    instances_tags = [
+        [],
+        [{'Key': 'Env', 'Value': 'Dev'}],
+        [{'Key': 'Env', 'Value': 'Dev'}, {'Key': 'Name', 'Value': 'Dummy-instance'}]
+    ]
+    for instance, instance_tags in zip(ec2_instance_multiple_instances_no_tags, instances_tags):
+        if instance_tags:
+            ec2_resource.create_tags(Resources=[instance.id], Tags=instance_tags)
+        instance.start()
+    policies = [
+        Policy(action='list', selector={'ec2_no_name_tag': True}),
+        Policy(action='stop', selector={'ec2_tag': {'tag_key': 'Env', 'tag_value': 'Dev'}}),
+        Policy(action='terminate', selector={'ec2_no_tags': True})
+    ]
+    main(aws_region='eu-west-1', policies=policies)
+    instances_states = [instance.state['Name'] for instance in ec2_instance_multiple_instances_no_tags]
+    assert instances_states == ['terminated', 'stopped', 'stopped']
+
+
+def test_main_policies_expression_pushed_down(capsys, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Instances with Env=Test and Env=Prod tags and policies stopping Env=Test instances and listing instances
+    without Name tag (loaded from the policy file).
+    WHEN main() is called with the policies (scanned only with instance state filter).
+    THEN Only Env=Test instance is stopped, the whole tag expression is checked locally. Env=Prod instance
+    is only listed.
+    """
+    instance_test, instance_prod, _ = ec2_instance_multiple_instances_no_tags
+    ec2_resource.create_tags(Resources=[instance_test.id], Tags=[{'Key': 'Env', 'Value': 'Test'}])
+    ec2_resource.create_tags(Resources=[instance_prod.id], Tags=[{'Key': 'Env', 'Value': 'Prod'}])
+    policies = [
+        Policy.from_dict({'action': 'stop', 'expression': 'Env=Test'}),
+        Policy.from_dict({'action': 'list', 'no_name': True})
+    ]
+    main(aws_region='eu-west-1', policies=policies)
+    instance_test.reload()
+    instance_prod.reload()
+    assert instance_test.state['Name'] == 'stopped'
+    assert instance_prod.state['Name'] == 'running'
+    assert f'Instance id: "{instance_prod.id}", current state: "running"' in capsys.readouterr().out
+
+
+def test_main_multiple_instances_no_tags_stop_wait(capsys, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags.
+    WHEN main() is called with stop action and wait for the target state.
+    THEN The instances are reported as stopped once their state has been polled.
+    """
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.start()
+    main(aws_region='eu-west-1', ec2_action='stop', wait=True, ec2_no_tags=True)
+    output = capsys.readouterr().out.splitlines()
+    for instance in ec2_instance_multiple_instances_no_tags:
+        assert f'Instance with id "{instance.id}" stopped...' in output
+        assert f'Instance with id "{instance.id}" is stopped...' in output
+
+
+def test_main_policies_mark_and_stop_wait(capsys, caplog, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Running instances without assigned tags, one of them with expiry time in the past.
+    WHEN main() is called with policies marking instances without Name tag and stopping expired instances
+    and wait for the target state.
+    THEN Only the stopped instance is awaited, the marked instances (without target state) are not tracked.
+    """
+    instance_expired, *instances_marked = ec2_instance_multiple_instances_no_tags
+    ec2_resource.create_tags(Resources=[instance_expired.id], Tags=[{'Key': 'cleanup-after', 'Value': '2020-01-01'}])
+    policies = [
+        Policy.from_dict({'action': 'mark', 'no_name': True}),
+        Policy.from_dict({'action': 'stop', 'expired': True})
+    ]
+    main(aws_region='eu-west-1', policies=policies, wait=True)
+    output = capsys.readouterr().out.splitlines()
+    assert f'Instance with id "{instance_expired.id}" is stopped...' in output
+    for instance in instances_marked:
+        assert f'Instance with id "{instance.id}" marked...' in output
+    # Exceptions raised by the future callbacks are only logged
+    assert not [record for record in caplog.records if record.name == 'concurrent.futures']
+
+
+def test_main_dry_run_and_apply_plan(tmp_path, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances, one of them with Name tag assigned.
+    WHEN main() is called in dry run mode, the plan is saved and then applied in a later run.
+    THEN Dry run does not change any instance, applying the plan stops only the planned instances.
+    """
+    tagged_instance, *untagged_instances = ec2_instance_multiple_instances_no_tags
+    tagged_instance.create_tags(Tags=[{'Key': 'Name', 'Value': 'Keep'}])
+    plan = ActionPlan()
+    main(aws_region='eu-west-1', ec2_action='stop', dry_run=True, plan=plan, ec2_no_tags=True)
+    plan_file = str(tmp_path / 'plan.json')
+    plan.save(plan_file=plan_file)
+    assert sorted(plan.regions['eu-west-1']['stop']) == sorted(instance.id for instance in untagged_instances)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert instance.state['Name'] == 'running'
+    main(aws_region='eu-west-1', applied_plan=ActionPlan.load(plan_file=plan_file))
+    for instance in untagged_instances:
+        instance.reload()
+        assert instance.state['Name'] == 'stopped'
+    tagged_instance.reload()
+    assert tagged_instance.state['Name'] == 'running'
+
+
+def test_main_dry_run_mark_policy(ec2_instance):
+    """
+    GIVEN Running instance without assigned tags and policies marking and stopping instances.
+    WHEN main() is called in dry run mode.
+    THEN ValueError is raised before any instance is marked, because the plan can contain only stop
+    and terminate actions.
+    """
+    policies = [
+        Policy.from_dict({'action': 'mark', 'no_tags': True}),
+        Policy.from_dict({'action': 'stop', 'expired': True})
+    ]
+    with pytest.raises(ValueError):
+        main(aws_region='eu-west-1', policies=policies, dry_run=True, plan=ActionPlan())
+    ec2_instance.reload()
+    assert not ec2_instance.tags
+
+
+def test_main_multiple_instances_no_tags_stop_ndjson_output(ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags.
+    WHEN main() is called with stop action and NDJSON result writer.
+    THEN A record with region, state transition and outcome is written per instance.
+    """
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.start()
+    stream = io.StringIO()
+    result_writer = ResultWriter(output_format='ndjson', stream=stream)
+    set_result_writer(result_writer)
+    try:
+        main(aws_region='eu-west-1', ec2_action='stop', ec2_no_tags=True)
+    finally:
+        set_result_writer(None)
+        result_writer.close()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    instance_ids = sorted(instance.id for instance in ec2_instance_multiple_instances_no_tags)
+    assert sorted(record['instance_id'] for record in records) == instance_ids
+    for record in records:
+        assert record['region'] == 'eu-west-1'
+        assert record['action'] == 'stop'
+        assert record['state_before'] == 'running'
+        assert record['outcome'] == 'succeeded'
+        assert record['latency_ms'] >= 0
+
+
+def test_main_multiple_instances_no_tags_stop_stats(monkeypatch, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags and statistics collected.
+    WHEN main() is called with stop action.
+    THEN Time of scan, match and action phases and AWS API calls are recorded.
+    """
+    stats = RunStats()
+    monkeypatch.setattr(ec2_tags, '_stats', stats)
+    main(aws_region='eu-west-1', ec2_action='stop', ec2_no_tags=True)
+    assert {'scan', 'match', 'action'} <= set(stats.phases)
+    assert stats.api_calls['DescribeInstances'].calls == 1
+    assert stats.api_calls['DescribeInstances'].bytes_received > 0
+    assert stats.api_calls['StopInstances'].calls == 1
+    assert stats.api_calls['StopInstances'].errors == 0
+
+
+def test_main_list_from_snapshot(capsys, ec2_instance):
+    """
+    GIVEN Local inventory snapshot synced within staleness window and instance stopped afterwards.
+    WHEN main() is called with list action and max staleness.
+    THEN The instance is listed from the snapshot with its state from the time of sync.
+    """
+    main(aws_region='eu-west-1', ec2_action='list', max_staleness=3600, ec2_no_tags=True)
+    ec2_instance.stop()
+    main(aws_region='eu-west-1', ec2_action='list', max_staleness=3600, ec2_no_tags=True)
+    main(aws_region='eu-west-1', ec2_action='list', refresh_snapshot=True, ec2_no_tags=True)
+    assert capsys.readouterr().out.splitlines() == [
+        f'Instance id: "{ec2_instance.id}", current state: "running"',
+        f'Instance id: "{ec2_instance.id}", current state: "running"',
+        f'Instance id: "{ec2_instance.id}", current state: "stopped"'
+    ]
+
+
+def test_main_list_from_snapshot_tag_expression(capsys, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Instances with Env=Test and Env=Prod tags and instance without tags.
+    WHEN main() is called with list action, tag expression selector and refresh of the local snapshot.
+    THEN Only the instance matching the tag expression is listed from the snapshot.
+    """
+    instance_test, instance_prod, _ = ec2_instance_multiple_instances_no_tags
+    ec2_resource.create_tags(Resources=[instance_test.id], Tags=[{'Key': 'Env', 'Value': 'Test'}])
+    ec2_resource.create_tags(Resources=[instance_prod.id], Tags=[{'Key': 'Env', 'Value': 'Prod'}])
+    main(aws_region='eu-west-1', ec2_action='list', refresh_snapshot=True,
+         ec2_tag_expression=CompiledTagExpression('Env=Test'))
+    assert capsys.readouterr().out.splitlines() == [f'Instance id: "{instance_test.id}", current state: "running"']
+
+
+def test_main_export_and_query(capsys, tmp_path, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple instances with and without tags.
+    WHEN main() is called with export action and the exported file is queried.
+    THEN All instances are exported and the query returns only instances matching the selector.
+    """
+    instance_tagged = ec2_instance_multiple_instances_no_tags[0]
+    ec2_resource.create_tags(Resources=[instance_tagged.id], Tags=[{'Key': 'Name', 'Value': 'Dummy-instance'}])
+    export_file = str(tmp_path / 'export-{region}.json.gz')
+    main(aws_region='eu-west-1', ec2_action='export', export_file=export_file)
+    assert capsys.readouterr().out == f'3 instances exported to "{tmp_path / "export-eu-west-1.json.gz"}"...\n'
+    query_exported_instances(export_file=str(tmp_path / 'export-eu-west-1.json.gz'), ec2_no_name_tag=True)
+    expected_ids = sorted(instance.id for instance in ec2_instance_multiple_instances_no_tags[1:])
+    assert capsys.readouterr().out.splitlines() == [
+        f'Instance id: "{instance_id}", current state: "running"' for instance_id in expected_ids
+    ]
+
+
+def test_run_main_in_regions_export_without_placeholder(tmp_path, ec2_instance):
+    """
+    GIVEN Export file name without "{region}" placeholder.
+    WHEN run_main_in_regions() is called with export action in two regions.
+    THEN ValueError is raised and no file is written, because the regions would overwrite each other's export.
+    """
+    export_file = tmp_path / 'export.json.gz'
+    with pytest.raises(ValueError, match='placeholder'):
+        run_main_in_regions(aws_regions=['us-east-1', 'eu-west-1'], ec2_action='export', export_file=str(export_file))
+    assert not export_file.exists()
+
+
+def test_run_main_in_regions_stop(ec2_client, ec2_instance):
+    """
+    GIVEN Single instance without assigned tag in each of two regions.
+    WHEN run_main_in_regions() is called.
+    THEN The stop action has been performed in both regions. The output is grouped per region in given order.
+    """
+    ec2_instance.start()
+    ec2_resource_other_region = boto3.resource('ec2', region_name='us-east-1')
+    image_id = ec2_resource_other_region.meta.client.describe_images()['Images'][0]['ImageId']
+    ec2_instance_other_region = ec2_resource_other_region.create_instances(ImageId=image_id, MinCount=1, MaxCount=1)[0]
+    ec2_instance_other_region.start()
+    run_main_in_regions(aws_regions=['us-east-1', 'eu-west-1'], ec2_action='stop', ec2_no_tags=True)
+    assert ec2_instance.state['Name'] == 'stopped'
+    assert ec2_instance_other_region.state['Name'] == 'stopped'
+
+
+def test_run_main_in_regions_output_order(capsys, ec2_instance):
+    """
+    GIVEN Single instance without assigned tag in one of three regions.
+    WHEN run_main_in_regions() is called.
+    THEN The output is grouped per region in given order.
+    """
+    run_main_in_regions(aws_regions=['eu-west-2', 'eu-west-1', 'us-east-1'], ec2_action='list', ec2_no_tags=True)
+    output_lines = capsys.readouterr().out.splitlines()
+    assert output_lines == [
+        'Region: eu-west-2',
+        '  Nothing to do...',
+        'Region: eu-west-1',
+        f'  Instance id: "{ec2_instance.id}", current state: "running"',
+        'Region: us-east-1',
+        '  Nothing to do...'
+    ]
+
+
+def test_run_main_in_accounts_stop(capsys, ec2_instance, role_arns):
+    """
+    GIVEN Running instance without assigned tag in each of two accounts of assumed roles.
+    WHEN run_main_in_accounts() is called with stop action.
+    THEN The stop action has been performed only in the accounts of the roles.
+    The output is grouped per account and region with the summary of the account.
+    """
+    run_main_in_accounts(role_arns=role_arns, aws_regions=['eu-west-1'], ec2_action='stop', ec2_no_tags=True)
+    output_lines = capsys.readouterr().out.splitlines()
+    assert [line for line in output_lines if not line.startswith('    ')] == [
+        'Account: 111111111111',
+        '  Region: eu-west-1',
+        '  Summary: 1 succeeded',
+        'Account: 222222222222',
+        '  Region: eu-west-1',
+        '  Summary: 1 succeeded'
+    ]
+    # Instance of the ambient credentials' account is not touched
+    ec2_instance.reload()
+    assert ec2_instance.state['Name'] == 'running'
+
+
+def test_run_main_in_accounts_enabled_regions_ndjson_output(role_arns):
+    """
+    GIVEN Running instance without assigned tag in each of two accounts of assumed roles.
+    WHEN run_main_in_accounts() is called without regions and with NDJSON result writer.
+    THEN Enabled regions of each account are listed and a record with the account is written per instance.
+    """
+    stream = io.StringIO()
+    result_writer = ResultWriter(output_format='ndjson', stream=stream)
+    set_result_writer(result_writer)
+    try:
+        run_main_in_accounts(role_arns=role_arns, ec2_action='list', ec2_no_tags=True)
+    finally:
+        set_result_writer(None)
+        result_writer.close()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert sorted((record['account'], record['region']) for record in records) == [
+        ('111111111111', 'eu-west-1'),
+        ('222222222222', 'eu-west-1')
+    ]
+
+
+def test_serve_sweeps(capsys, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags, one of them tagged after the first sweep.
+    WHEN serve() is called for list action and then for stop action with the same status.
+    THEN Inventory is kept between the sweeps and only instances still without tags are stopped.
+    """
+    instance_tagged = ec2_instance_multiple_instances_no_tags[0]
+    status = ServeStatus(interval=0.01)
+    serve(aws_regions=['eu-west-1'], ec2_action='list', interval=0.01, status=status, max_sweeps=1,
+          ec2_no_tags=True)
+    ec2_resource.create_tags(Resources=[instance_tagged.id], Tags=[{'Key': 'Env', 'Value': 'Dev'}])
+    serve(aws_regions=['eu-west-1'], ec2_action='stop', interval=0.01, status=status, max_sweeps=3,
+          ec2_no_tags=True)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+    assert instance_tagged.state['Name'] == 'running'
+    assert [instance.state['Name'] for instance in ec2_instance_multiple_instances_no_tags[1:]] == ['stopped'] * 2
+    assert status.sweeps == 3
+    assert status.failed_sweeps == 0
+    output_lines = capsys.readouterr().out.splitlines()
+    assert [line.split(' finished')[0] for line in output_lines if line.startswith('Sweep ')] == \
+        ['Sweep 1', 'Sweep 2', 'Sweep 3']
+    assert output_lines[-1].endswith(': nothing to do')
+
+
+def test_serve_tag_expression_stop(ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Instances with Env=Test and Env=Prod tags and instance without tags.
+    WHEN serve() is called for stop action with tag expression selector.
+    THEN Only the instance matching the tag expression is stopped, although the inventory is selected locally.
+    """
+    instance_test, instance_prod, instance_untagged = ec2_instance_multiple_instances_no_tags
+    ec2_resource.create_tags(Resources=[instance_test.id], Tags=[{'Key': 'Env', 'Value': 'Test'}])
+    ec2_resource.create_tags(Resources=[instance_prod.id], Tags=[{'Key': 'Env', 'Value': 'Prod'}])
+    serve(aws_regions=['eu-west-1'], ec2_action='stop', interval=0.01, status=ServeStatus(interval=0.01),
+          max_sweeps=2, ec2_tag_expression=CompiledTagExpression('Env=Test'))
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+    assert instance_test.state['Name'] == 'stopped'
+    assert instance_prod.state['Name'] == 'running'
+    assert instance_untagged.state['Name'] == 'running'
+
+
+def build_state_change_event(instance_id: str, state: str, region: str = 'eu-west-1') -> dict:
+    """
+    Returns EventBridge EC2 instance state-change event.
+    """
+    return {
+        'source': 'aws.ec2',
+        'detail-type': 'EC2 Instance State-change Notification',
+        'region': region,
+        'detail': {'instance-id': instance_id, 'state': state}
+    }
+
+
+def test_main_instance_ids_tag_expression_stop(ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Instances with Env=Test and Env=Prod tags (e.g. from events).
+    WHEN main() is called with stop action, tag expression selector and ids of both instances.
+    THEN Only the instance matching the tag expression is stopped, although the instances were described
+    only by their ids.
+    """
+    instance_test, instance_prod, _ = ec2_instance_multiple_instances_no_tags
+    ec2_resource.create_tags(Resources=[instance_test.id], Tags=[{'Key': 'Env', 'Value': 'Test'}])
+    ec2_resource.create_tags(Resources=[instance_prod.id], Tags=[{'Key': 'Env', 'Value': 'Prod'}])
+    main(aws_region='eu-west-1', ec2_action='stop', ec2_tag_expression=CompiledTagExpression('Env=Test'),
+         instance_ids=[instance_test.id, instance_prod.id])
+    instance_test.reload()
+    instance_prod.reload()
+    assert instance_test.state['Name'] == 'stopped'
+    assert instance_prod.state['Name'] == 'running'
+
+
+def test_consume_events_file_stop(capsys, tmp_path, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN NDJSON file with state-change events of instances without assigned tags (one of them stopped,
+    one from other region) and an invalid line.
+    WHEN consume_events() is called with stop action.
+    THEN Only running instances from the events are stopped, described with a single request.
+    """
+    instance_running, instance_stopped, instance_other = ec2_instance_multiple_instances_no_tags
+    instance_stopped.stop()
+    events_file = tmp_path / 'events.ndjson'
+    events_file.write_text('\n'.join([
+        json.dumps(build_state_change_event(instance_id=instance_running.id, state='running')),
+        json.dumps(build_state_change_event(instance_id=instance_stopped.id, state='stopped')),
+        json.dumps(build_state_change_event(instance_id=instance_other.id, state='running', region='us-east-1')),
+        'not json',
+        json.dumps(build_state_change_event(instance_id=instance_running.id, state='running'))
+    ]))
+    stats = RunStats()
+    set_stats(stats)
+    try:
+        consume_events(events=read_events_file(events_file=str(events_file)), ec2_action='stop',
+                       aws_regions=['eu-west-1'], batch_window=0.1, ec2_no_tags=True)
+    finally:
+        set_stats(None)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+    assert instance_running.state['Name'] == 'stopped'
+    assert instance_other.state['Name'] == 'running'
+    assert stats.api_calls['DescribeInstances'].calls == 1
+    assert stats.api_calls['StopInstances'].calls == 1
+    assert f'  Instance with id "{instance_running.id}" stopped...' in capsys.readouterr().out.splitlines()
+
+
+def test_consume_events_queue(ec2_resource, ec2_instance_with_tag, sqs_queue_url):
+    """
+    GIVEN SQS queue with state-change events of instance with tag and an unrelated message.
+    WHEN consume_events() is called with the queue events for instances with the tag.
+    THEN The instance is stopped and all messages are deleted from the queue.
+    """
+    sqs_client = boto3.client('sqs')
+    sqs_client.send_message(QueueUrl=sqs_queue_url,
+                            MessageBody=json.dumps(build_state_change_event(instance_id=ec2_instance_with_tag.id,
+                                                                            state='running')))
+    sqs_client.send_message(QueueUrl=sqs_queue_url, MessageBody=json.dumps({'detail-type': 'Scheduled Event'}))
+    consume_events(events=receive_queue_events(queue_url=sqs_queue_url, wait_time=0, stop_when_empty=True),
+                   ec2_action='stop',
+                   batch_window=0,
+                   acknowledge=partial(delete_queue_messages, queue_url=sqs_queue_url),
+                   ec2_tag={'tag_key': 'Env', 'tag_value': 'Production'})
+    ec2_instance_with_tag.reload()
+    assert ec2_instance_with_tag.state['Name'] == 'stopped'
+    attributes = sqs_client.get_queue_attributes(QueueUrl=sqs_queue_url, AttributeNames=['All'])['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '0'
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '0'
+
+
+def test_consume_events_region_error_not_acknowledged(monkeypatch, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN State-change events of instances from two regions, describing instances in one of the regions fails.
+    WHEN consume_events() is called with stop action and acknowledge func.
+    THEN The instance from the other region is stopped and only receipt of its event is acknowledged, so that
+    the event from the failed region is delivered again.
+    """
+    instance_running, _, instance_other = ec2_instance_multiple_instances_no_tags
+    acknowledged = []
+    region_main = ec2_tags.main
+
+    def main_failing_in_region(aws_region, **kwargs):
+        if aws_region == 'us-east-1':
+            raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}},
+                              'DescribeInstances')
+        return region_main(aws_region=aws_region, **kwargs)
+
+    monkeypatch.setattr(ec2_tags, 'main', main_failing_in_region)
+    events = [(build_state_change_event(instance_id=instance_running.id, state='running'), 'receipt-1'),
+              (build_state_change_event(instance_id=instance_other.id, state='running', region='us-east-1'),
+               'receipt-2')]
+    consume_events(events=events, ec2_action='stop', batch_window=60,
+                   acknowledge=lambda receipt_handles: acknowledged.extend(receipt_handles), ec2_no_tags=True)
+    instance_running.reload()
+    assert instance_running.state['Name'] == 'stopped'
+    assert acknowledged == ['receipt-1']
+
+
+def test_main_multiple_instances_no_tags_tag(capsys, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags and statistics collected.
+    WHEN main() is called twice with tag action.
+    THEN All instances are tagged with a single CreateTags request. The second run has nothing to do, because
+    the instances already have the tags.
+    """
+    stats = RunStats()
+    set_stats(stats)
+    try:
+        main(aws_region='eu-west-1', ec2_action='tag', ec2_no_name_tag=True, tags={'Owner': 'unknown'})
+        main(aws_region='eu-west-1', ec2_action='tag', ec2_no_name_tag=True, tags={'Owner': 'unknown'})
+    finally:
+        set_stats(None)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert instance.tags == [{'Key': 'Owner', 'Value': 'unknown'}]
+    assert stats.api_calls['CreateTags'].calls == 1
+    output_lines = capsys.readouterr().out.splitlines()
+    assert output_lines[-1] == 'Nothing to do...'
+    assert sum(line.endswith('tagged...') for line in output_lines) == 3
+
+
+def test_main_untag_per_instance(ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN main() is called with untag action in per-instance mode.
+    THEN The tag has been removed from the instance.
+    """
+    main(aws_region='eu-west-1', ec2_action='untag', per_instance=True,
+         ec2_tag={'tag_key': 'Env', 'tag_value': 'Production'}, tags={'Env': 'Production'})
+    ec2_instance_with_tag.reload()
+    assert not ec2_instance_with_tag.tags
+
+
+def test_main_mark_then_stop_expired(ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without assigned tags, one of them marked with expiry time in the future.
+    WHEN main() is called with mark action and with stop action on expired instances.
+    THEN Instances which were not marked are marked with expiry time after the grace period and stopped once
+    it has passed. The instance marked before keeps its expiry time and is still running.
+    """
+    instance_marked = ec2_instance_multiple_instances_no_tags[0]
+    ec2_resource.create_tags(Resources=[instance_marked.id], Tags=[{'Key': 'cleanup-after', 'Value': '2099-01-01'}])
+    main(aws_region='eu-west-1', ec2_action='mark', ec2_no_name_tag=True, grace_period=0)
+    stats = RunStats()
+    set_stats(stats)
+    try:
+        main(aws_region='eu-west-1', ec2_action='stop', ec2_expired_tag='cleanup-after')
+    finally:
+        set_stats(None)
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+    assert instance_marked.state['Name'] == 'running'
+    assert instance_marked.tags == [{'Key': 'cleanup-after', 'Value': '2099-01-01'}]
+    for instance in ec2_instance_multiple_instances_no_tags[1:]:
+        assert instance.state['Name'] == 'stopped'
+        assert [tag['Key'] for tag in instance.tags] == ['cleanup-after']
+    assert stats.api_calls['DescribeInstances'].calls == 1
+    assert stats.api_calls['StopInstances'].calls == 1
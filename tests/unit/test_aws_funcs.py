@@ -1,4 +1,13 @@
-from ec2_tags import check_aws_region, perform_action_on_instance
+import asyncio
+
+import boto3
+from botocore.exceptions import EndpointConnectionError, ClientError
+
+import ec2_tags
+from ec2_tags import check_aws_region, perform_action_on_instance, perform_batch_action, perform_instance_action, \
+    scan_instances, InstanceRecord, InventorySnapshot, refresh_inventory_snapshot, async_process_region, Policy, \
+    TokenBucketRateLimiter, ClientFactory, wait_for_instance_states, AssumedRoleSessions, InstanceInventory, \
+    select_inventory_instances, configure_client_factory, get_client_factory, get_ec2_client
 
 
 def test_check_aws_region_all_valid(ec2_resource):
@@ -23,6 +32,46 @@ def test_check_aws_region_partially_valid(ec2_resource):
         assert not check_aws_region(region_specified=region)
 
 
+def test_check_aws_region_cached(ec2_resource, monkeypatch):
+    """
+    GIVEN AWS region names cached by previous check.
+    WHEN check_aws_region() is called.
+    THEN Region name is validated without calling AWS API.
+    """
+    assert check_aws_region(region_specified='eu-central-1')
+
+    def get_aws_region_names_failed(*args, **kwargs):
+        raise AssertionError('AWS API should not be called')
+    monkeypatch.setattr(ec2_tags, 'get_aws_region_names', get_aws_region_names_failed)
+    assert check_aws_region(region_specified='us-west-1')
+
+
+def test_check_aws_region_offline(monkeypatch):
+    """
+    GIVEN AWS API is not reachable and no region names are cached.
+    WHEN check_aws_region() is called.
+    THEN Region name is validated with the list of known region names.
+    """
+    def get_aws_region_names_offline(*args, **kwargs):
+        raise EndpointConnectionError(endpoint_url='https://ec2.amazonaws.com')
+    monkeypatch.setattr(ec2_tags, 'get_aws_region_names', get_aws_region_names_offline)
+    assert check_aws_region(region_specified='eu-west-1')
+    assert not check_aws_region(region_specified='eu-west-123')
+
+
+def test_check_aws_region_invalid_format(monkeypatch):
+    """
+    GIVEN Values which are not formatted as AWS region names.
+    WHEN check_aws_region() is called.
+    THEN Values are rejected without calling AWS API.
+    """
+    def get_aws_region_names_failed(*args, **kwargs):
+        raise AssertionError('AWS API should not be called')
+    monkeypatch.setattr(ec2_tags, 'get_aws_region_names', get_aws_region_names_failed)
+    for region in ['', 'eu', 'EU-WEST-1', 'eu west 1', 'eu-west-1a', 'eu-west']:
+        assert not check_aws_region(region_specified=region)
+
+
 def test_perform_action_on_instance_specified_ec2_tag_stop(ec2_resource, ec2_instance):
     """
     GIVEN Instance with assigned tag.
@@ -282,3 +331,397 @@ def test_perform_action_on_instance_no_action_no_tags_list(ec2_instance_with_tag
     ec2_instance_with_tag.start()
     assert not perform_action_on_instance(action='list', instance=ec2_instance_with_tag, ec2_no_tags=True)
     assert ec2_instance_with_tag.state['Name'] == 'running'
+
+
+def test_perform_batch_action_stop(ec2_client, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances.
+    WHEN perform_batch_action() is called.
+    THEN The stop action has been performed on all given instances.
+    """
+    instance_ids = [instance.id for instance in ec2_instance_multiple_instances_no_tags]
+    results = perform_batch_action(ec2_client=ec2_client, action='stop', instance_ids=instance_ids)
+    assert results == {instance_id: True for instance_id in instance_ids}
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert instance.state['Name'] == 'stopped'
+
+
+def test_perform_batch_action_dry_run(ec2_client, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances.
+    WHEN perform_batch_action() is called in dry run mode.
+    THEN The stop action is reported as permitted for all instances, while the instances are still running.
+    """
+    instance_ids = [instance.id for instance in ec2_instance_multiple_instances_no_tags]
+    results = perform_batch_action(ec2_client=ec2_client, action='stop', instance_ids=instance_ids, dry_run=True)
+    assert results == {instance_id: True for instance_id in instance_ids}
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert instance.state['Name'] == 'running'
+
+
+def test_perform_batch_action_terminate_isolates_failed_instance(ec2_client, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances and an id of non-existent instance.
+    WHEN perform_batch_action() is called.
+    THEN The terminate action has been performed on all existing instances. Only non-existent instance failed.
+    """
+    instance_ids = [instance.id for instance in ec2_instance_multiple_instances_no_tags]
+    missing_instance_id = 'i-0123456789abcdef0'
+    results = perform_batch_action(ec2_client=ec2_client,
+                                   action='terminate',
+                                   instance_ids=instance_ids[:1] + [missing_instance_id] + instance_ids[1:])
+    assert not results.pop(missing_instance_id)
+    assert results == {instance_id: True for instance_id in instance_ids}
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert instance.state['Name'] == 'terminated'
+
+
+class UnauthorizedEc2Client:
+    """
+    Dummy EC2 client rejecting all StopInstances requests because of missing permission.
+    """
+    def __init__(self):
+        self.stop_instances_calls = []
+
+    def stop_instances(self, InstanceIds, **kwargs):
+        self.stop_instances_calls.append(InstanceIds)
+        raise ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'You are not authorized'}},
+                          'StopInstances')
+
+
+def test_perform_batch_action_dry_run_unauthorized():
+    """
+    GIVEN EC2 client rejecting the request because of missing permission.
+    WHEN perform_batch_action() is called in dry run mode with a chunk of instances.
+    THEN The whole chunk fails after a single request, it is not split to isolate the failing instance.
+    """
+    ec2_client = UnauthorizedEc2Client()
+    instance_ids = [f'i-{index}' for index in range(8)]
+    results = perform_batch_action(ec2_client=ec2_client, action='stop', instance_ids=instance_ids,
+                                   rate_limiter=TokenBucketRateLimiter(rate=1000), dry_run=True)
+    assert results == {instance_id: False for instance_id in instance_ids}
+    assert ec2_client.stop_instances_calls == [instance_ids]
+
+
+def test_perform_batch_action_tag(ec2_client, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Multiple running instances without tags.
+    WHEN perform_batch_action() is called with tag action.
+    THEN Given tags have been assigned to all instances.
+    """
+    instance_ids = [instance.id for instance in ec2_instance_multiple_instances_no_tags]
+    results = perform_batch_action(ec2_client=ec2_client, action='tag', instance_ids=instance_ids,
+                                   tags={'Owner': 'unknown', 'cleanup-after': '2026-01-31'})
+    assert results == {instance_id: True for instance_id in instance_ids}
+    for instance in ec2_instance_multiple_instances_no_tags:
+        instance.reload()
+        assert sorted(instance.tags, key=lambda tag: tag['Key']) == [
+            {'Key': 'Owner', 'Value': 'unknown'}, {'Key': 'cleanup-after', 'Value': '2026-01-31'}
+        ]
+
+
+def test_perform_batch_action_untag(ec2_client, ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN perform_batch_action() is called with untag action of the tag key only.
+    THEN The tag has been removed from the instance.
+    """
+    results = perform_batch_action(ec2_client=ec2_client, action='untag', instance_ids=[ec2_instance_with_tag.id],
+                                   tags={'Env': None})
+    assert results == {ec2_instance_with_tag.id: True}
+    ec2_instance_with_tag.reload()
+    assert not ec2_instance_with_tag.tags
+
+
+def test_perform_instance_action_tag(ec2_client, ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN perform_instance_action() is called with tag action.
+    THEN The value of the tag has been replaced.
+    """
+    assert perform_instance_action(ec2_client=ec2_client, action='tag', instance_id=ec2_instance_with_tag.id,
+                                   tags={'Env': 'Test'})
+    ec2_instance_with_tag.reload()
+    assert ec2_instance_with_tag.tags == [{'Key': 'Env', 'Value': 'Test'}]
+
+
+def test_perform_action_on_instance_tag_unchanged(ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN perform_action_on_instance() is called with tag action of the same tag.
+    THEN The action has not been performed, because the tags would not change.
+    """
+    assert not perform_action_on_instance(action='tag', instance=ec2_instance_with_tag,
+                                          ec2_tag={'tag_key': 'Env', 'tag_value': 'Production'},
+                                          tags={'Env': 'Production'})
+
+
+def test_perform_instance_action_stop(ec2_client, ec2_instance):
+    """
+    GIVEN Running instance.
+    WHEN perform_instance_action() is called.
+    THEN The stop action has been performed on given instance.
+    """
+    perform_instance_action(ec2_client=ec2_client, action='stop', instance_id=ec2_instance.id)
+    ec2_instance.reload()
+    assert ec2_instance.state['Name'] == 'stopped'
+
+
+def test_scan_instances(ec2_client, ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN scan_instances() is called.
+    THEN Compact record of the instance is returned.
+    """
+    instances = list(scan_instances(ec2_client=ec2_client, ec2_filters=[]))
+    assert instances == [
+        InstanceRecord(instance_id=ec2_instance_with_tag.id,
+                       state='running',
+                       tags={'Env': 'Production'},
+                       launch_time=ec2_instance_with_tag.launch_time)
+    ]
+
+
+def test_scan_instances_filtered(ec2_client, ec2_instance_with_tag):
+    """
+    GIVEN Running instance with assigned tag.
+    WHEN scan_instances() is called with filters not matching the instance.
+    THEN No records are returned.
+    """
+    ec2_filters = [{'Name': 'tag:Env', 'Values': ['Test']}]
+    assert list(scan_instances(ec2_client=ec2_client, ec2_filters=ec2_filters)) == []
+
+
+def test_refresh_inventory_snapshot_full(ec2_client, ec2_instance_with_tag):
+    """
+    GIVEN Empty local inventory snapshot.
+    WHEN refresh_inventory_snapshot() is called.
+    THEN All instances are stored in the snapshot.
+    """
+    with InventorySnapshot() as snapshot:
+        refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=snapshot, region='eu-west-1')
+        instances = list(snapshot.instances(region='eu-west-1'))
+        assert snapshot.sync_times(region='eu-west-1')[1] is not None
+    assert instances == [
+        InstanceRecord(instance_id=ec2_instance_with_tag.id,
+                       state='running',
+                       tags={'Env': 'Production'},
+                       launch_time=ec2_instance_with_tag.launch_time)
+    ]
+
+
+def test_refresh_inventory_snapshot_incremental(ec2_client, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Fully synced local inventory snapshot and instances whose state or tags changed afterwards.
+    WHEN refresh_inventory_snapshot() is called.
+    THEN Only instances whose state changed are re-fetched.
+    """
+    instance_stopped, instance_tagged, _ = ec2_instance_multiple_instances_no_tags
+    with InventorySnapshot() as snapshot:
+        refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=snapshot, region='eu-west-1')
+        instance_stopped.stop()
+        ec2_resource.create_tags(Resources=[instance_tagged.id], Tags=[{'Key': 'Env', 'Value': 'Dev'}])
+        refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=snapshot, region='eu-west-1')
+        instances = {instance.id: instance for instance in snapshot.instances(region='eu-west-1')}
+    assert instances[instance_stopped.id].state == 'stopped'
+    assert not instances[instance_tagged.id].tags
+
+
+def test_refresh_instance_inventory_incremental(ec2_client, ec2_resource, ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN Fully synced in-memory inventory, then stopped, terminated and newly launched instances.
+    WHEN refresh_inventory_snapshot() is called with the inventory.
+    THEN Changed and new instances are re-fetched and the full sync time is kept.
+    """
+    instance_stopped, instance_terminated, _ = ec2_instance_multiple_instances_no_tags
+    inventory = InstanceInventory()
+    refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=inventory, region='eu-west-1')
+    _, full_synced_at = inventory.sync_times(region='eu-west-1')
+    instance_stopped.stop()
+    instance_terminated.terminate()
+    image_id = ec2_client.describe_images()['Images'][0]['ImageId']
+    instance_new = ec2_resource.create_instances(ImageId=image_id, MinCount=1, MaxCount=1)[0]
+    refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=inventory, region='eu-west-1')
+    states = inventory.instance_states(region='eu-west-1')
+    assert states[instance_stopped.id] == 'stopped'
+    assert states[instance_terminated.id] == 'terminated'
+    assert states[instance_new.id] == 'running'
+    assert inventory.sync_times(region='eu-west-1')[1] == full_synced_at
+    assert inventory.instances_count() == {'eu-west-1': 4}
+
+
+def test_select_inventory_instances_verifies_candidates(ec2_client, ec2_resource,
+                                                        ec2_instance_multiple_instances_no_tags):
+    """
+    GIVEN In-memory inventory with instances without tags, one of them tagged after the sync.
+    WHEN select_inventory_instances() is called with stop policy for instances without tags.
+    THEN The tagged instance is not selected, because candidates are described again before the action.
+    """
+    instance_tagged = ec2_instance_multiple_instances_no_tags[0]
+    inventory = InstanceInventory()
+    refresh_inventory_snapshot(ec2_client=ec2_client, snapshot=inventory, region='eu-west-1')
+    ec2_resource.create_tags(Resources=[instance_tagged.id], Tags=[{'Key': 'Env', 'Value': 'Dev'}])
+    selected = list(select_inventory_instances(ec2_client=ec2_client,
+                                               inventory=inventory,
+                                               region='eu-west-1',
+                                               policies=[Policy(action='stop', selector={'ec2_no_tags': True})]))
+    assert sorted(instance.id for instance, _ in selected) == \
+        sorted(instance.id for instance in ec2_instance_multiple_instances_no_tags[1:])
+    assert {action for _, action in selected} == {'stop'}
+    # Inventory is updated with the described instances
+    assert next(instance for instance in inventory.instances(region='eu-west-1')
+                if instance.id == instance_tagged.id).tags == {'Env': 'Dev'}
+
+
+class DummyAsyncEc2Client:
+    """
+    Dummy async EC2 client (aiobotocore-like) returning given DescribeInstances pages.
+    """
+    def __init__(self, pages: list, missing_instance_ids: tuple = ()):
+        self.pages = pages
+        self.missing_instance_ids = missing_instance_ids
+        self.stop_instances_calls = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, **kwargs):
+        return self._pages()
+
+    async def _pages(self):
+        for page in self.pages:
+            yield page
+
+    async def stop_instances(self, InstanceIds):
+        self.stop_instances_calls.append(InstanceIds)
+        if set(InstanceIds) & set(self.missing_instance_ids):
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': 'Instance not found'}},
+                              'StopInstances')
+
+
+def test_async_process_region_stop(capsys):
+    """
+    GIVEN Async EC2 client returning two pages of instances.
+    WHEN async_process_region() is called with stop action policy.
+    THEN The stop action has been performed in batches on instances matching the policy.
+    """
+    pages = [
+        {'Reservations': [{'Instances': [
+            {'InstanceId': 'i-1', 'State': {'Name': 'running'}, 'LaunchTime': None},
+            {'InstanceId': 'i-2', 'State': {'Name': 'running'}, 'LaunchTime': None,
+             'Tags': [{'Key': 'Name', 'Value': 'Dummy-instance'}]}
+        ]}]},
+        {'Reservations': [{'Instances': [
+            {'InstanceId': 'i-3', 'State': {'Name': 'running'}, 'LaunchTime': None},
+            {'InstanceId': 'i-4', 'State': {'Name': 'running'}, 'LaunchTime': None}
+        ]}]}
+    ]
+    ec2_client = DummyAsyncEc2Client(pages=pages, missing_instance_ids=('i-4',))
+    asyncio.run(async_process_region(ec2_client=ec2_client,
+                                     policies=[Policy(action='stop', selector={'ec2_no_name_tag': True})],
+                                     rate_limiter=TokenBucketRateLimiter(rate=1000),
+                                     semaphore=asyncio.Semaphore(2)))
+    assert ec2_client.stop_instances_calls == [['i-1'], ['i-3', 'i-4'], ['i-3'], ['i-4']]
+    assert capsys.readouterr().out.splitlines() == [
+        'Instance with id "i-1" stopped...',
+        'Instance with id "i-3" stopped...',
+        'Error: Instance not found. Try later...'
+    ]
+
+
+def test_client_factory_shares_clients(aws_credentials):
+    """
+    GIVEN Client factory with custom pool size and retry settings.
+    WHEN client() is called repeatedly for the same and for different regions.
+    THEN The same client is returned per region and clients use the custom settings.
+    """
+    factory = ClientFactory(max_pool_connections=20, retry_mode='adaptive', max_attempts=3)
+    ec2_client = factory.client('ec2', region_name='us-east-1')
+    assert factory.client('ec2', region_name='us-east-1') is ec2_client
+    assert factory.client('ec2', region_name='eu-west-1') is not ec2_client
+    assert ec2_client.meta.config.max_pool_connections == 20
+    assert ec2_client.meta.config.retries == {'mode': 'adaptive', 'total_max_attempts': 3}
+
+
+def test_get_ec2_client_session_settings(aws_credentials):
+    """
+    GIVEN Client factory of the script with custom pool size and retry settings, and a separate session
+    (e.g. of an assumed role).
+    WHEN get_ec2_client() is called with the session.
+    THEN The client is created from the session and uses the settings of the client factory.
+    """
+    configure_client_factory(max_pool_connections=20, retry_mode='adaptive', max_attempts=3)
+    session = boto3.session.Session()
+    ec2_client = get_ec2_client(aws_region='eu-west-1', session=session)
+    assert ec2_client is not get_client_factory().client('ec2', region_name='eu-west-1')
+    assert ec2_client.meta.config.max_pool_connections == 20
+    assert ec2_client.meta.config.retries == {'mode': 'adaptive', 'total_max_attempts': 3}
+
+
+def test_wait_for_instance_states_backoff(monkeypatch, ec2_client, ec2_instance):
+    """
+    GIVEN Running instance which is stopped after the second poll of its state.
+    WHEN wait_for_instance_states() is called with the stopped target state.
+    THEN The state is polled with exponentially growing intervals until the instance is stopped.
+    """
+    poll_intervals = []
+
+    def sleep(seconds):
+        poll_intervals.append(seconds)
+        if len(poll_intervals) == 2:
+            ec2_instance.stop()
+
+    monkeypatch.setattr(ec2_tags.time, 'sleep', sleep)
+    timed_out = wait_for_instance_states(ec2_client=ec2_client, instance_target_states={ec2_instance.id: 'stopped'})
+    assert timed_out == {}
+    assert poll_intervals == [ec2_tags.WAIT_POLL_INTERVAL_MIN, 2 * ec2_tags.WAIT_POLL_INTERVAL_MIN]
+
+
+def test_wait_for_instance_states_timeout(ec2_client, ec2_instance):
+    """
+    GIVEN Running instance.
+    WHEN wait_for_instance_states() is called with the stopped target state and short timeout.
+    THEN The instance is returned as timed out with its last seen state.
+    """
+    timed_out = wait_for_instance_states(ec2_client=ec2_client,
+                                         instance_target_states={ec2_instance.id: 'stopped'},
+                                         timeout=0.1)
+    assert timed_out == {ec2_instance.id: 'running'}
+
+
+def test_assumed_role_sessions_credentials_cached(role_arns):
+    """
+    GIVEN Sessions of assumed roles.
+    WHEN credentials() is called twice for the same role.
+    THEN The role is assumed only once and cached credentials are returned.
+    """
+    role_sessions = AssumedRoleSessions()
+    credentials = role_sessions.credentials(role_arn=role_arns[0])
+    assert role_sessions.credentials(role_arn=role_arns[0]) == credentials
+    assert role_sessions.credentials(role_arn=role_arns[1]) != credentials
+
+
+def test_assumed_role_sessions_credentials_refreshed(role_arns):
+    """
+    GIVEN Sessions of assumed roles with refresh margin longer than the credentials lifetime.
+    WHEN credentials() is called twice for the same role.
+    THEN The role is assumed again, because the cached credentials are about to expire.
+    """
+    role_sessions = AssumedRoleSessions(duration=900, refresh_margin=3600)
+    credentials = role_sessions.credentials(role_arn=role_arns[0])
+    assert role_sessions.credentials(role_arn=role_arns[0])['access_key'] != credentials['access_key']
+
+
+def test_assumed_role_sessions_session(role_arns):
+    """
+    GIVEN Sessions of assumed roles.
+    WHEN EC2 client of the role's session is used.
+    THEN The client calls AWS in the account of the role.
+    """
+    session = AssumedRoleSessions().session(role_arn=role_arns[0])
+    ec2_client = session.client('ec2', region_name='eu-west-1')
+    reservations = ec2_client.describe_instances()['Reservations']
+    assert reservations[0]['OwnerId'] == '111111111111'
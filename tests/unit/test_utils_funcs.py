@@ -1,6 +1,24 @@
+import io
+import os
+import sys
+import json
+import socket
+import time
+import subprocess
+import urllib.request
+import urllib.error
+
 import pytest
+from botocore.exceptions import ClientError
 
-from ec2_tags import check_tag_exist, is_action_allowed, check_proper_instance_state
+from ec2_tags import check_tag_exist, is_action_allowed, check_proper_instance_state, split_into_chunks, \
+    build_instance_filters, TokenBucketRateLimiter, call_with_rate_limit, iterate_in_background, \
+    InstanceRecord, is_instance_selected, CompiledTagExpression, TagExpressionError, \
+    Policy, PolicyError, load_policies, select_policy_action, build_policies_filters, \
+    InventoryIndex, ActionPlan, PlanError, ResultWriter, RunStats, ResultCounts, get_role_account_id, \
+    ServeStatus, start_status_server, parse_instance_event, EventError, get_queue_region, parse_tags, TagsError, \
+    is_tags_change_needed, build_api_tags, parse_expiry_timestamp, format_expiry_timestamp, is_instance_expired, \
+    is_instance_error
 
 
 def test_check_tag_exist_true():
@@ -105,7 +123,7 @@ def test_is_action_allowed_true():
     WHEN is_action_allowed() is called.
     THEN None is returned.
     """
-    for action in ['stop', 'terminate', 'list']:
+    for action in ['stop', 'terminate', 'tag', 'untag', 'list']:
         assert is_action_allowed(action=action) is None
 
 
@@ -161,4 +179,894 @@ def test_check_proper_instance_state_stop_false():
     THEN False is returned.
     """
     for state in ['shutting-down', 'terminated', 'stopping', 'stopped', 'test', 'down', 'xxxx']:
-        assert not check_proper_instance_state(action='stop', ec2_current_state=state)
\ No newline at end of file
+        assert not check_proper_instance_state(action='stop', ec2_current_state=state)
+
+
+def test_split_into_chunks():
+    """
+    GIVEN List of items longer than chunk size.
+    WHEN split_into_chunks() is called.
+    THEN The list is split into chunks not longer than chunk size.
+    """
+    assert split_into_chunks(items=[1, 2, 3, 4, 5], chunk_size=2) == [[1, 2], [3, 4], [5]]
+
+
+def test_split_into_chunks_empty_list():
+    """
+    GIVEN Empty list.
+    WHEN split_into_chunks() is called.
+    THEN No chunks are returned.
+    """
+    assert split_into_chunks(items=[], chunk_size=2) == []
+
+
+def test_build_instance_filters_specified_tag_stop():
+    """
+    GIVEN Specified tag and stop action.
+    WHEN build_instance_filters() is called.
+    THEN Filters for the specified tag and instance states allowing stop action are returned.
+    """
+    ec2_tag_wanted = {
+        'tag_key': 'Env',
+        'tag_value': 'Test'
+    }
+    assert build_instance_filters(action='stop', ec2_tag=ec2_tag_wanted) == [
+        {'Name': 'tag:Env', 'Values': ['Test']},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running']}
+    ]
+
+
+def test_build_instance_filters_expired_terminate():
+    """
+    GIVEN Expired selector and terminate action.
+    WHEN build_instance_filters() is called.
+    THEN Filters for instances marked with the expiry tag and instance states allowing terminate action are returned.
+    """
+    assert build_instance_filters(action='terminate', ec2_expired_tag='cleanup-after') == [
+        {'Name': 'tag-key', 'Values': ['cleanup-after']},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+    ]
+
+
+def test_build_instance_filters_no_tags_list():
+    """
+    GIVEN Selector which cannot be expressed with filters and list action.
+    WHEN build_instance_filters() is called.
+    THEN No filters are returned.
+    """
+    assert build_instance_filters(action='list', ec2_no_tags=True) == []
+
+
+def test_token_bucket_rate_limiter_on_throttle():
+    """
+    GIVEN Token bucket rate limiter.
+    WHEN on_throttle() is called.
+    THEN The rate is halved but not lower than min rate.
+    """
+    rate_limiter = TokenBucketRateLimiter(rate=4, max_rate=10, min_rate=1.5)
+    rate_limiter.on_throttle()
+    assert rate_limiter.rate == 2
+    rate_limiter.on_throttle()
+    assert rate_limiter.rate == 1.5
+
+
+def test_token_bucket_rate_limiter_on_success():
+    """
+    GIVEN Token bucket rate limiter.
+    WHEN on_success() is called multiple times.
+    THEN The rate is increased but not higher than max rate.
+    """
+    rate_limiter = TokenBucketRateLimiter(rate=4, max_rate=5)
+    rate_limiter.on_success()
+    assert rate_limiter.rate == 4.25
+    for _ in range(10):
+        rate_limiter.on_success()
+    assert rate_limiter.rate == 5
+
+
+def test_token_bucket_rate_limiter_rate_below_one(monkeypatch):
+    """
+    GIVEN Token bucket rate limiter with rate lower than one request per second.
+    WHEN reserve() is called twice and again after the returned wait time.
+    THEN The second request waits for the token, which is granted once the wait time elapsed.
+    """
+    clock = [100.0]
+    monkeypatch.setattr('ec2_tags.time.monotonic', lambda: clock[0])
+    rate_limiter = TokenBucketRateLimiter(rate=0.5)
+    assert rate_limiter.reserve() == 0
+    wait_time = rate_limiter.reserve()
+    assert wait_time == 2
+    clock[0] += wait_time
+    assert rate_limiter.reserve() == 0
+
+
+def test_token_bucket_rate_limiter_throttled_repeatedly(monkeypatch):
+    """
+    GIVEN Token bucket rate limiter with default rate.
+    WHEN on_throttle() is called until the rate drops to the min rate (below one request per second).
+    THEN The rate limiter still grants a token after the returned wait time.
+    """
+    clock = [100.0]
+    monkeypatch.setattr('ec2_tags.time.monotonic', lambda: clock[0])
+    rate_limiter = TokenBucketRateLimiter()
+    for _ in range(5):
+        rate_limiter.on_throttle()
+    assert rate_limiter.rate == rate_limiter.min_rate < 1
+    wait_time = rate_limiter.reserve()
+    assert wait_time > 0
+    clock[0] += wait_time
+    assert rate_limiter.reserve() == 0
+
+
+def test_call_with_rate_limit_throttled(monkeypatch):
+    """
+    GIVEN Function throttled by AWS API on first call.
+    WHEN call_with_rate_limit() is called.
+    THEN The function is retried and the rate of rate limiter is reduced.
+    """
+    monkeypatch.setattr('ec2_tags.time.sleep', lambda seconds: None)
+    calls = []
+
+    def throttled_func(instance_id):
+        calls.append(instance_id)
+        if len(calls) == 1:
+            raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}},
+                              'StopInstances')
+        return instance_id
+
+    rate_limiter = TokenBucketRateLimiter(rate=1000, max_rate=1000)
+    assert call_with_rate_limit(rate_limiter, throttled_func, instance_id='i-123') == 'i-123'
+    assert calls == ['i-123', 'i-123']
+    assert rate_limiter.rate < 1000
+
+
+def test_call_with_rate_limit_not_throttled_error():
+    """
+    GIVEN Function failing with error other than throttling.
+    WHEN call_with_rate_limit() is called.
+    THEN The error is raised without retries.
+    """
+    calls = []
+
+    def failed_func():
+        calls.append(1)
+        raise ClientError({'Error': {'Code': 'IncorrectInstanceState', 'Message': 'Instance is pending.'}},
+                          'StopInstances')
+
+    with pytest.raises(ClientError):
+        call_with_rate_limit(TokenBucketRateLimiter(), failed_func)
+    assert len(calls) == 1
+
+
+def test_iterate_in_background():
+    """
+    GIVEN Iterable with items.
+    WHEN iterate_in_background() is called.
+    THEN All items are yielded in the original order.
+    """
+    items = list(iterate_in_background(range(100), max_size=10))
+    assert [item for item in items if item is not None] == list(range(100))
+
+
+def test_iterate_in_background_idle():
+    """
+    GIVEN Iterable which waits before yielding the next item.
+    WHEN iterate_in_background() is called.
+    THEN None is yielded while waiting for the next item.
+    """
+    def slow_items():
+        yield 1
+        time.sleep(0.2)
+        yield 2
+
+    assert list(iterate_in_background(slow_items(), idle_timeout=0.05))[:2] == [1, None]
+
+
+def test_iterate_in_background_error():
+    """
+    GIVEN Iterable raising an exception.
+    WHEN iterate_in_background() is called.
+    THEN The exception is raised in the consumer.
+    """
+    def failed_items():
+        yield 1
+        raise ValueError('Listing failed')
+
+    with pytest.raises(ValueError):
+        list(iterate_in_background(failed_items()))
+
+
+def test_instance_record_from_tags_list():
+    """
+    GIVEN List of EC2 instance tags.
+    WHEN InstanceRecord.from_tags_list() is called.
+    THEN Instance record with tags indexed by tag key is returned.
+    """
+    dummy_tags = [
+        {'Key': 'Environment', 'Value': 'dev'},
+        {'Key': 'Name', 'Value': 'ansible-0'}
+    ]
+    instance = InstanceRecord.from_tags_list(instance_id='i-123', state='running', tags=dummy_tags)
+    assert instance.tags == {'Environment': 'dev', 'Name': 'ansible-0'}
+    assert instance.has_tag(tag_key='Environment', tag_value='dev')
+    assert instance.has_tag(tag_key='Name')
+    assert not instance.has_tag(tag_key='Environment', tag_value='prod')
+    assert not instance.has_tag(tag_key='Project')
+
+
+def test_instance_record_from_tags_list_no_tags():
+    """
+    GIVEN Instance without tags (EC2 API returns no tags list).
+    WHEN InstanceRecord.from_tags_list() is called.
+    THEN Instance record with empty read-only tags is returned.
+    """
+    instance = InstanceRecord.from_tags_list(instance_id='i-123', state='running', tags=None)
+    assert not instance.tags
+    with pytest.raises(TypeError):
+        instance.tags['Name'] = 'ansible-0'
+
+
+def test_is_instance_selected_no_name_tag():
+    """
+    GIVEN Instances with and without Name tag.
+    WHEN is_instance_selected() is called with no Name tag selector.
+    THEN Only instances without Name tag are selected.
+    """
+    assert is_instance_selected(instance=InstanceRecord('i-1', 'running'), ec2_no_name_tag=True)
+    assert is_instance_selected(instance=InstanceRecord('i-2', 'running', {'Env': 'dev'}), ec2_no_name_tag=True)
+    assert not is_instance_selected(instance=InstanceRecord('i-3', 'running', {'Name': 'x'}), ec2_no_name_tag=True)
+
+
+def test_compiled_tag_expression_matches():
+    """
+    GIVEN Tag expression with AND, NOT, wildcard and regex terms.
+    WHEN CompiledTagExpression.matches() is called.
+    THEN Only instances matching the expression are matched.
+    """
+    tag_expression = CompiledTagExpression('Env=Te?t AND NOT Owner=* AND (Project~^tmp- OR Name=web-*)')
+    assert tag_expression.matches(InstanceRecord('i-1', 'running', {'Env': 'Test', 'Project': 'tmp-1'}))
+    assert tag_expression.matches(InstanceRecord('i-2', 'running', {'Env': 'Text', 'Name': 'web-1'}))
+    assert not tag_expression.matches(InstanceRecord('i-3', 'running', {'Env': 'Test', 'Project': 'prod-1'}))
+    assert not tag_expression.matches(InstanceRecord('i-4', 'running', {'Env': 'Test', 'Project': 'tmp-1',
+                                                                        'Owner': 'ops'}))
+    assert not tag_expression.matches(InstanceRecord('i-5', 'running'))
+
+
+def test_compiled_tag_expression_filters():
+    """
+    GIVEN Tag expression with sub-expressions supported by EC2 API.
+    WHEN CompiledTagExpression is created.
+    THEN Supported sub-expressions are pushed down into EC2 filters and are not checked locally.
+    """
+    tag_expression = CompiledTagExpression('(Env=Dev OR Env=Test) AND Owner=* AND Name=web-*')
+    assert tag_expression.filters == [
+        {'Name': 'tag:Env', 'Values': ['Dev', 'Test']},
+        {'Name': 'tag-key', 'Values': ['Owner']},
+        {'Name': 'tag:Name', 'Values': ['web-*']}
+    ]
+    assert tag_expression.predicate is None
+
+
+def test_compiled_tag_expression_filters_partial():
+    """
+    GIVEN Tag expression with sub-expressions not supported by EC2 API.
+    WHEN CompiledTagExpression is created.
+    THEN Only supported top-level sub-expressions are pushed down into EC2 filters. Instances listed with
+    the filters are checked only with the rest of the expression.
+    """
+    tag_expression = CompiledTagExpression('Env=Test AND NOT Owner=* AND Project="tmp project"')
+    assert tag_expression.filters == [
+        {'Name': 'tag:Env', 'Values': ['Test']},
+        {'Name': 'tag:Project', 'Values': ['tmp project']}
+    ]
+    assert tag_expression.matches(InstanceRecord('i-1', 'running', {'Env': 'Test'}), filters_applied=True)
+    assert not tag_expression.matches(InstanceRecord('i-2', 'running', {'Env': 'Test', 'Owner': 'ops'}),
+                                      filters_applied=True)
+
+
+def test_compiled_tag_expression_matches_without_filters():
+    """
+    GIVEN Tag expressions fully or partially pushed down into EC2 filters.
+    WHEN CompiledTagExpression.matches() is called with instances which were not listed with the filters.
+    THEN The whole expression is checked, including the sub-expressions pushed down into EC2 filters.
+    """
+    tag_expression = CompiledTagExpression('Env=Test')
+    assert tag_expression.predicate is None
+    assert tag_expression.matches(InstanceRecord('i-1', 'running', {'Env': 'Test'}))
+    assert not tag_expression.matches(InstanceRecord('i-2', 'running', {'Env': 'Prod'}))
+    assert not tag_expression.matches(InstanceRecord('i-3', 'running'))
+    tag_expression = CompiledTagExpression('Env=Test AND NOT Owner=* AND Project="tmp project"')
+    assert tag_expression.matches(InstanceRecord('i-4', 'running', {'Env': 'Test', 'Project': 'tmp project'}))
+    assert not tag_expression.matches(InstanceRecord('i-5', 'running', {'Env': 'Test'}))
+    assert not is_instance_selected(instance=InstanceRecord('i-6', 'running', {'Env': 'Prod'}),
+                                    ec2_tag_expression=CompiledTagExpression('Env=Test'))
+    assert is_instance_selected(instance=InstanceRecord('i-6', 'running', {'Env': 'Prod'}), filters_applied=True,
+                                ec2_tag_expression=CompiledTagExpression('Env=Test'))
+
+
+@pytest.mark.parametrize('expression', ['', 'Env', 'Env=Test AND', '(Env=Test', 'Env=Test)', 'Env~"["', 'Env="Test'])
+def test_compiled_tag_expression_invalid(expression):
+    """
+    GIVEN Invalid tag expression.
+    WHEN CompiledTagExpression is created.
+    THEN TagExpressionError is raised.
+    """
+    with pytest.raises(TagExpressionError):
+        CompiledTagExpression(expression)
+
+
+def test_load_policies_json(tmp_path):
+    """
+    GIVEN JSON policy file with multiple policies.
+    WHEN load_policies() is called.
+    THEN Policies with selectors are returned.
+    """
+    policy_file = tmp_path / 'policies.json'
+    policy_file.write_text(
+        '{"policies": [{"name": "stop-dev", "action": "stop", "tag": {"key": "Env", "value": "Dev"}},'
+        ' {"action": "terminate", "no_tags": true}, {"action": "list", "no_name": true},'
+        ' {"action": "stop", "expression": "Env=Test"}]}'
+    )
+    policies = load_policies(policy_file=str(policy_file))
+    assert [policy.name for policy in policies] == ['stop-dev', 'terminate', 'list', 'stop']
+    assert policies[0].selector == {'ec2_tag': {'tag_key': 'Env', 'tag_value': 'Dev'}}
+    assert policies[1].selector == {'ec2_no_tags': True}
+    assert policies[2].selector == {'ec2_no_name_tag': True}
+    assert policies[3].selector['ec2_tag_expression'].filters == [{'Name': 'tag:Env', 'Values': ['Test']}]
+
+
+def test_load_policies_yaml(tmp_path):
+    """
+    GIVEN YAML policy file with list of policies.
+    WHEN load_policies() is called.
+    THEN Policies with selectors are returned.
+    """
+    pytest.importorskip('yaml')
+    policy_file = tmp_path / 'policies.yaml'
+    policy_file.write_text('- action: stop\n  expression: Env=Dev\n- action: list\n  no_name: true\n')
+    policies = load_policies(policy_file=str(policy_file))
+    assert [policy.action for policy in policies] == ['stop', 'list']
+
+
+@pytest.mark.parametrize('policy', [
+    {'action': 'reboot'},
+    {'action': 'stop', 'no_tags': True, 'no_name': True},
+    {'action': 'stop', 'tag': {'key': 'Env'}},
+    {'action': 'stop', 'expression': 'Env=Dev AND'},
+    {'action': 'tag', 'no_name': True},
+    {'action': 'stop', 'expired': True, 'no_name': True},
+    'stop'
+])
+def test_policy_from_dict_invalid(policy):
+    """
+    GIVEN Invalid policy file entry.
+    WHEN Policy.from_dict() is called.
+    THEN PolicyError is raised.
+    """
+    with pytest.raises(PolicyError):
+        Policy.from_dict(policy)
+
+
+def test_select_policy_action_precedence():
+    """
+    GIVEN Policies with different actions matching the same instance.
+    WHEN select_policy_action() is called.
+    THEN The action with the highest precedence is returned.
+    """
+    policies = [
+        Policy(action='list', selector={'ec2_no_name_tag': True}),
+        Policy(action='terminate', selector={'ec2_no_tags': True}),
+        Policy(action='stop', selector={'ec2_tag': {'tag_key': 'Env', 'tag_value': 'Dev'}})
+    ]
+    assert select_policy_action(instance=InstanceRecord('i-1', 'running'), policies=policies) == 'terminate'
+    assert select_policy_action(instance=InstanceRecord('i-2', 'running', {'Env': 'Dev'}), policies=policies) == 'stop'
+    assert select_policy_action(instance=InstanceRecord('i-3', 'stopped', {'Env': 'Dev'}), policies=policies) == 'list'
+    assert select_policy_action(instance=InstanceRecord('i-4', 'running', {'Name': 'x'}), policies=policies) is None
+
+
+def test_build_policies_filters():
+    """
+    GIVEN Policies with stop and terminate actions.
+    WHEN build_policies_filters() is called.
+    THEN Only filter of instance states allowing any of actions is returned.
+    """
+    policies = [
+        Policy(action='stop', selector={'ec2_tag': {'tag_key': 'Env', 'tag_value': 'Dev'}}),
+        Policy(action='terminate', selector={'ec2_no_tags': True})
+    ]
+    assert build_policies_filters(policies=policies) == [
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopped', 'stopping']}
+    ]
+
+
+@pytest.fixture
+def inventory_index():
+    """
+    Inverted indexes over dummy EC2 instances.
+    """
+    return InventoryIndex([
+        InstanceRecord('i-1', 'running'),
+        InstanceRecord('i-2', 'running', {'Env': 'Test', 'Name': 'web-1'}),
+        InstanceRecord('i-3', 'stopped', {'Env': 'Test', 'Owner': 'ops'}),
+        InstanceRecord('i-4', 'running', {'Env': 'Prod', 'Name': 'db-1'})
+    ])
+
+
+def test_inventory_index_select_no_tags(inventory_index):
+    """
+    GIVEN Inverted indexes over instances.
+    WHEN InventoryIndex.select() is called with no tags selector.
+    THEN Only instances without tags are returned.
+    """
+    assert [instance.id for instance in inventory_index.select(ec2_no_tags=True)] == ['i-1']
+
+
+def test_inventory_index_select_expired():
+    """
+    GIVEN Inverted indexes over instances marked with expiry tag in the past, in the future or with invalid value.
+    WHEN InventoryIndex.select() is called with expired selector.
+    THEN Only instances whose expiry time has passed are returned.
+    """
+    inventory_index = InventoryIndex([
+        InstanceRecord('i-1', 'running'),
+        InstanceRecord('i-2', 'running', {'cleanup-after': '2020-01-31T00:00:00Z'}),
+        InstanceRecord('i-3', 'stopped', {'cleanup-after': '2020-01-31'}),
+        InstanceRecord('i-4', 'running', {'cleanup-after': format_expiry_timestamp(time.time() + 3600)}),
+        InstanceRecord('i-5', 'running', {'cleanup-after': 'never'})
+    ])
+    assert [instance.id for instance in inventory_index.select(ec2_expired_tag='cleanup-after')] == ['i-2', 'i-3']
+    assert inventory_index.select(ec2_expired_tag='expires') == []
+
+
+def test_inventory_index_select_no_name_tag(inventory_index):
+    """
+    GIVEN Inverted indexes over instances.
+    WHEN InventoryIndex.select() is called with no Name tag selector.
+    THEN Only instances without Name tag are returned.
+    """
+    assert [instance.id for instance in inventory_index.select(ec2_no_name_tag=True)] == ['i-1', 'i-3']
+
+
+def test_inventory_index_select_specified_tag(inventory_index):
+    """
+    GIVEN Inverted indexes over instances.
+    WHEN InventoryIndex.select() is called with specified tag selector.
+    THEN Only instances with specified tag are returned.
+    """
+    ec2_tag_wanted = {
+        'tag_key': 'Env',
+        'tag_value': 'Test'
+    }
+    assert [instance.id for instance in inventory_index.select(ec2_tag=ec2_tag_wanted)] == ['i-2', 'i-3']
+
+
+def test_inventory_index_select_tag_expression(inventory_index):
+    """
+    GIVEN Inverted indexes over instances.
+    WHEN InventoryIndex.select() is called with tag expression.
+    THEN Only instances matching the expression are returned.
+    """
+    tag_expression = CompiledTagExpression('Env=* AND NOT Owner=* AND Name=*-1')
+    assert [instance.id for instance in inventory_index.select(ec2_tag_expression=tag_expression)] == ['i-2', 'i-4']
+
+
+def test_action_plan_save_and_load(tmp_path):
+    """
+    GIVEN Action plan with instances added from multiple regions.
+    WHEN The plan is saved to the file and loaded back.
+    THEN The loaded plan yields the same instances with their actions per region.
+    """
+    plan_file = str(tmp_path / 'plan.json')
+    plan = ActionPlan()
+    plan.add(region='eu-west-1', action='stop', instance_ids=['i-1', 'i-2'])
+    plan.add(region='eu-west-1', action='terminate', instance_ids=['i-3'])
+    plan.add(region='us-east-1', action='stop', instance_ids=['i-4'])
+    plan.save(plan_file=plan_file)
+    loaded_plan = ActionPlan.load(plan_file=plan_file)
+    assert loaded_plan.regions == plan.regions
+    assert [(instance.id, action) for instance, action in loaded_plan.iterate_instances(region='eu-west-1')] == [
+        ('i-1', 'stop'), ('i-2', 'stop'), ('i-3', 'terminate')
+    ]
+    assert list(loaded_plan.iterate_instances(region='eu-north-1')) == []
+
+
+@pytest.mark.parametrize('plan_content', [
+    'not json',
+    '{"version": 2, "regions": {}}',
+    '{"version": 1}',
+    '{"version": 1, "regions": {"eu-west-1": {"list": ["i-1"]}}}'
+])
+def test_action_plan_load_invalid(tmp_path, plan_content):
+    """
+    GIVEN Plan file which is not valid.
+    WHEN ActionPlan.load() is called.
+    THEN PlanError is raised.
+    """
+    plan_file = tmp_path / 'plan.json'
+    plan_file.write_text(plan_content)
+    with pytest.raises(PlanError):
+        ActionPlan.load(plan_file=str(plan_file))
+
+
+RESULT_RECORDS = [
+    {'instance_id': 'i-1', 'region': 'eu-west-1', 'action': 'stop', 'state_before': 'running',
+     'state_after': 'stopping', 'outcome': 'succeeded', 'latency_ms': 12.5},
+    {'instance_id': 'i-2', 'region': 'eu-west-1', 'action': 'stop', 'outcome': 'failed', 'latency_ms': 3.0,
+     'error': 'Instance is pending'}
+]
+
+
+def test_result_writer_json():
+    """
+    GIVEN Result writer with JSON format.
+    WHEN Records are written and the writer is closed.
+    THEN The output is JSON array of records with all output fields.
+    """
+    stream = io.StringIO()
+    with ResultWriter(output_format='json', stream=stream) as result_writer:
+        for record in RESULT_RECORDS:
+            result_writer.write(record)
+    records = json.loads(stream.getvalue())
+    assert [record['instance_id'] for record in records] == ['i-1', 'i-2']
+    assert records[1]['state_before'] is None
+    assert records[1]['error'] == 'Instance is pending'
+
+
+def test_result_writer_json_no_records():
+    """
+    GIVEN Result writer with JSON format.
+    WHEN The writer is closed without any record written.
+    THEN The output is empty JSON array.
+    """
+    stream = io.StringIO()
+    ResultWriter(output_format='json', stream=stream).close()
+    assert json.loads(stream.getvalue()) == []
+
+
+def test_result_writer_ndjson_buffered():
+    """
+    GIVEN Result writer with NDJSON format and buffer of 2 records.
+    WHEN Records are written one by one.
+    THEN The records are written to the stream only once the buffer is full, a record per line.
+    """
+    stream = io.StringIO()
+    result_writer = ResultWriter(output_format='ndjson', stream=stream, buffer_size=2)
+    result_writer.write(RESULT_RECORDS[0])
+    assert stream.getvalue() == ''
+    result_writer.write(RESULT_RECORDS[1])
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line)['outcome'] for line in lines] == ['succeeded', 'failed']
+
+
+def test_result_writer_csv():
+    """
+    GIVEN Result writer with CSV format.
+    WHEN Records are written and the writer is closed.
+    THEN The output is CSV with header row and a row per record.
+    """
+    stream = io.StringIO()
+    with ResultWriter(output_format='csv', stream=stream) as result_writer:
+        for record in RESULT_RECORDS:
+            result_writer.write(record)
+    assert stream.getvalue().splitlines() == [
+        'instance_id,region,action,state_before,state_after,outcome,latency_ms,error,account',
+        'i-1,eu-west-1,stop,running,stopping,succeeded,12.5,,',
+        'i-2,eu-west-1,stop,,,failed,3.0,Instance is pending,'
+    ]
+
+
+def test_run_stats_prometheus():
+    """
+    GIVEN Statistics with recorded phase and AWS API calls.
+    WHEN to_prometheus() is called.
+    THEN Phase time, counters and cumulative latency histogram are returned in Prometheus text format.
+    """
+    stats = RunStats()
+    stats.add_phase_time('scan', 1.5)
+    stats.record_api_call(operation='StopInstances', latency=0.02)
+    stats.record_api_call(operation='StopInstances', latency=0.3, error=True, retries=2)
+    stats.record_api_attempt(operation='StopInstances', bytes_received=100, throttled=True)
+    lines = stats.to_prometheus().splitlines()
+    assert 'ec2_tags_phase_seconds{phase="scan"} 1.5' in lines
+    assert 'ec2_tags_api_calls_total{operation="StopInstances"} 2' in lines
+    assert 'ec2_tags_api_errors_total{operation="StopInstances"} 1' in lines
+    assert 'ec2_tags_api_retries_total{operation="StopInstances"} 2' in lines
+    assert 'ec2_tags_api_throttles_total{operation="StopInstances"} 1' in lines
+    assert 'ec2_tags_api_received_bytes_total{operation="StopInstances"} 100' in lines
+    assert 'ec2_tags_api_call_duration_seconds_bucket{operation="StopInstances",le="0.01"} 0' in lines
+    assert 'ec2_tags_api_call_duration_seconds_bucket{operation="StopInstances",le="0.025"} 1' in lines
+    assert 'ec2_tags_api_call_duration_seconds_bucket{operation="StopInstances",le="0.5"} 2' in lines
+    assert 'ec2_tags_api_call_duration_seconds_bucket{operation="StopInstances",le="+Inf"} 2' in lines
+    assert 'ec2_tags_api_call_duration_seconds_count{operation="StopInstances"} 2' in lines
+
+
+def test_run_stats_send_statsd():
+    """
+    GIVEN Statistics with recorded phase and AWS API call and listening UDP socket.
+    WHEN send_statsd() is called with the socket address.
+    THEN StatsD metric lines are received.
+    """
+    stats = RunStats()
+    stats.add_phase_time('action', 0.25)
+    stats.record_api_call(operation='DescribeInstances', latency=0.1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+        server_socket.bind(('127.0.0.1', 0))
+        server_socket.settimeout(5)
+        stats.send_statsd(address=f'127.0.0.1:{server_socket.getsockname()[1]}')
+        lines = server_socket.recv(65535).decode('utf-8').splitlines()
+    assert 'ec2_tags.phase.action:250.000|ms' in lines
+    assert 'ec2_tags.api.DescribeInstances.calls:1|c' in lines
+    assert 'ec2_tags.api.DescribeInstances.latency:100.000|ms' in lines
+
+
+def test_import_defers_aws_sdk():
+    """
+    GIVEN New Python process.
+    WHEN ec2_tags module is imported.
+    THEN AWS SDK, jmespath, asyncio and sqlite3 modules are not loaded.
+    """
+    deferred_modules = ['boto3', 'botocore.session', 'botocore.config', 'jmespath', 'asyncio', 'sqlite3']
+    code = f'import sys, ec2_tags; print(*[module for module in {deferred_modules!r} if module in sys.modules])'
+    repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.split() == []
+
+
+def test_cli_all_regions_export_requires_placeholder(tmp_path):
+    """
+    GIVEN Export file name without "{region}" placeholder.
+    WHEN The script is run with --all-regions and export action.
+    THEN The script exits with usage error before calling AWS.
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable, 'ec2_tags.py', '--all-regions', '-f', str(tmp_path / 'all.json.gz'),
+                             'export'], cwd=repo_dir, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert '-f/--file must contain "{region}" placeholder' in result.stderr
+
+
+def test_result_counts_summary():
+    """
+    GIVEN Result counts of two regions.
+    WHEN Counts are merged and summary() is called.
+    THEN Counts per outcome are returned in the order of outcomes.
+    """
+    region_counts = ResultCounts()
+    region_counts.add(outcome='failed')
+    region_counts.add(outcome='succeeded', count=2)
+    account_counts = ResultCounts()
+    account_counts.add(outcome='succeeded')
+    account_counts.update(region_counts)
+    assert account_counts.summary() == '3 succeeded, 1 failed'
+    assert ResultCounts().summary() == 'nothing to do'
+
+
+@pytest.mark.parametrize('role_arn, account_id', [
+    ('arn:aws:iam::111111111111:role/cleanup', '111111111111'),
+    ('arn:aws-us-gov:iam::222222222222:role/ops/cleanup', '222222222222')
+])
+def test_get_role_account_id(role_arn, account_id):
+    """
+    GIVEN IAM role ARN.
+    WHEN get_role_account_id() is called.
+    THEN Account id of the role is returned.
+    """
+    assert get_role_account_id(role_arn) == account_id
+
+
+def test_get_role_account_id_invalid():
+    """
+    GIVEN ARN which is not IAM role ARN.
+    WHEN get_role_account_id() is called.
+    THEN ValueError is raised.
+    """
+    with pytest.raises(ValueError):
+        get_role_account_id('arn:aws:iam::111111111111:user/admin')
+
+
+def test_serve_status_metrics():
+    """
+    GIVEN Serve status with a successful and a failed sweep.
+    WHEN to_prometheus() is called.
+    THEN Sweep counters and results of the last sweep are returned in Prometheus text format.
+    """
+    status = ServeStatus(interval=60)
+    result_counts = ResultCounts()
+    result_counts.add(outcome='succeeded', count=2)
+    status.record_sweep(seconds=1.5, result_counts=ResultCounts())
+    status.record_sweep(seconds=2.5, result_counts=result_counts, failed=True)
+    lines = status.to_prometheus().splitlines()
+    assert 'ec2_tags_sweeps_total 2' in lines
+    assert 'ec2_tags_sweep_failures_total 1' in lines
+    assert 'ec2_tags_last_sweep_duration_seconds 2.5' in lines
+    assert 'ec2_tags_last_sweep_instances{outcome="succeeded"} 2' in lines
+    assert status.is_healthy()
+
+
+def test_serve_status_unhealthy():
+    """
+    GIVEN Serve status without successful sweep within the healthy intervals.
+    WHEN is_healthy() is called.
+    THEN Serve mode is reported unhealthy.
+    """
+    status = ServeStatus(interval=60)
+    status.started_at -= 1000
+    assert not status.is_healthy()
+    status.record_sweep(seconds=1.0, result_counts=ResultCounts())
+    assert status.is_healthy()
+
+
+def test_start_status_server():
+    """
+    GIVEN Status server of serve mode listening on a free local port.
+    WHEN Health, metrics and unknown endpoints are requested.
+    THEN Health and metrics are returned, unknown endpoint is not found.
+    """
+    status = ServeStatus(interval=60)
+    server = start_status_server(status=status, address='127.0.0.1:0')
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        with urllib.request.urlopen(f'{base_url}/healthz', timeout=5) as response:
+            assert response.read() == b'ok\n'
+        with urllib.request.urlopen(f'{base_url}/metrics', timeout=5) as response:
+            assert 'ec2_tags_sweeps_total 0' in response.read().decode('utf-8').splitlines()
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(f'{base_url}/unknown', timeout=5)
+        assert err.value.code == 404
+        status.started_at -= 1000
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(f'{base_url}/healthz', timeout=5)
+        assert err.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+STATE_CHANGE_EVENT = {
+    'source': 'aws.ec2',
+    'detail-type': 'EC2 Instance State-change Notification',
+    'region': 'eu-west-1',
+    'detail': {'instance-id': 'i-1', 'state': 'running'}
+}
+RUN_INSTANCES_EVENT = {
+    'source': 'aws.ec2',
+    'detail-type': 'AWS API Call via CloudTrail',
+    'region': 'us-east-1',
+    'detail': {
+        'eventName': 'RunInstances',
+        'awsRegion': 'us-east-1',
+        'responseElements': {'instancesSet': {'items': [{'instanceId': 'i-2'}, {'instanceId': 'i-3'}]}}
+    }
+}
+
+
+@pytest.mark.parametrize('event, instance_events', [
+    (STATE_CHANGE_EVENT, [('eu-west-1', 'i-1', 'running')]),
+    (RUN_INSTANCES_EVENT, [('us-east-1', 'i-2', None), ('us-east-1', 'i-3', None)]),
+    ({'Type': 'Notification', 'Message': json.dumps(STATE_CHANGE_EVENT)}, [('eu-west-1', 'i-1', 'running')]),
+    ({'detail-type': 'AWS API Call via CloudTrail', 'detail': {'eventName': 'CreateTags'}}, []),
+    ({'detail-type': 'Scheduled Event', 'detail': {}}, [])
+])
+def test_parse_instance_event(event, instance_events):
+    """
+    GIVEN EventBridge event (possibly wrapped in SNS notification).
+    WHEN parse_instance_event() is called.
+    THEN Region, id and state of EC2 instances from state-change and RunInstances events are returned,
+    other events are ignored.
+    """
+    assert parse_instance_event(event) == instance_events
+
+
+@pytest.mark.parametrize('event', [
+    {'detail-type': 'EC2 Instance State-change Notification', 'region': 'eu-west-1', 'detail': {}},
+    {'detail-type': 'EC2 Instance State-change Notification', 'region': 'not a region',
+     'detail': {'instance-id': 'i-1'}},
+    {'Type': 'Notification', 'Message': 'not json'},
+    ['not', 'an', 'object']
+])
+def test_parse_instance_event_invalid(event):
+    """
+    GIVEN Malformed event.
+    WHEN parse_instance_event() is called.
+    THEN EventError is raised.
+    """
+    with pytest.raises(EventError):
+        parse_instance_event(event)
+
+
+def test_get_queue_region():
+    """
+    GIVEN SQS queue URLs with and without region.
+    WHEN get_queue_region() is called.
+    THEN Region of the queue or None is returned.
+    """
+    assert get_queue_region('https://sqs.eu-west-1.amazonaws.com/123456789012/events') == 'eu-west-1'
+    assert get_queue_region('http://localhost:9324/queue/events') is None
+
+
+def test_parse_tags():
+    """
+    GIVEN Comma-separated tags of tag and untag actions given as KEY=VALUE or KEY.
+    WHEN parse_tags() is called.
+    THEN Tag values are mapped to tag keys, KEY alone of untag action removes the tag with any value.
+    """
+    assert parse_tags(tag_args=['Owner=unknown,cleanup-after=2026-01-31', 'Note='], action='tag') == \
+        {'Owner': 'unknown', 'cleanup-after': '2026-01-31', 'Note': ''}
+    tags = parse_tags(tag_args=['Owner,Env=Test'], action='untag')
+    assert tags == {'Owner': None, 'Env': 'Test'}
+    assert build_api_tags(tags) == [{'Key': 'Owner'}, {'Key': 'Env', 'Value': 'Test'}]
+
+
+def test_parse_tags_invalid():
+    """
+    GIVEN Tags without value of tag action, without key, with reserved aws: prefix or no tags at all.
+    WHEN parse_tags() is called.
+    THEN TagsError is raised.
+    """
+    for tag_args, action in [(['Owner'], 'tag'), (['=unknown'], 'untag'), (['aws:cloudformation:stack-name'], 'untag'),
+                             (['AWS:Owner=unknown'], 'tag'), ([], 'tag'), (['Owner=unknown,'], 'tag'),
+                             ([f'Key{index}=value' for index in range(51)], 'tag')]:
+        with pytest.raises(TagsError):
+            parse_tags(tag_args=tag_args, action=action)
+
+
+def test_is_tags_change_needed():
+    """
+    GIVEN Instance with assigned tags.
+    WHEN is_tags_change_needed() is called with tag and untag actions.
+    THEN True is returned only if the action would change the tags of the instance.
+    """
+    instance = InstanceRecord.from_tags_list(instance_id='i-1', state='running',
+                                             tags=[{'Key': 'Owner', 'Value': 'unknown'},
+                                                   {'Key': 'Env', 'Value': 'Test'}])
+    assert not is_tags_change_needed(instance=instance, action='tag', tags={'Owner': 'unknown'})
+    assert is_tags_change_needed(instance=instance, action='tag', tags={'Owner': 'unknown', 'Env': 'Dev'})
+    assert is_tags_change_needed(instance=instance, action='tag', tags={'Project': ''})
+    assert is_tags_change_needed(instance=instance, action='untag', tags={'Owner': None})
+    assert is_tags_change_needed(instance=instance, action='untag', tags={'Env': 'Test'})
+    assert not is_tags_change_needed(instance=instance, action='untag', tags={'Env': 'Dev', 'Project': None})
+
+
+def test_parse_expiry_timestamp():
+    """
+    GIVEN Expiry tag values with UTC time, time with offset, date only and invalid values.
+    WHEN parse_expiry_timestamp() is called.
+    THEN POSIX timestamp is returned (UTC if time zone is not given), or None for invalid values.
+    """
+    assert parse_expiry_timestamp('2026-01-31T12:00:00Z') == 1769860800.0
+    assert parse_expiry_timestamp('2026-01-31T14:00:00+02:00') == 1769860800.0
+    assert parse_expiry_timestamp('2026-01-31') == 1769817600.0
+    assert parse_expiry_timestamp(format_expiry_timestamp(1769860800.0)) == 1769860800.0
+    for tag_value in ['', 'tomorrow', '2026-13-01']:
+        assert parse_expiry_timestamp(tag_value) is None
+
+
+def test_is_instance_expired():
+    """
+    GIVEN Instances marked with expiry tag, instance without the tag and given current time.
+    WHEN is_instance_expired() is called.
+    THEN True is returned only if the expiry time of the instance has passed.
+    """
+    instance = InstanceRecord('i-1', 'running', {'cleanup-after': '2026-01-31T12:00:00Z'})
+    assert is_instance_expired(instance=instance, expiry_tag='cleanup-after', now=1769860800.0)
+    assert not is_instance_expired(instance=instance, expiry_tag='cleanup-after', now=1769860799.0)
+    assert not is_instance_expired(instance=InstanceRecord('i-2', 'running'), expiry_tag='cleanup-after')
+    assert is_instance_selected(instance=instance, ec2_expired_tag='cleanup-after')
+    assert is_tags_change_needed(instance=InstanceRecord('i-2', 'running'), action='mark',
+                                 tags={'cleanup-after': '2026-02-07T12:00:00Z'})
+    assert not is_tags_change_needed(instance=instance, action='mark', tags={'cleanup-after': '2026-02-07T12:00:00Z'})
+
+
+def test_is_instance_error():
+    """
+    GIVEN AWS API errors caused by an instance in the batch and errors of the whole request.
+    WHEN is_instance_error() is called.
+    THEN True is returned only for the errors caused by an instance.
+    """
+    for error_code, expected in [('IncorrectInstanceState', True), ('InvalidInstanceID.NotFound', True),
+                                 ('InvalidInstanceID.Malformed', True), ('OperationNotPermitted', True),
+                                 ('UnauthorizedOperation', False), ('RequestLimitExceeded', False),
+                                 ('InternalError', False), ('InvalidInstanceIDs', False)]:
+        err = ClientError({'Error': {'Code': error_code, 'Message': 'Error'}}, 'StopInstances')
+        assert is_instance_error(err) is expected